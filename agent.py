@@ -1,10 +1,10 @@
 #!/data/data/com.termux/files/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import os, sys, json, time, asyncio, hashlib, signal, re, socket
+import os, sys, json, time, asyncio, hashlib, signal, re, socket, threading
 import aiohttp
 from aiohttp import ClientSession
-from yd_cloud import yadisk_download_cloud
+from yd_cloud import yadisk_download_cloud, yadisk_list_recent, yadisk_token, _normalize_disk_path
 
 from pathlib import Path
 from subprocess import Popen, PIPE
@@ -67,15 +67,62 @@ CURRENT_JOB = None
 
 
 HEARTBEAT_INTERVAL_S = int(os.environ.get("HEARTBEAT_INTERVAL_S", "20"))
-TIMEOUT_S            = int(os.environ.get("TIMEOUT_S", "7200"))
+TIMEOUT_S            = int(os.environ.get("TIMEOUT_S", "7200"))  # когда длительность аудио неизвестна
+
+# Дедлайны по длительности: base + audio_s × RTF × mult, где RTF — измеренный на устройстве
+# (время whisper / длительность аудио, EWMA по модели и числу потоков)
+DEADLINE_BASE_S = float(os.environ.get("DEADLINE_BASE_S", "120"))   # загрузка модели и пр.
+DEADLINE_MULT   = float(os.environ.get("DEADLINE_MULT", "3.0"))     # запас на троттлинг/соседей
+DEADLINE_MAX_S  = float(os.environ.get("DEADLINE_MAX_S", "21600"))
+RTF_DEFAULT     = float(os.environ.get("RTF_DEFAULT", "1.0"))       # пока своих замеров нет
+# Зависание: ни вывода, ни STALL_MIN_CPU_S процессорного времени за STALL_S → kill и повтор
+STALL_S         = float(os.environ.get("STALL_S", "120"))
+STALL_MIN_CPU_S = float(os.environ.get("STALL_MIN_CPU_S", "0.5"))
+STALL_FALLBACK_MODEL = os.environ.get("STALL_FALLBACK_MODEL", "")   # модель поменьше для последней попытки
+# Петли повторов whisper (галлюцинации на шуме/музыке ожидания): следим за сегментами в stdout,
+# при срабатывании — kill и дорасшифровка хвоста с начала петли (REP_RETRY_ARGS, напр. без контекста)
+REP_GUARD             = os.environ.get("REP_GUARD", "1") == "1"
+REP_MAX_SAME          = int(os.environ.get("REP_MAX_SAME", "4"))         # одинаковых сегментов подряд
+REP_WINDOW            = int(os.environ.get("REP_WINDOW", "8"))           # окно сегментов для n-грамм/сжатия
+REP_NGRAM             = int(os.environ.get("REP_NGRAM", "3"))
+REP_NGRAM_RATIO       = float(os.environ.get("REP_NGRAM_RATIO", "0.5"))  # доля повторных n-грамм в окне
+REP_COMPRESSION_RATIO = float(os.environ.get("REP_COMPRESSION_RATIO", "2.4"))  # как в самом whisper
+REP_MIN_WORDS         = int(os.environ.get("REP_MIN_WORDS", "24"))
+REP_RETRIES           = int(os.environ.get("REP_RETRIES", "2"))
+REP_RETRY_ARGS        = os.environ.get("REP_RETRY_ARGS", "-mc 0").split()
+RC_DEADLINE, RC_STALL, RC_REPEAT = 124, 125, 126
 
 MAX_TEXT_LEN         = int(os.environ.get("MAX_TEXT_LEN", "200000"))  # лимит full_text
 LOG_LEVEL  = os.environ.get("LOG_LEVEL", "INFO").upper()  # DEBUG/INFO/WARN/ERROR
 REG_INCLUDE_TOKEN = os.environ.get("REG_INCLUDE_TOKEN") == "1"  # опц: включить токен в payload
 
+# Микро-батчинг коротких звонков: BATCH_WINDOW_S=0 — выключено.
+# Вторую задачу берём, только если в job.assign есть duration_s (сек) и она короткая; воркер объявляет это
+# в registration: capabilities.batch = {max_jobs, short_s, requires: ["duration_s"]}.
+BATCH_WINDOW_S   = float(os.environ.get("BATCH_WINDOW_S", "0"))    # сколько держать короткую задачу в ожидании соседей
+BATCH_MAX_JOBS   = int(os.environ.get("BATCH_MAX_JOBS", "4"))      # максимум задач в одном прогоне whisper
+BATCH_SHORT_S    = float(os.environ.get("BATCH_SHORT_S", "60"))    # «короткий» звонок, сек
+BATCH_GAP_S      = float(os.environ.get("BATCH_GAP_S", "2.0"))     # тишина между кусками, сек
+BATCH_WHISPER_ARGS = os.environ.get("BATCH_WHISPER_ARGS", "-mc 0").split()  # без контекста: текст задачи не течёт в соседнюю
+ACTIVE_JOBS = {}  # job_id -> asyncio.Task (при батчинге их может быть несколько)
+JOB_DURATION_HINT = {}  # job_id -> duration_s из job.assign (None — не прислали)
+
 # Таймауты HTTP (загрузка аудио/POST результата)
 _HTTP_TIMEOUT = aiohttp.ClientTimeout(total=180, connect=10, sock_read=120)
 
+# Профили HTTP-клиента: отдельный пул и таймауты на каждый класс трафика
+#   control — WS + мелкие API-вызовы; bulk — скачивание аудио (Я.Диск downloader);
+#   upload — POST результата. Для bulk нет total-лимита: большой файл не должен падать по общему таймауту.
+HTTP_DNS_TTL_S = int(os.environ.get("HTTP_DNS_TTL_S", "300"))
+HTTP_PROFILES = {
+    "control": {"limit": 8, "limit_per_host": 4, "keepalive_timeout": 60,
+                "timeout": _HTTP_TIMEOUT},
+    "bulk":    {"limit": 4, "limit_per_host": 2, "keepalive_timeout": 30,
+                "timeout": aiohttp.ClientTimeout(total=None, connect=15, sock_connect=15, sock_read=60)},
+    "upload":  {"limit": 2, "limit_per_host": 2, "keepalive_timeout": 120,
+                "timeout": aiohttp.ClientTimeout(total=300, connect=10, sock_read=120)},
+}
+
 # ================== папки ==================
 BASE_DIR  = Path("/sdcard/worker")
 CACHE_DIR = BASE_DIR / "cache"
@@ -126,39 +173,1227 @@ def slog(tag, obj):
         except Exception:
             log(tag, "<unloggable-object>")
 
+# ================== метрики (Prometheus-совместимые) ==================
+# Счётчики, gauge'и и гистограммы с фиксированными бакетами. Наполняются из handle_job,
+# загрузок, post_result и WS-цикла; отдаются в текстовом формате Prometheus на
+# 127.0.0.1:METRICS_PORT (0 — выключено), компактная сводка — в heartbeat (metrics.agent).
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# входящие WS-кадры, которые агент разбирает; прочие считаются как type="other" (сервер не раздувает метки)
+_WS_IN_TYPES = frozenset(("registration.ok", "control.ping", "job.assign", "job.result.ack",
+                          "control.set_config", "error"))
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}   # (name, labels) -> value
+        self.gauges = {}
+        self.hists = {}      # (name, labels) -> [bucket counts..., +Inf], sum, count
+        self.buckets = {}    # name -> tuple
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        k = self._key(name, labels)
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=_LATENCY_BUCKETS, **labels):
+        k = self._key(name, labels)
+        with self.lock:
+            b = self.buckets.setdefault(name, tuple(buckets))
+            h = self.hists.get(k)
+            if h is None:
+                h = self.hists[k] = [[0] * (len(b) + 1), 0.0, 0]
+            i = 0
+            while i < len(b) and value > b[i]:
+                i += 1
+            h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    @staticmethod
+    def _fmt_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+                seen = set()
+                for (name, labels), v in sorted(store.items()):
+                    if name not in seen:
+                        lines.append(f"# TYPE {name} {kind}")
+                        seen.add(name)
+                    lines.append(f"{name}{self._fmt_labels(labels)} {v}")
+            seen = set()
+            for (name, labels), (counts, total, n) in sorted(self.hists.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                acc = 0
+                for le, c in zip(list(self.buckets[name]) + ["+Inf"], counts):
+                    acc += c
+                    lines.append(f"{name}_bucket{self._fmt_labels(labels, [('le', le)])} {acc}")
+                lines.append(f"{name}_sum{self._fmt_labels(labels)} {round(total, 6)}")
+                lines.append(f"{name}_count{self._fmt_labels(labels)} {n}")
+        return "\n".join(lines) + "\n"
+
+    def _quantile(self, name, counts, n, q):
+        target = q * n
+        acc = 0
+        for le, c in zip(self.buckets[name], counts):
+            acc += c
+            if acc >= target:
+                return le
+        return None  # в +Inf
+
+    def summary(self, skip=()) -> dict:
+        """Компактно для heartbeat: {"c": {series: v}, "h": {series: [count, p50, p95]}}."""
+        def _series(name, labels):
+            return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+        with self.lock:
+            c = {_series(n, l): v for (n, l), v in self.counters.items() if n not in skip}
+            c.update({_series(n, l): v for (n, l), v in self.gauges.items() if n not in skip})
+            h = {_series(n, l): [cnt, self._quantile(n, cs, cnt, 0.5), self._quantile(n, cs, cnt, 0.95)]
+                 for (n, l), (cs, _sum, cnt) in self.hists.items() if cnt and n not in skip}
+        return {"c": c, "h": h}
+
+_M = MetricsRegistry()
+
+async def start_metrics_server():
+    """Опциональный localhost-эндпоинт /metrics (Prometheus text format)."""
+    if METRICS_PORT <= 0:
+        return None
+    from aiohttp import web
+
+    async def _metrics(_req):
+        _M.set("agent_jobs_active", len(ACTIVE_JOBS))
+        return web.Response(text=_M.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+    log("METRICS: http://127.0.0.1:%d/metrics" % METRICS_PORT)
+    return runner
+
+# ================== сторож event loop ==================
+# Корутина-тикер меряет запаздывание планировщика (lag = фактический сон − заказанный),
+# а поток-сэмплер, увидев, что тик не приходил дольше LOOP_BLOCK_MS, снимает стек
+# потока loop'а: так в логе оказывается конкретная синхронная функция, державшая loop.
+LOOP_LAG_INTERVAL_S = float(os.environ.get("LOOP_LAG_INTERVAL_S", "0.2"))
+LOOP_BLOCK_MS = int(os.environ.get("LOOP_BLOCK_MS", "250"))  # 0 — без снятия стека
+
+class LoopWatchdog:
+    def __init__(self, interval_s=LOOP_LAG_INTERVAL_S, block_ms=LOOP_BLOCK_MS, window=1000):
+        from collections import deque
+        self.interval = max(0.02, interval_s)
+        self.block_s = block_ms / 1000.0
+        self.lags = deque(maxlen=window)   # последние lag'и, с
+        self.max_lag = 0.0
+        self.blocks = 0
+        self.last_tick = time.monotonic()
+        self.loop_thread = None
+        self.captured = None               # (t_monotonic, [frames]) текущей блокировки
+        self.task = None
+
+    def _sampler(self):
+        import traceback
+        step = max(0.02, self.block_s / 2)
+        while True:
+            time.sleep(step)
+            if self.captured is not None or self.loop_thread is None:
+                continue
+            stalled = time.monotonic() - self.last_tick
+            if stalled < self.block_s:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                stack = [f for f in traceback.extract_stack(frame) if os.sep + "asyncio" + os.sep not in f.filename]
+                self.captured = (self.last_tick, [f"{os.path.basename(f.filename)}:{f.lineno}:{f.name}" for f in stack[-6:]])
+
+    @staticmethod
+    def _culprit(frames):
+        """Самый внутренний кадр из agent.py (его функция и есть виновник), иначе — самый внутренний."""
+        own = [f for f in frames if f.startswith(os.path.basename(__file__) + ":")]
+        return (own or frames or ["?"])[-1]
+
+    async def run(self):
+        self.loop_thread = threading.get_ident()
+        if self.block_s > 0:
+            threading.Thread(target=self._sampler, name="loop-watchdog", daemon=True).start()
+        while True:
+            t0 = time.monotonic()
+            self.last_tick = t0
+            await asyncio.sleep(self.interval)
+            t1 = time.monotonic()
+            self.last_tick = t1
+            lag = max(0.0, t1 - t0 - self.interval)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            _M.observe("agent_loop_lag_seconds", lag, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+            cap, self.captured = self.captured, None
+            if cap is not None and self.block_s > 0 and lag >= self.block_s:
+                self.blocks += 1
+                culprit = self._culprit(cap[1])
+                _M.inc("agent_loop_blocks_total", where=culprit.rsplit(":", 1)[-1])
+                log(f"LOOP: blocked {int(lag * 1000)} ms in {culprit} ← " + " ← ".join(reversed(cap[1][:-1])))
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def snapshot(self) -> dict:
+        xs = sorted(self.lags)
+        if not xs:
+            return {"lag_p50_ms": None, "lag_p99_ms": None, "lag_max_ms": None, "blocks": self.blocks}
+        return {
+            "lag_p50_ms": round(xs[len(xs) // 2] * 1000, 1),
+            "lag_p99_ms": round(xs[min(len(xs) - 1, int(len(xs) * 0.99))] * 1000, 1),
+            "lag_max_ms": round(self.max_lag * 1000, 1),
+            "blocks": self.blocks,
+        }
+
+_LOOP_WD = LoopWatchdog()
+
 # ================== утилиты ==================
-def run(cmd, timeout=None, env=None, log_cmd=False):
-    """Запуск команды, возврат (rc, stdout, stderr)."""
+def run(cmd, timeout=None, env=None, log_cmd=False, stall_s=None, on_line=None, threads=None):
+    """
+    Запуск команды, возврат (rc, stdout, stderr). Процесс всегда идёт через _run_watched: дедлайн,
+    а с stall_s/on_line — ещё и наблюдение за прогрессом; учёт ресурсов — в _take_run_usage().
+    threads — сколько потоков просили у процесса (для cpu_eff).
+    """
     if log_cmd and _should_debug():
         log("CMD:", " ".join(cmd))
     p = Popen(cmd, stdout=PIPE, stderr=PIPE, text=True, env=env)
+    return _run_watched(p, timeout, stall_s, os.path.basename(cmd[0]), on_line, threads)
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def _proc_status_kb(pid, field: str):
+    """Поле /proc/<pid>/status в кБ (VmRSS, VmHWM — пиковый RSS), None — если процесса уже нет."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except Exception:
+        pass
+    return None
+
+CPU_EFF_WARN = float(os.environ.get("CPU_EFF_WARN", "0.5"))  # cpu_s / (wall_s × threads) ниже — в лог
+
+# пиковый RSS и учёт ресурсов наблюдаемых процессов — по потоку, который их запускал (executor)
+_RUN_STATS = threading.local()
+
+def _last_run_peak_mb(reset=True):
+    v = getattr(_RUN_STATS, "peak_rss_mb", None)
+    if reset:
+        _RUN_STATS.peak_rss_mb = None
+    return v
+
+def _begin_run_usage():
+    """Начать сбор учёта дочерних процессов потока; вне сбора run() записи не копит (ping, getprop, -version)."""
+    _RUN_STATS.children = []
+    _RUN_STATS.collecting = True
+
+def _take_run_usage():
+    """Учёт дочерних процессов, накопленный текущим потоком с _begin_run_usage; сбор заканчивается."""
+    v = getattr(_RUN_STATS, "children", None) or []
+    _RUN_STATS.children = []
+    _RUN_STATS.collecting = False
+    return v
+
+def with_run_usage(fn, *a, **kw):
+    """fn(*a, **kw) для executor'а → (результат, [учёт дочерних процессов]) без хвостов прошлых вызовов потока."""
+    _begin_run_usage()
+    _last_run_peak_mb()
+    try:
+        res = fn(*a, **kw)
+    finally:
+        _last_run_peak_mb()
+        usage = _take_run_usage()
+    return res, usage
+
+def _proc_io(pid):
+    """/proc/<pid>/io: {'read_bytes', 'write_bytes', 'rchar', 'wchar'} или None."""
     try:
-        out, err = p.communicate(timeout=timeout)
+        with open(f"/proc/{pid}/io") as f:
+            return {k: int(v) for k, v in (line.split(":") for line in f if ":" in line)}
     except Exception:
-        p.kill()
-        out, err = p.communicate()
-        return 124, out, err
+        return None
+
+def _reap(p, block_s: float):
+    """
+    Дождаться процесса до block_s сек (None — без ограничения) через wait4: в отличие от
+    Popen.wait отдаёт rusage ребёнка. (True, rusage|None) — завершился, (False, None) — ещё жив.
+    """
+    if not hasattr(os, "wait4"):
+        try:
+            p.wait(timeout=block_s)
+            return True, None
+        except Exception:
+            return False, None
+    end, delay = time.monotonic() + (block_s if block_s is not None else 0), 0.0005
+    while True:
+        try:
+            pid, status, ru = os.wait4(p.pid, os.WNOHANG if block_s is not None else 0)
+        except ChildProcessError:
+            p.wait()  # уже собран кем-то ещё
+            return True, None
+        if pid:
+            p.returncode = os.waitstatus_to_exitcode(status)
+            return True, ru
+        rem = end - time.monotonic()
+        if rem <= 0:
+            return False, None
+        time.sleep(min(delay, rem))
+        delay = min(delay * 2, 0.05)
+
+def usage_summary(children) -> dict:
+    """
+    Сводка по дочерним процессам: сумма CPU/ошибок страниц/переключений/IO, пик RSS,
+    cores = cpu_s / wall_s и cpu_eff = cpu_s / Σ(wall_s × threads) — доля заказанных потоков,
+    реально занятых работой (низкая при переподписке ядер: потоки ждут CPU).
+    """
+    if not children:
+        return None
+    wall = sum(c["wall_s"] for c in children)
+    cpu = sum(c["cpu_s"] for c in children)
+    out = {"children": len(children), "wall_s": round(wall, 2), "cpu_s": round(cpu, 2),
+           "cores": round(cpu / wall, 2) if wall > 0 else None,
+           "maxrss_mb": max(c["maxrss_mb"] or 0 for c in children) or None}
+    thr_wall = sum(c["wall_s"] * c["threads"] for c in children if c.get("threads"))
+    if thr_wall > 0:
+        out["cpu_eff"] = round(sum(c["cpu_s"] for c in children if c.get("threads")) / thr_wall, 2)
+    for k in ("minflt", "majflt", "nvcsw", "nivcsw"):
+        out[k] = sum(c.get(k) or 0 for c in children)
+    for k in ("read_mb", "write_mb"):
+        out[k] = round(sum(c.get(k) or 0 for c in children), 1)
+    return out
+
+def _proc_cpu_s(pid):
+    """utime+stime процесса (все потоки) из /proc/<pid>/stat, сек."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / _CLK_TCK
+    except Exception:
+        return None
+
+def _run_watched(p, timeout, stall_s, tag, on_line=None, threads=None):
+    """
+    Ждёт процесс, следя за прогрессом: рост stdout/stderr или CPU-времени.
+    Дедлайн → kill и RC_DEADLINE, нет прогресса stall_s секунд → kill и RC_STALL,
+    on_line(строка stdout) вернул True → kill и RC_REPEAT.
+    Ребёнок собирается через wait4: rusage (CPU, ошибки страниц, переключения контекста, пик RSS)
+    плюс последний замер /proc/<pid>/io уходят записью в _RUN_STATS.children.
+    """
+    bufs = {"out": [], "err": []}
+    seen = [0]
+    tripped = threading.Event()
+
+    def _pump(stream, key):
+        for line in iter(stream.readline, ""):
+            bufs[key].append(line)
+            seen[0] += len(line)
+            if on_line is not None and key == "out" and not tripped.is_set() and on_line(line):
+                tripped.set()
+        stream.close()
+
+    readers = [threading.Thread(target=_pump, args=(p.stdout, "out"), daemon=True),
+               threading.Thread(target=_pump, args=(p.stderr, "err"), daemon=True)]
+    for r in readers:
+        r.start()
+    t0 = last_prog = time.monotonic()
+    last_seen, last_cpu = 0, _proc_cpu_s(p.pid) or 0.0
+    peak_kb = 0
+    io = None
+    verdict = None
+    while True:
+        done, ru = _reap(p, 0.25 if on_line is not None else 1.0)
+        if done:
+            break
+        now = time.monotonic()
+        cpu = _proc_cpu_s(p.pid)
+        peak_kb = max(peak_kb, _proc_status_kb(p.pid, "VmHWM") or 0)
+        io = _proc_io(p.pid) or io
+        if seen[0] != last_seen or (cpu is not None and cpu - last_cpu >= STALL_MIN_CPU_S):
+            last_prog, last_seen = now, seen[0]
+            if cpu is not None:
+                last_cpu = cpu
+        if tripped.is_set():
+            verdict = "repetition"
+        elif timeout and now - t0 > timeout:
+            verdict = "deadline"
+        elif stall_s and now - last_prog > stall_s:
+            verdict = "stall"
+        if verdict:
+            p.kill()
+            _done, ru = _reap(p, None)
+            break
+    wall = time.monotonic() - t0
+    for r in readers:
+        r.join(timeout=5)
+    if ru is not None:
+        peak_kb = max(peak_kb, ru.ru_maxrss)
+        rec = {"tool": tag, "wall_s": round(wall, 3), "cpu_s": round(ru.ru_utime + ru.ru_stime, 3),
+               "threads": threads, "maxrss_mb": round(ru.ru_maxrss / 1024),
+               "minflt": ru.ru_minflt, "majflt": ru.ru_majflt, "nvcsw": ru.ru_nvcsw, "nivcsw": ru.ru_nivcsw,
+               # /proc/<pid>/io — последний замер при жизни; у коротких процессов — блоки из rusage
+               "read_mb": round(max((io or {}).get("read_bytes", 0), ru.ru_inblock * 512) / 1048576, 2),
+               "write_mb": round(max((io or {}).get("write_bytes", 0), ru.ru_oublock * 512) / 1048576, 2)}
+        if getattr(_RUN_STATS, "collecting", False):
+            _RUN_STATS.children.append(rec)
+        _M.inc("agent_child_cpu_seconds_total", rec["cpu_s"], tool=tag)
+        _M.inc("agent_child_major_faults_total", rec["majflt"], tool=tag)
+        _M.inc("agent_child_context_switches_total", rec["nivcsw"], tool=tag, kind="involuntary")
+    if peak_kb:
+        prev = getattr(_RUN_STATS, "peak_rss_mb", None) or 0
+        _RUN_STATS.peak_rss_mb = max(prev, round(peak_kb / 1024))
+    out, err = "".join(bufs["out"]), "".join(bufs["err"])
+    if verdict:
+        _M.inc("agent_subprocess_killed_total", tool=tag, reason=verdict)
+        log(f"WATCH: {tag} pid={p.pid} killed ({verdict}) after {int(time.monotonic() - t0)} s, cpu={last_cpu:.1f} s")
+        rc = {"deadline": RC_DEADLINE, "stall": RC_STALL, "repetition": RC_REPEAT}[verdict]
+        return rc, out, (err or "") + f" {verdict.upper()}"
     return p.returncode, out, err
 
-def ensure_cache_quota():
-    total = 0
-    files = []
-    for p in CACHE_DIR.glob("**/*"):
-        if p.is_file():
-            s = p.stat().st_size
-            total += s
-            files.append((p, s, p.stat().st_mtime))
-    if total/1024/1024 <= MAX_CACHE_MB:
-        return
-    files.sort(key=lambda x: x[2])  # старые сначала
-    while total/1024/1024 > MAX_CACHE_MB and files:
-        p, s, _ = files.pop(0)
+# ================== дедлайны по длительности ==================
+RTF_FILE = BASE_DIR / "rtf.json"
+
+class RtfTracker:
+    """EWMA real-time factor (сек обработки на сек аудио) по ключу модель+потоки; хранится в RTF_FILE."""
+
+    def __init__(self, path: Path, alpha=0.3):
+        self.path = path
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.data = None
+
+    @staticmethod
+    def key(model=None, threads=None, profile="") -> str:
+        return f"{os.path.basename(model or MODEL_PATH)}|t{threads or THREADS}" + (f"|{profile}" if profile else "")
+
+    def _load(self):
+        if self.data is None:
+            try:
+                self.data = json.loads(self.path.read_text(encoding="utf-8"))
+            except Exception:
+                self.data = {}
+        return self.data
+
+    def rtf(self, key=None) -> float:
+        with self.lock:
+            v = self._load().get(key or self.key())
+        return v["rtf"] if v else RTF_DEFAULT
+
+    def update(self, audio_s: float, wall_s: float, key=None):
+        if audio_s < 5 or wall_s <= 0:
+            return
+        k = key or self.key()
+        with self.lock:
+            d = self._load()
+            cur = wall_s / audio_s
+            prev = d.get(k)
+            rtf = cur if prev is None else (1 - self.alpha) * prev["rtf"] + self.alpha * cur
+            d[k] = {"rtf": round(rtf, 4), "n": (prev or {}).get("n", 0) + 1}
+            try:
+                _atomic_write_json(self.path, d)
+            except Exception as e:
+                dbg("RTF: save failed", repr(e))
+
+    def deadline_s(self, audio_s: float, key=None) -> float:
+        if not audio_s or audio_s <= 0:
+            return float(TIMEOUT_S)
+        return min(DEADLINE_MAX_S, DEADLINE_BASE_S + audio_s * self.rtf(key) * DEADLINE_MULT)
+
+_RTF = RtfTracker(RTF_FILE)
+
+# ================== бюджет памяти ==================
+# Два whisper-cli по каналам — это две копии модели в RAM; на 8 ГБ устройствах LMK Android
+# убивает Termux посреди задачи. Перед распознаванием оцениваем пик одного процесса
+# (модель + буферы потоков + аудио; база модели уточняется по замеренному VmHWM) и сверяем
+# с MemAvailable − MEM_RESERVE_MB: параллельно, по очереди или по очереди на MEM_FALLBACK_MODEL.
+MEM_RESERVE_MB     = int(os.environ.get("MEM_RESERVE_MB", "700"))   # ОС, Termux, агент, всплески
+MEM_FALLBACK_MODEL = os.environ.get("MEM_FALLBACK_MODEL", "")
+MEM_PER_THREAD_MB  = 8
+MEM_PER_AUDIO_S_MB = 0.128   # s16 PCM + float32 сэмплы + mel, 16 кГц
+MEM_PROFILE_FILE   = BASE_DIR / "mem_profile.json"
+
+class MemoryBudget:
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.base = None   # модель -> замеренная база, МБ
+
+    def _load(self):
+        if self.base is None:
+            try:
+                self.base = json.loads(self.path.read_text(encoding="utf-8"))
+            except Exception:
+                self.base = {}
+        return self.base
+
+    def estimate_mb(self, model: str, threads: int, audio_s: float) -> int:
+        try:
+            size_mb = os.path.getsize(model) / 1048576
+        except OSError:
+            size_mb = 0
+        with self.lock:
+            learned = self._load().get(os.path.basename(model), 0)
+        base = max(size_mb * 1.1 + 80, learned)
+        return int(base + threads * MEM_PER_THREAD_MB + audio_s * MEM_PER_AUDIO_S_MB)
+
+    def observe(self, model: str, threads: int, audio_s: float, peak_mb):
+        """Замеренный пик → база модели (с перекосом вверх: недооценка дороже переоценки)."""
+        if not peak_mb:
+            return
+        base = max(0, peak_mb - threads * MEM_PER_THREAD_MB - audio_s * MEM_PER_AUDIO_S_MB)
+        key = os.path.basename(model)
+        with self.lock:
+            d = self._load()
+            prev = d.get(key)
+            d[key] = int(base if prev is None else max(base, 0.8 * prev + 0.2 * base))
+            try:
+                _atomic_write_json(self.path, d)
+            except Exception as e:
+                dbg("MEM: save failed", repr(e))
+
+    def plan(self, model: str, threads: int, audio_s: float) -> dict:
+        """{'mode': parallel|serial, 'model', 'est_mb', 'avail_mb'} для двух каналов."""
+        avail = _mem_available_bytes()
+        est = self.estimate_mb(model, threads, audio_s)
+        res = {"mode": "parallel", "model": model, "est_mb": est, "avail_mb": None}
+        if avail is None:
+            return res
+        budget = avail // 1048576 - MEM_RESERVE_MB
+        res["avail_mb"] = avail // 1048576
+        if 2 * est <= budget:
+            return res
+        res["mode"] = "serial"
+        if est > budget and MEM_FALLBACK_MODEL and os.path.exists(MEM_FALLBACK_MODEL) and MEM_FALLBACK_MODEL != model:
+            fb_est = self.estimate_mb(MEM_FALLBACK_MODEL, threads, audio_s)
+            if fb_est < est:
+                res.update(model=MEM_FALLBACK_MODEL, est_mb=fb_est)
+        if res["est_mb"] > budget:
+            log(f"MEM: over budget even serial: need ~{res['est_mb']} MB, have {budget} MB")
+        _M.inc("agent_mem_plans_total", mode=res["mode"], downshift=res["model"] != model)
+        return res
+
+_MEM = MemoryBudget(MEM_PROFILE_FILE)
+
+# ================== профили декодера ==================
+# Параметры декодера whisper (beam/best-of/audio-ctx/flash-attn/fallback) и число потоков,
+# подобранные командой `agent.py tune` на эталонных звонках: Парето-оптимальные точки
+# WER × RTF, именованные fast/balanced/accurate, по ключу устройство|модель.
+# Выбор: DECODER_PROFILE (env), control.set_config {"decoder_profile": ...}, job.decoder_profile.
+DECODER_PROFILES_FILE = BASE_DIR / "decoder_profiles.json"
+DECODER_PROFILE = os.environ.get("DECODER_PROFILE", "")   # "" — умолчания бинаря
+DECODER_PARAM_FLAGS = {"beam_size": "-bs", "best_of": "-bo", "audio_ctx": "-ac",
+                       "flash_attn": "-fa", "no_fallback": "-nf"}
+_DECODER_PROFILES = None
+
+_DEVICE_MODEL = None
+
+def decoder_profile_key(model=None) -> str:
+    global _DEVICE_MODEL
+    if _DEVICE_MODEL is None:
+        _DEVICE_MODEL = (_STATIC_FACTS or {}).get("device_model") or _probe_device_model() or "unknown"
+    return f"{_DEVICE_MODEL}|{os.path.basename(model or MODEL_PATH)}"
+
+def load_decoder_profiles(reload=False) -> dict:
+    global _DECODER_PROFILES
+    if _DECODER_PROFILES is None or reload:
+        try:
+            _DECODER_PROFILES = json.loads(DECODER_PROFILES_FILE.read_text(encoding="utf-8"))
+        except Exception:
+            _DECODER_PROFILES = {}
+    return _DECODER_PROFILES
+
+def decoder_profile(name: str, model=None):
+    """{'params': {...}, 'threads': N, 'wer':..., 'rtf':...} или None, если профиля нет."""
+    if not name:
+        return None
+    prof = (load_decoder_profiles().get(decoder_profile_key(model)) or {}).get("profiles", {}).get(name)
+    if prof is None and _throttle("decoder_profile:" + name, 600):
+        log("DECODER: no profile", repr(name), "for", decoder_profile_key(model), "→ binary defaults")
+    return prof
+
+def decoder_args(params: dict) -> list:
+    """Флаги whisper-cli для параметров; флаги, которых бинарь не знает (по -h), пропускаем."""
+    known = ((_STATIC_FACTS or {}).get("whisper") or {}).get("flags") or {}
+    args = []
+    for k, v in (params or {}).items():
+        flag = DECODER_PARAM_FLAGS.get(k)
+        if not flag or known.get(flag) is False or v is None or v is False:
+            continue
+        args += [flag] if v is True else [flag, str(v)]
+    return args
+
+def decoder_setup(profile=None):
+    """(threads, model, extra_args) с учётом профиля и режима питания."""
+    model = _POWER.model(MODEL_PATH)
+    prof = decoder_profile(profile, model) or {}
+    return _POWER.threads(prof.get("threads") or THREADS), model, decoder_args(prof.get("params"))
+
+_SEG_LINE_RE = re.compile(r"^\[(\d+):(\d+):(\d+)[.,](\d+)\s*-->\s*(\d+):(\d+):(\d+)[.,](\d+)\]\s*(.*)$")
+
+class RepetitionGuard:
+    """
+    Смотрит на сегменты из stdout whisper-cli ("[00:00:01.000 --> 00:00:03.000]  текст") и
+    срабатывает на петлю: REP_MAX_SAME одинаковых сегментов подряд, либо в окне из REP_WINDOW
+    сегментов доля повторных n-грамм ≥ REP_NGRAM_RATIO или степень сжатия zlib ≥ REP_COMPRESSION_RATIO.
+    Времена — абсолютные (offset_s — начало куска в исходном WAV).
+    """
+
+    def __init__(self, offset_s=0.0):
+        self.offset = offset_s
+        self.segs = []          # (start, end, text, norm, wall)
+        self.loop_start = None
+        self.last_end = offset_s
+        self.tripped_at = None
+
+    def feed(self, line: str) -> bool:
+        if self.loop_start is not None:
+            return True
+        m = _SEG_LINE_RE.match(line.strip())
+        if not m:
+            return False
+        g = [int(x) for x in m.groups()[:8]]
+        st = g[0] * 3600 + g[1] * 60 + g[2] + g[3] / 1000.0 + self.offset
+        en = g[4] * 3600 + g[5] * 60 + g[6] + g[7] / 1000.0 + self.offset
+        text = m.group(9).strip()
+        self.segs.append((st, en, text, _tune_norm(text), time.monotonic()))
+        self.last_end = max(self.last_end, en)
+        start = self._check()
+        if start is None:
+            return False
+        self.loop_start, self.tripped_at = start, time.monotonic()
+        return True
+
+    def _check(self):
+        import zlib
+        same = 1
+        for i in range(len(self.segs) - 1, 0, -1):
+            # короткие реплики («да», «алло») подряд — это речь, а не петля
+            if len(self.segs[i][3]) >= 10 and self.segs[i][3] == self.segs[i - 1][3]:
+                same += 1
+            else:
+                break
+        if same >= REP_MAX_SAME:
+            return self.segs[-same][0]
+        win = self.segs[-REP_WINDOW:]
+        text = " ".join(sg[3] for sg in win)
+        words = text.split()
+        if len(words) < REP_MIN_WORDS:
+            return None
+        grams = [tuple(words[i:i + REP_NGRAM]) for i in range(len(words) - REP_NGRAM + 1)]
+        rep_ratio = 1.0 - len(set(grams)) / len(grams)
+        raw = text.encode("utf-8")
+        comp_ratio = len(raw) / len(zlib.compress(raw))
+        if rep_ratio >= REP_NGRAM_RATIO or comp_ratio >= REP_COMPRESSION_RATIO:
+            # начало петли — первый сегмент окна, чей текст потом повторяется; иначе начало окна
+            for i, sg in enumerate(win):
+                if sg[3] and any(sg[3] == later[3] for later in win[i + 1:]):
+                    return sg[0]
+            return win[0][0]
+        return None
+
+    def kept(self):
+        """Сегменты до начала петли — в формате _whisper_json_segments."""
+        return [{"start": st, "end": en, "text": " " + text, "confidence": None}
+                for st, en, text, _n, _w in self.segs if self.loop_start is None or st < self.loop_start]
+
+    def wasted_s(self) -> float:
+        """Время декодирования, ушедшее на петлю (от первого её сегмента до kill)."""
+        walls = [w for st, _e, _t, _n, w in self.segs if self.loop_start is not None and st >= self.loop_start]
+        return round(self.tripped_at - walls[0], 2) if walls and self.tripped_at else 0.0
+
+def _wav_slice(src: Path, dst: Path, start_s: float) -> float:
+    """Хвост WAV начиная с start_s. Возвращает длительность хвоста, сек."""
+    import wave
+    with wave.open(str(src), "rb") as r:
+        rate = r.getframerate()
+        r.setpos(min(r.getnframes(), int(start_s * rate)))
+        frames = r.readframes(r.getnframes() - r.tell())
+        params = r.getparams()
+    with wave.open(str(dst), "wb") as w:
+        w.setparams(params)
+        w.writeframes(frames)
+    return len(frames) / float(params.sampwidth * params.nchannels * rate)
+
+def _supported_args(args, extra=None):
+    """args без флагов, которых бинарь не знает или которые уже заданы в extra (вместе с их значением)."""
+    known = ((_STATIC_FACTS or {}).get("whisper") or {}).get("flags") or {}
+    out = []
+    for a in args:
+        if a.startswith("-") and (known.get(a) is False or a in (extra or [])):
+            out.append(None)
+        elif not (out and out[-1] is None and not a.startswith("-")):
+            out.append(a)
+    return [a for a in out if a is not None]
+
+def _whisper_run_resumable(wav_path: Path, out_prefix: str, timeout, threads, model, extra, info, lang=None):
+    """
+    whisper_run_json с RepetitionGuard. При петле: сегменты до неё сохраняем, хвост с начала петли
+    распознаём заново с REP_RETRY_ARGS; повторная петля — хвост с её конца (петля пропускается).
+    После REP_RETRIES — оставляем то, что есть. Итог пишется в <out_prefix>.json.
+    """
+    if not REP_GUARD:
+        return whisper_run_json(wav_path, out_prefix, timeout=timeout, stall_s=STALL_S,
+                                threads=threads, model=model, extra=extra, lang=lang)
+    guard = RepetitionGuard()
+    rc, out, err = whisper_run_json(wav_path, out_prefix, timeout=timeout, stall_s=STALL_S,
+                                    threads=threads, model=model, extra=extra, on_line=guard.feed, lang=lang)
+    if rc != RC_REPEAT:
+        return rc, out, err
+    segs = []
+    retry_args = _supported_args(REP_RETRY_ARGS, extra)
+    tail_wav = wav_path.with_name(wav_path.stem + "_tail.wav")
+    tail_pref = out_prefix + "_tail"
+    t_start = time.monotonic()
+    try:
+        for attempt in range(REP_RETRIES + 1):
+            segs += guard.kept()
+            span = [round(guard.loop_start, 2), round(guard.last_end, 2)]
+            info.setdefault("repetition_spans", []).append(span)
+            info["repetition_wasted_s"] = round(info.get("repetition_wasted_s", 0.0) + guard.wasted_s(), 2)
+            _M.inc("agent_whisper_repetition_total")
+            log(f"REPEAT: loop in {wav_path.name} at {span[0]}–{span[1]} s, attempt {attempt + 1}")
+            if attempt == REP_RETRIES:
+                rc = 0  # частичный результат лучше, чем никакого
+                break
+            # первая петля — перерасшифровать с её начала; повторная — перепрыгнуть её
+            resume = guard.loop_start if attempt == 0 else guard.last_end
+            if _wav_slice(wav_path, tail_wav, resume) < 1.0:
+                rc = 0
+                break
+            guard = RepetitionGuard(offset_s=resume)
+            left = max(30.0, timeout - (time.monotonic() - t_start)) if timeout else None
+            rc, out, err = whisper_run_json(tail_wav, tail_pref, timeout=left, stall_s=STALL_S, threads=threads,
+                                            model=model, extra=list(extra or []) + retry_args, on_line=guard.feed,
+                                            lang=lang)
+            if rc == 0:
+                segs += [dict(sg, start=sg["start"] + resume, end=sg["end"] + resume)
+                         for sg in _whisper_json_segments(Path(tail_pref + ".json"))]
+                break
+            if rc != RC_REPEAT:
+                return rc, out, err
+    finally:
+        cleanup_files(tail_wav, Path(tail_pref + ".json"))
+    _write_segments_json(Path(out_prefix + ".json"), segs)
+    return rc, out, err
+
+def whisper_run_guarded(wav_path: Path, out_prefix: str, deadline_s: float, profile=None, model=None, lang=None,
+                        extra_args=None):
+    """
+    whisper_run_json под наблюдением. При зависании — повтор с вдвое меньшим числом потоков,
+    затем (если задан STALL_FALLBACK_MODEL) — на модели поменьше.
+    Возвращает (rc, out, err, info); info: attempts, killed (deadline/stall/None), threads, model, peak_rss_mb,
+    usage — учёт всех запущенных whisper-cli (повторы и дорасшифровки включительно).
+    model — принудительная модель (бюджет памяти), lang — язык распознавания (иначе LANG_HINT),
+    extra_args — флаги поверх профиля для всех попыток (батч: BATCH_WHISPER_ARGS).
+    """
+    threads, _model, extra = decoder_setup(profile)
+    model = model or _model
+    plan = [(threads, model), (max(1, threads // 2), model)]
+    if STALL_FALLBACK_MODEL and os.path.exists(STALL_FALLBACK_MODEL):
+        plan.append((max(1, threads // 2), STALL_FALLBACK_MODEL))
+    info = {"attempts": 0, "killed": None}
+    _begin_run_usage()
+    _last_run_peak_mb()
+    try:
+        for threads, model in plan:
+            info["attempts"] += 1
+            info["threads"], info["model"] = threads, os.path.basename(model)
+            # меньше потоков — медленнее: дедлайн растёт пропорционально (не больше чем вдвое)
+            dl = min(DEADLINE_MAX_S, deadline_s * min(2.0, plan[0][0] / threads))
+            args = list(extra or []) if model == plan[0][1] else []
+            args += _supported_args(extra_args or [], args)
+            rc, out, err = _whisper_run_resumable(wav_path, out_prefix, dl, threads, model, args or None, info, lang)
+            info["peak_rss_mb"] = max(info.get("peak_rss_mb") or 0, _last_run_peak_mb() or 0) or None
+            info["killed"] = {RC_DEADLINE: "deadline", RC_STALL: "stall"}.get(rc)
+            if rc != RC_STALL:
+                break
+            log(f"WATCH: whisper stalled on {wav_path.name}, retry", info["attempts"], "of", len(plan) - 1)
+    finally:
+        info["usage"] = _take_run_usage()
+    return rc, out, err, info
+
+# ================== чанки длинных звонков ==================
+# Диспетчер может раздать длинный звонок по кускам: input.range = {start_s, end_s, overlap_s}.
+# Воркер декодирует окно [start_s − overlap_s, end_s + overlap_s], сегменты возвращает с абсолютным
+# временем; сегменты, чья середина вне [start_s, end_s), помечены overlap=true. Склейка —
+# merge_chunk_results (и `agent.py merge` для локальной проверки).
+CHUNK_EDGE_S = 0.3  # сегмент ближе к краю окна — вероятно обрезан
+
+def chunk_window(rng):
+    """input.range → {start_s, end_s, overlap_s, window: [от, до], window_s} или None (целый файл)."""
+    if not isinstance(rng, dict) or rng.get("start_s") is None:
+        return None
+    start = max(0.0, float(rng["start_s"]))
+    end = float(rng["end_s"]) if rng.get("end_s") is not None else None
+    ov = max(0.0, float(rng.get("overlap_s") or 0))
+    w0 = max(0.0, start - ov)
+    w1 = end + ov if end is not None else None
+    return dict(rng, start_s=start, end_s=end, overlap_s=ov, window=[w0, w1],
+                window_s=(w1 - w0) if w1 is not None else None)
+
+def chunk_segments(segments, rng: dict):
+    """Сдвиг сегментов окна в абсолютное время + пометка overlap для середины вне [start_s, end_s)."""
+    off, start, end = rng["window"][0], rng["start_s"], rng["end_s"]
+    out = []
+    for s in segments:
+        s = dict(s)
+        for k in ("start", "end"):
+            if s.get(k) is not None:
+                s[k] = round(s[k] + off, 3)
+        mid = ((s.get("start") or 0) + (s.get("end") or s.get("start") or 0)) / 2
+        if mid < start or (end is not None and mid >= end):
+            s["overlap"] = True
+        out.append(s)
+    return out
+
+def _segments_from_columnar(col):
+    if not col:
+        return []
+    out = []
+    for i, sp in enumerate(col["speaker"]):
+        s = {"speaker": col["speakers"][sp],
+             "text": col["text"][col["text_off"][i]:col["text_off"][i + 1]],
+             "start": None if col["start_ms"][i] is None else col["start_ms"][i] / 1000.0,
+             "end": None if col["end_ms"][i] is None else col["end_ms"][i] / 1000.0}
+        if col.get("confidence") and col["confidence"][i] is not None:
+            s["confidence"] = col["confidence"][i]
+        out.append(s)
+    return out
+
+def _seg_dup(a: dict, b: dict) -> bool:
+    """Одна и та же реплика из двух соседних окон: тот же speaker, время и слова в основном совпадают."""
+    if a["speaker"] != b["speaker"] or a.get("start") is None or b.get("start") is None:
+        return False
+    a1, b1 = a.get("end") or a["start"], b.get("end") or b["start"]
+    inter = min(a1, b1) - max(a["start"], b["start"])
+    if inter < 0.5 * max(0.05, min(a1 - a["start"], b1 - b["start"])):
+        return False
+    wa, wb = _tune_norm(a["text"]).split(), _tune_norm(b["text"]).split()
+    if not wa or not wb:
+        return False
+    common = sum(min(wa.count(w), wb.count(w)) for w in set(wa))
+    return common >= 0.6 * min(len(wa), len(wb))
+
+def merge_chunk_results(results, max_gap_s: float = 0.6) -> dict:
+    """
+    Детерминированная склейка job.result кусков одного звонка (json или columnar-v1).
+    Дубликаты на стыке соседних кусков (_seg_dup) решаются в пользу версии, дальше отстоящей
+    от края своего окна (больше контекста); непарные сегменты перекрытия, прижатые к краю
+    окна (обрезки), отбрасываются. Возвращает {"text", "segments", "chunks", "duplicates", "edge_cut"}.
+    """
+    chunks = []
+    for r in results:
+        meta = r.get("meta") or {}
+        rng = chunk_window(meta.get("range")) or {"start_s": 0.0, "end_s": None, "window": [0.0, None]}
+        win = list((meta.get("range") or {}).get("window") or rng["window"])
+        segs = meta.get("segments") or _segments_from_columnar(meta.get("segments_columnar"))
+        segs = [dict(s) for s in segs if (s.get("text") or "").strip()]
+        segs.sort(key=lambda s: (s.get("start") or 0, s.get("end") or 0, str(s.get("speaker")), s["text"]))
+        chunks.append({"start": rng["start_s"], "end": rng["end_s"], "window": win, "segs": segs,
+                       "drop": set()})
+    chunks.sort(key=lambda c: (c["start"], c["end"] if c["end"] is not None else float("inf")))
+
+    def room(c, s, side):
+        """Расстояние сегмента до края окна куска со стороны стыка."""
+        if side == "right":
+            return (c["window"][1] if c["window"][1] is not None else float("inf")) - (s.get("end") or s["start"])
+        return s["start"] - c["window"][0]
+
+    dups = cut = 0
+    for left, right in zip(chunks, chunks[1:]):
+        lo = right["window"][0]
+        hi = left["window"][1] if left["window"][1] is not None else float("inf")
+        la = [i for i, s in enumerate(left["segs"]) if (s.get("end") or s["start"] or 0) > lo]
+        rb = [j for j, s in enumerate(right["segs"]) if (s.get("start") or 0) < hi]
+        taken = set()
+        for i in la:
+            a = left["segs"][i]
+            for j in rb:
+                if j in taken or not _seg_dup(a, right["segs"][j]):
+                    continue
+                taken.add(j)
+                dups += 1
+                if room(left, a, "right") >= room(right, right["segs"][j], "left"):
+                    right["drop"].add(j)
+                else:
+                    left["drop"].add(i)
+                break
+            else:
+                if a.get("overlap") and room(left, a, "right") < CHUNK_EDGE_S:
+                    left["drop"].add(i)
+                    cut += 1
+        for j in rb:
+            b = right["segs"][j]
+            if j not in taken and b.get("overlap") and room(right, b, "left") < CHUNK_EDGE_S:
+                right["drop"].add(j)
+                cut += 1
+    kept = []
+    for c in chunks:
+        for i, s in enumerate(c["segs"]):
+            if i not in c["drop"]:
+                s.pop("overlap", None)
+                kept.append(s)
+    kept.sort(key=lambda s: (s.get("start") or 0, s.get("end") or 0, str(s.get("speaker")), s["text"]))
+    speakers = sorted({s["speaker"] for s in kept}, key=str)
+    segments = _build_segments([(sp, [s for s in kept if s["speaker"] == sp]) for sp in speakers],
+                               max_gap_s=max_gap_s)
+    return {"text": " ".join(s["text"] for s in segments).strip(), "segments": segments,
+            "chunks": len(chunks), "duplicates": dups, "edge_cut": cut}
+
+# ================== определение языка ==================
+# Короткое окно речи (по энергии) с каждого канала → один процесс whisper-cli с -l auto -dl
+# на оба окна (модель грузится один раз). Язык кэшируется по ключу источника (телефон, очередь,
+# каталог input.file) и явно передаётся в основное распознавание; итог — в meta.lang.
+LANG_PROBE          = os.environ.get("LANG_PROBE", "1") == "1"
+LANG_PROBE_WINDOW_S = float(os.environ.get("LANG_PROBE_WINDOW_S", "8"))
+LANG_PROBE_ALLOWED  = [x for x in os.environ.get("LANG_PROBE_ALLOWED", "ru,kk,en").split(",") if x]
+LANG_PROBE_MIN_P    = float(os.environ.get("LANG_PROBE_MIN_P", "0.6"))
+LANG_PROBE_SCAN_S   = float(os.environ.get("LANG_PROBE_SCAN_S", "180"))  # речь ищем только в начале записи
+LANG_CACHE_TTL_S    = float(os.environ.get("LANG_CACHE_TTL_S", str(7 * 86400)))
+LANG_CACHE_MAX      = int(os.environ.get("LANG_CACHE_MAX", "5000"))
+LANG_CACHE_FILE     = BASE_DIR / "lang_cache.json"
+_LANG_DETECT_RE = re.compile(r"auto-detected language:\s*([a-z]{2,3})\s*\(p\s*=\s*([0-9.]+)\)")
+
+try:
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop as _audioop  # убран в Python 3.13
+except Exception:
+    _audioop = None
+
+def _block_rms(raw: bytes) -> float:
+    """RMS блока s16le: audioop, иначе NumPy, иначе чистый Python."""
+    if _audioop is not None:
+        return float(_audioop.rms(raw, 2))
+    if _np is not None:
+        a = _np.frombuffer(raw, dtype="<i2").astype(_np.float64)
+        return float(_np.sqrt((a * a).mean())) if a.size else 0.0
+    import array, math
+    a = array.array("h", raw)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return math.sqrt(sum(x * x for x in a) / len(a)) if a else 0.0
+
+def _speech_window(src: Path, dst: Path, win_s: float) -> float:
+    """
+    Собрать в dst первые win_s секунд «речи» из первых LANG_PROBE_SCAN_S секунд src (блоки по 0.5 с
+    с RMS выше порога: max(300, 3× шумового пола)). Возвращает длительность окна, 0 — речи не нашлось.
+    В памяти — только RMS блоков; выбранные блоки дочитываются вторым проходом.
+    """
+    import wave
+    with wave.open(str(src), "rb") as r:
+        params = r.getparams()
+        if params.sampwidth != 2 or params.nchannels != 1:
+            return 0.0
+        block = int(params.framerate * 0.5)
+        max_blocks = max(1, int(LANG_PROBE_SCAN_S / 0.5))
+        levels = []
+        while len(levels) < max_blocks:
+            raw = r.readframes(block)
+            if not raw:
+                break
+            levels.append(_block_rms(raw))
+        if not levels:
+            return 0.0
+        rms = sorted(levels)
+        thr = max(300.0, 3 * rms[len(rms) // 5])  # шумовой пол — 20-й перцентиль: речь в звонке занимает большую часть
+        need = int(win_s / 0.5)
+        picked = [i for i, level in enumerate(levels) if level >= thr][:need]
+        if len(picked) < 2:
+            return 0.0
+        with wave.open(str(dst), "wb") as w:
+            w.setparams(params)
+            for i in picked:
+                r.setpos(i * block)
+                w.writeframes(r.readframes(block))
+    return len(picked) * 0.5
+
+def whisper_detect_languages(wavs, threads=None, model=None, timeout=120):
+    """[(lang, p) | None] по каждому WAV: один процесс whisper-cli, -l auto -dl, несколько -f."""
+    exe = _whisper_exe()
+    if not exe or not wavs:
+        return [None] * len(wavs)
+    cmd = [exe, "-m", str(model or MODEL_PATH), "-l", "auto", "-dl", "-t", str(threads or THREADS)]
+    for w in wavs:
+        cmd += ["-f", str(w)]
+    rc, out, err = run(cmd, timeout=timeout, log_cmd=True, stall_s=STALL_S, threads=threads or THREADS)
+    found = [(m.group(1), float(m.group(2))) for m in _LANG_DETECT_RE.finditer((err or "") + (out or ""))]
+    if rc != 0 and not found:
+        log("LANG: detect failed rc=", rc, (err or "")[-300:])
+    return (found + [None] * len(wavs))[:len(wavs)]
+
+class LangCache:
+    """LRU-кэш язык-по-источнику с TTL; хранится в LANG_CACHE_FILE."""
+
+    def __init__(self, path: Path):
+        from collections import OrderedDict
+        self.path = path
+        self.items = None          # key -> {"left": lang, "right": lang, "ts": ...}
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        self._od = OrderedDict
+
+    def _load(self):
+        if self.items is None:
+            try:
+                self.items = self._od(json.loads(self.path.read_text(encoding="utf-8")))
+            except Exception:
+                self.items = self._od()
+        return self.items
+
+    def get(self, key):
+        with self.lock:
+            items = self._load()
+            v = items.get(key)
+            if v is not None and time.time() - v.get("ts", 0) > LANG_CACHE_TTL_S:
+                items.pop(key, None)
+                v = None
+            if v is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                items.move_to_end(key)
+        _M.inc("agent_lang_cache_total", result="hit" if v else "miss")
+        return v
+
+    def put(self, key, value: dict):
+        with self.lock:
+            items = self._load()
+            items[key] = dict(value, ts=int(time.time()))
+            items.move_to_end(key)
+            while len(items) > LANG_CACHE_MAX:
+                items.popitem(last=False)
+            try:
+                _atomic_write_json(self.path, items)
+            except Exception as e:
+                dbg("LANG: cache save failed", repr(e))
+
+    def snapshot(self) -> dict:
+        n = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.items or {}),
+                "hit_rate": round(self.hits / n, 3) if n else None}
+
+_LANG_CACHE = LangCache(LANG_CACHE_FILE)
+
+def lang_source_key(job: dict):
+    """Ключ источника для кэша языка: job.source_key → input.phone/queue → каталог input.file."""
+    j_input = job.get("input") if isinstance(job.get("input"), dict) else {}
+    for k in (job.get("source_key"), j_input.get("phone"), j_input.get("queue")):
+        if k:
+            return str(k)
+    f = j_input.get("file") or j_input.get("local_path")
+    if f:
+        return "dir:" + os.path.dirname(str(f))
+    return None
+
+def known_languages(job: dict, default: str):
+    """Язык без распознавания: явный job.lang/input.lang, кэш источника или default, если проба выключена."""
+    j_input = job.get("input") if isinstance(job.get("input"), dict) else {}
+    explicit = job.get("lang") or j_input.get("lang")
+    if explicit:
+        return {"left": explicit, "right": explicit, "source": "job"}
+    known = ((_STATIC_FACTS or {}).get("whisper") or {}).get("flags") or {}
+    if not LANG_PROBE or known.get("-dl") is False:
+        return {"left": default, "right": default, "source": "default"}
+    key = lang_source_key(job)
+    cached = _LANG_CACHE.get(key) if key else None
+    if cached:
+        return {"left": cached["left"], "right": cached["right"], "source": "cache"}
+    return None
+
+def probe_languages(job: dict, left_wav: Path, right_wav: Path, scratch, default: str, threads=None, model=None):
+    """
+    Проба языка по окну речи каждого канала (блокирующая — через executor).
+    Языки не из LANG_PROBE_ALLOWED и неуверенные (p < LANG_PROBE_MIN_P) заменяются default.
+    """
+    t0 = time.time()
+    wins, sides = [], []
+    for side, wav in (("left", left_wav), ("right", right_wav)):
+        if wav is None:
+            continue
+        dst = scratch.path("lang", f"_lang_{side}.wav", int(LANG_PROBE_WINDOW_S * 32000))
+        if _speech_window(wav, dst, LANG_PROBE_WINDOW_S) > 0:
+            wins.append(dst)
+            sides.append(side)
+        else:
+            scratch.release(dst)
+    res = {"left": default, "right": default, "source": "probe", "p": {}}
+    for side, det in zip(sides, whisper_detect_languages(wins, threads=threads, model=model)):
+        if det is None:
+            continue
+        lang, p = det
+        res["p"][side] = round(p, 3)
+        if lang in LANG_PROBE_ALLOWED and p >= LANG_PROBE_MIN_P:
+            res[side] = lang
+        else:
+            dbg("LANG: rejected", side, lang, p)
+    for w in wins:
+        scratch.release(w)
+    res["probe_ms"] = int((time.time() - t0) * 1000)
+    key = lang_source_key(job)
+    if key and res["p"]:
+        _LANG_CACHE.put(key, {"left": res["left"], "right": res["right"]})
+    return res
+
+# ================== индекс кэша ==================
+# Размер/LRU кэша держим в памяти и в маленьком файле CACHE_DIR/.index.json.
+# Полный обход CACHE_DIR — только при старте (если индекса нет или он битый),
+# дальше файлы регистрируются/снимаются по месту создания/удаления.
+CACHE_INDEX_FILE = CACHE_DIR / ".index.json"
+
+class CacheIndex:
+    def __init__(self, root: Path, index_file: Path):
+        from collections import OrderedDict
+        self.root = root
+        self.index_file = index_file
+        self.files = OrderedDict()  # относительный путь -> размер; порядок = LRU (старые сначала)
+        self.total = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def _key(self, p) -> str:
+        p = Path(p)
+        try:
+            return str(p.relative_to(self.root))
+        except ValueError:
+            return str(p)
+
+    def load(self) -> str:
+        """Поднять индекс из файла; при отсутствии/порче — один полный обход. Возвращает источник."""
+        try:
+            data = json.loads(self.index_file.read_text(encoding="utf-8"))
+            if data.get("v") != 1:
+                raise ValueError("index version")
+            with self.lock:
+                self.files.clear()
+                for name, size in data.get("files", []):
+                    self.files[name] = int(size)
+                self.total = sum(self.files.values())
+                self.dirty = False
+            return "file"
+        except Exception:
+            self.rebuild()
+            return "walk"
+
+    def rebuild(self):
+        found = []
+        for p in self.root.glob("**/*"):
+            if p == self.index_file or not p.is_file():
+                continue
+            try:
+                st = p.stat()
+            except Exception:
+                continue
+            found.append((st.st_mtime, self._key(p), st.st_size))
+        found.sort()
+        with self.lock:
+            self.files.clear()
+            for _mt, name, size in found:
+                self.files[name] = size
+            self.total = sum(self.files.values())
+            self.dirty = True
+        self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {"v": 1, "files": [[k, v] for k, v in self.files.items()]}
+            self.dirty = False
         try:
-            p.unlink()
-            total -= s
-            log("CACHE: removed", p)
+            _atomic_write_json(self.index_file, data)
         except Exception as e:
-            log("CACHE: rm error", p, e)
+            log("CACHE: index save error", e)
+
+    def register(self, *paths):
+        for p in paths:
+            try:
+                size = Path(p).stat().st_size
+            except Exception:
+                continue
+            k = self._key(p)
+            with self.lock:
+                self.total += size - self.files.pop(k, 0)
+                self.files[k] = size
+                self.dirty = True
+
+    def touch(self, p):
+        k = self._key(p)
+        with self.lock:
+            if k in self.files:
+                self.files.move_to_end(k)
+                self.dirty = True
+
+    def unregister(self, *paths):
+        for p in paths:
+            k = self._key(p)
+            with self.lock:
+                if k in self.files:
+                    self.total -= self.files.pop(k)
+                    self.dirty = True
+
+    def over_quota(self) -> bool:
+        return self.total > MAX_CACHE_MB * 1024 * 1024
+
+    def evict(self):
+        """Удаляет самые старые файлы, пока не уложимся в MAX_CACHE_MB. O(число удалённых)."""
+        limit = MAX_CACHE_MB * 1024 * 1024
+        removed = 0
+        while True:
+            with self.lock:
+                if self.total <= limit or not self.files:
+                    break
+                name, size = self.files.popitem(last=False)
+                self.total -= size
+                self.dirty = True
+            p = self.root / name
+            try:
+                p.unlink()
+                removed += 1
+                log("CACHE: removed", p)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                log("CACHE: rm error", p, e)
+        self.save()
+        return removed
+
+_CACHE_INDEX = CacheIndex(CACHE_DIR, CACHE_INDEX_FILE)
+
+def ensure_cache_quota():
+    """Дёшево, если квота не превышена; иначе вытеснение по LRU-индексу."""
+    if _CACHE_INDEX.over_quota():
+        _CACHE_INDEX.evict()
+    else:
+        _CACHE_INDEX.save()
+
+async def ensure_cache_quota_async():
+    if _CACHE_INDEX.over_quota() or _CACHE_INDEX.dirty:
+        await asyncio.get_running_loop().run_in_executor(None, ensure_cache_quota)
 
 def sha256_file(path: Path) -> str:
     h = hashlib.sha256()
@@ -167,6 +1402,13 @@ def sha256_file(path: Path) -> str:
             h.update(chunk)
     return h.hexdigest()
 
+def _atomic_write_json(path: Path, obj, indent=None):
+    """JSON во временный файл рядом и os.replace — читатель не увидит недописанный файл. Ошибки — наружу."""
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=indent), encoding="utf-8")
+    os.replace(tmp, path)
+
 def cleanup_files(*paths):
     for _p in paths:
         try:
@@ -175,6 +1417,317 @@ def cleanup_files(*paths):
         except Exception:
             pass
 
+# ================== scratch: быстрые промежуточные файлы ==================
+# mp3/wav задачи кладём в самое быстрое место, где они поместятся:
+# tmpfs (/dev/shm) → приватная память приложения ($TMPDIR, ~/.cache) → /sdcard/worker/cache.
+SCRATCH_DIRS          = os.environ.get("SCRATCH_DIRS", "")  # свои кандидаты через ':' (по приоритету)
+SCRATCH_MEM_RESERVE_MB = int(os.environ.get("SCRATCH_MEM_RESERVE_MB", "1536"))  # не трогать RAM-tier, если MemAvailable меньше
+SCRATCH_MP3_EST_MB    = int(os.environ.get("SCRATCH_MP3_EST_MB", "32"))   # оценка mp3 до скачивания
+SCRATCH_WAV_FACTOR    = float(os.environ.get("SCRATCH_WAV_FACTOR", "16"))  # wav(L+R, 16kHz s16) ≈ mp3 * factor
+
+def _mem_available_bytes():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    return None
+
+def _mount_fstype(path: Path) -> str:
+    """Тип ФС для пути по /proc/mounts (самая длинная точка монтирования)."""
+    best, fstype = "", ""
+    try:
+        p = str(path.resolve())
+        with open("/proc/mounts") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mnt = parts[1]
+                if (p == mnt or p.startswith(mnt.rstrip("/") + "/")) and len(mnt) > len(best):
+                    best, fstype = mnt, parts[2]
+    except Exception:
+        pass
+    return fstype
+
+class ScratchManager:
+    """Уровни scratch-хранилища с учётом занятых байт по каждому уровню."""
+
+    def __init__(self, tiers):
+        # tiers: [(name, Path, is_ram)] — по убыванию скорости; последний — запасной
+        self.tiers = []
+        for name, d, is_ram in tiers:
+            try:
+                d.mkdir(parents=True, exist_ok=True)
+                if os.access(str(d), os.W_OK):
+                    self.tiers.append((name, d, is_ram))
+            except Exception:
+                pass
+        self.bytes_by_tier = {name: 0 for name, _d, _r in self.tiers}
+        self.lock = threading.Lock()  # резервы меняют и loop, и executor (probe_languages, батч)
+
+    @classmethod
+    def default(cls):
+        tiers = []
+        if SCRATCH_DIRS:
+            for i, raw in enumerate(x for x in SCRATCH_DIRS.split(":") if x):
+                d = Path(raw)
+                tiers.append((f"dir{i}", d, _mount_fstype(d) in ("tmpfs", "ramfs")))
+        else:
+            tiers.append(("shm", Path("/dev/shm") / "worker", True))
+            tmp = os.environ.get("TMPDIR")
+            if tmp:
+                tiers.append(("tmp", Path(tmp) / "worker", _mount_fstype(Path(tmp)) in ("tmpfs", "ramfs")))
+            tiers.append(("private", Path.home() / ".cache" / "worker_scratch", False))
+        tiers.append(("sdcard", CACHE_DIR, False))
+        return cls(tiers)
+
+    def _fits(self, name: str, d: Path, is_ram: bool, projected: int) -> bool:
+        # зарезервированные, но ещё не записанные байты других задач уже обещаны этому уровню
+        reserved = self.bytes_by_tier.get(name, 0)
+        try:
+            st = os.statvfs(str(d))
+            if st.f_bavail * st.f_frsize - reserved < projected * 1.1:
+                return False
+        except Exception:
+            return False
+        if is_ram:
+            avail = _mem_available_bytes()
+            if avail is None or avail - reserved - projected < SCRATCH_MEM_RESERVE_MB * 1024 * 1024:
+                return False
+        return True
+
+    def pick(self, projected: int):
+        """Первый уровень, куда влезает projected байт; иначе последний (sdcard)."""
+        for name, d, is_ram in self.tiers[:-1]:
+            if self._fits(name, d, is_ram, projected):
+                return name, d
+        name, d, _r = self.tiers[-1]
+        return name, d
+
+    def reserve(self, projected: int):
+        """pick + резерв projected байт одним шагом под lock: два потока не займут одно и то же место."""
+        with self.lock:
+            name, d = self.pick(projected)
+            self.bytes_by_tier[name] = self.bytes_by_tier.get(name, 0) + projected
+        return name, d
+
+    def unreserve(self, tier: str, projected: int):
+        with self.lock:
+            self.bytes_by_tier[tier] = max(0, self.bytes_by_tier.get(tier, 0) - projected)
+
+    def job(self, job_id: str):
+        return JobScratch(self, job_id)
+
+    def snapshot(self):
+        with self.lock:
+            return {"tiers": [n for n, _d, _r in self.tiers], "bytes": dict(self.bytes_by_tier)}
+
+class JobScratch:
+    """Контекст задачи: выдаёт пути под промежуточные файлы и удаляет их на выходе."""
+
+    def __init__(self, mgr: ScratchManager, job_id: str):
+        self.mgr = mgr
+        self.job_id = job_id
+        self.files = {}   # Path -> (tier, reserved_bytes)
+        self.used = {}    # логическое имя -> tier
+
+    def path(self, name: str, suffix: str, projected: int = 0) -> Path:
+        tier, d = self.mgr.reserve(projected)
+        p = d / f"{self.job_id}{suffix}"
+        self.files[p] = (tier, projected)
+        self.used[name] = tier
+        return p
+
+    def release(self, p: Path):
+        tier, reserved = self.files.pop(p, (None, 0))
+        cleanup_files(p)
+        _CACHE_INDEX.unregister(p)
+        if tier is not None:
+            self.mgr.unreserve(tier, reserved)
+
+    def report(self):
+        return dict(self.used)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for p in list(self.files):
+            self.release(p)
+        return False
+
+_SCRATCH = ScratchManager.default()
+
+
+def _read_temp_c():
+    try:
+        for cand in [
+            "/sys/class/thermal/thermal_zone0/temp",
+            "/sys/class/thermal/thermal_zone1/temp",
+            "/sys/devices/virtual/thermal/thermal_zone0/temp",
+        ]:
+            if os.path.exists(cand):
+                with open(cand) as f:
+                    t = f.read().strip()
+                if t.replace(".","",1).isdigit():
+                    return float(t)/1000.0 if len(t) > 3 else float(t)
+    except Exception:
+        pass
+    return None
+
+def _thermal_band(temp_c):
+    """0 — норма, 1 — тёплый (≥68°C), 2 — горячий (≥75°C); пороги как в adjust_threads_by_temp."""
+    if temp_c is None or temp_c < 68:
+        return 0
+    return 1 if temp_c < 75 else 2
+
+# ================== питание: батарея и зарядка ==================
+# Читаем /sys/class/power_supply/* (POWER_SUPPLY_DIR можно направить на каталог с файлами-заглушками
+# той же структуры: <name>/type, capacity, status, temp, online). Режимы:
+#   full   — на зарядке (или батареи нет): как раньше;
+#   reduced — на батарее либо батарея тёплая: вдвое меньше потоков, POWER_REDUCED_MODEL (если задан),
+#             без параллельного батчинга, звонки длиннее POWER_REDUCED_MAX_AUDIO_S не берём;
+#   drain  — мало заряда или батарея горячая: текущую задачу доделываем, новые не принимаем.
+POWER_SUPPLY_DIR          = os.environ.get("POWER_SUPPLY_DIR", "/sys/class/power_supply")
+POWER_POLL_S              = float(os.environ.get("POWER_POLL_S", "30"))
+POWER_DRAIN_PCT           = int(os.environ.get("POWER_DRAIN_PCT", "30"))   # ниже — drain (на батарее)
+POWER_HYST_PCT            = int(os.environ.get("POWER_HYST_PCT", "5"))
+POWER_WARM_C              = float(os.environ.get("POWER_WARM_C", "40"))    # батарея: ≥ — reduced
+POWER_HOT_C               = float(os.environ.get("POWER_HOT_C", "45"))     # батарея: ≥ — drain
+POWER_REDUCED_MODEL       = os.environ.get("POWER_REDUCED_MODEL", "")
+POWER_REDUCED_MAX_AUDIO_S = float(os.environ.get("POWER_REDUCED_MAX_AUDIO_S", "600"))
+POWER_MODES = ("full", "reduced", "drain")
+
+def read_power_supply(root=POWER_SUPPLY_DIR) -> dict:
+    """Сводка по power_supply: battery_pct, status, batt_temp_c, current_ma, plugged (None — не удалось прочитать)."""
+    def _rd(d, name):
+        try:
+            return (d / name).read_text().strip()
+        except Exception:
+            return None
+    st = {"battery_pct": None, "status": None, "batt_temp_c": None, "current_ma": None, "plugged": None}
+    try:
+        entries = sorted(Path(root).iterdir())
+    except Exception:
+        return st
+    for d in entries:
+        typ = (_rd(d, "type") or "").lower()
+        if typ == "battery" and st["battery_pct"] is None:
+            cap, temp, cur = _rd(d, "capacity"), _rd(d, "temp"), _rd(d, "current_now")
+            st["battery_pct"] = int(cap) if cap and cap.lstrip("-").isdigit() else None
+            st["status"] = _rd(d, "status")
+            st["batt_temp_c"] = int(temp) / 10.0 if temp and temp.lstrip("-").isdigit() else None  # десятые °C
+            st["current_ma"] = int(cur) // 1000 if cur and cur.lstrip("-").isdigit() else None     # мкА
+        elif typ in ("usb", "mains", "wireless", "ac", "usb_pd", "usb_dcp", "usb_cdp"):
+            if _rd(d, "online") == "1":
+                st["plugged"] = True
+            elif st["plugged"] is None:
+                st["plugged"] = False
+    if st["status"] in ("Charging", "Full"):
+        st["plugged"] = True
+    return st
+
+class PowerManager:
+    def __init__(self, root=POWER_SUPPLY_DIR):
+        self.root = root
+        self.state = {}
+        self.mode = "full"
+        self.since = time.time()
+        self.pct_per_job = None   # EWMA расхода заряда на задачу (на батарее), %
+        self._job_start = {}      # job_id -> battery_pct на старте (только на батарее)
+        self.task = None
+
+    def _decide(self, st) -> str:
+        pct, temp = st.get("battery_pct"), st.get("batt_temp_c")
+        if pct is None:
+            return "full"  # батареи не видно (эмулятор/стенд)
+        hot = temp is not None and temp >= POWER_HOT_C
+        warm = temp is not None and temp >= POWER_WARM_C
+        if hot:
+            return "drain"
+        if st.get("plugged"):
+            return "reduced" if warm else "full"
+        # на батарее: гистерезис вокруг POWER_DRAIN_PCT, чтобы не дёргаться на границе
+        low = POWER_DRAIN_PCT + (POWER_HYST_PCT if self.mode == "drain" else 0)
+        return "drain" if pct < low else "reduced"
+
+    def refresh(self) -> str:
+        """Блокирующее чтение sysfs — вызывать в executor. Возвращает новый режим."""
+        st = read_power_supply(self.root)
+        mode = self._decide(st)
+        self.state = st
+        if mode != self.mode:
+            log(f"POWER: {self.mode} → {mode}", st)
+            _M.inc("agent_power_mode_changes_total", mode=mode)
+            self.mode, self.since = mode, time.time()
+        _M.set("agent_power_mode", POWER_MODES.index(mode))
+        return mode
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            prev = self.mode
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except Exception as e:
+                log("POWER: refresh failed", repr(e))
+            if self.mode != prev:
+                _HB.kick("power")
+            await asyncio.sleep(POWER_POLL_S)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def accepts(self, audio_s=None) -> bool:
+        if self.mode == "drain":
+            return False
+        return not (self.mode == "reduced" and audio_s and audio_s > POWER_REDUCED_MAX_AUDIO_S)
+
+    def threads(self, threads: int) -> int:
+        return max(1, threads // 2) if self.mode != "full" else threads
+
+    def model(self, model: str) -> str:
+        if self.mode != "full" and POWER_REDUCED_MODEL and os.path.exists(POWER_REDUCED_MODEL):
+            return POWER_REDUCED_MODEL
+        return model
+
+    def job_started(self, job_id):
+        if not self.state.get("plugged") and self.state.get("battery_pct") is not None:
+            self._job_start[job_id] = self.state["battery_pct"]
+
+    def job_finished(self, job_id):
+        start = self._job_start.pop(job_id, None)
+        if start is None or self.state.get("plugged"):
+            return
+        try:
+            used = max(0, start - read_power_supply(self.root)["battery_pct"])
+        except Exception:
+            return
+        self.pct_per_job = used if self.pct_per_job is None else 0.7 * self.pct_per_job + 0.3 * used
+
+    def snapshot(self) -> dict:
+        st = self.state
+        jpc = None
+        if st.get("battery_pct") is not None and self.pct_per_job:
+            jpc = int(st["battery_pct"] / self.pct_per_job)
+        return {
+            "mode": self.mode,
+            "since": int(self.since),
+            "battery_pct": st.get("battery_pct"),
+            "plugged": st.get("plugged"),
+            "status": st.get("status"),
+            "batt_temp_c": st.get("batt_temp_c"),
+            "current_ma": st.get("current_ma"),
+            "jobs_per_charge": jpc,
+            "max_audio_s": {"full": None, "reduced": POWER_REDUCED_MAX_AUDIO_S, "drain": 0}[self.mode],
+        }
+
+_POWER = PowerManager()
 
 def get_metrics():
     """
@@ -244,21 +1797,7 @@ def get_metrics():
         pass
 
     # --- Температура ---
-    temp_c = None
-    try:
-        for cand in [
-            "/sys/class/thermal/thermal_zone0/temp",
-            "/sys/class/thermal/thermal_zone1/temp",
-            "/sys/devices/virtual/thermal/thermal_zone0/temp",
-        ]:
-            if os.path.exists(cand):
-                with open(cand) as f:
-                    t = f.read().strip()
-                if t.replace(".","",1).isdigit():
-                    temp_c = float(t)/1000.0 if len(t) > 3 else float(t)
-                    break
-    except Exception:
-        pass
+    temp_c = _read_temp_c()
 
     # --- Uptime ---
     uptime_s = None
@@ -284,6 +1823,14 @@ def get_metrics():
         "temp_c": temp_c,
         "uptime_s": uptime_s,
         "disk_free_mb": disk_free_mb,
+        "scratch_bytes": _SCRATCH.snapshot()["bytes"],
+        "http": _HTTP.snapshot() if _HTTP is not None else None,
+        # без самоотчётных рядов, меняющихся на каждом heartbeat (lag — в "loop")
+        "agent": _M.summary(skip=("agent_heartbeats_total", "agent_loop_lag_seconds")),
+        "loop": _LOOP_WD.snapshot(),
+        "power": _POWER.snapshot(),
+        "lang": _LANG_CACHE.snapshot(),
+        "prefetch": _PREFETCH.snapshot(),
     }
 
 
@@ -317,8 +1864,8 @@ def _cpu_percent_from_loadavg():
         THREADS = 8; log("THERMAL:", temp_c, "→ THREADS=8")
 
 def get_device_info():
-    # модель — фикс, если вся партия одинакова
-    model = "OPPO Find X2 Pro"
+    # модель — из getprop (кэш статических фактов), иначе фикс, если вся партия одинакова
+    model = (_STATIC_FACTS or {}).get("device_model") or "OPPO Find X2 Pro"
     try:
         cores = 0
         with open("/proc/cpuinfo") as f:
@@ -352,11 +1899,12 @@ def get_device_info():
     return {
         "model": model,
         "cpu_cores": int(cpu_cores),
+        "cpu_topology": (_STATIC_FACTS or {}).get("cpu_topology"),
         "ram_mb": int(ram_mb),
         "storage_total_mb": int(storage_total_mb)
     }
 
-def get_network_info():
+def get_network_info(ping=True):
     # ip через ip route
     ip = None
     try:
@@ -369,17 +1917,17 @@ def get_network_info():
     # rtt до хоста WS
     host = urlparse(SERVER_WS).hostname or "call-analysis-s6cb.onrender.com"
     rtt_ms = None
-    try:
-        rc, out, err = run(["ping","-c","1","-W","1", host], timeout=2)
-        m = re.search(r"time=([0-9.]+)\s*ms", out or "")
-        if m:
-            rtt_ms = float(m.group(1))
-    except Exception:
-        pass
+    if ping:  # без ping — быстрый вариант для регистрации, RTT придёт с heartbeat
+        try:
+            rc, out, err = run(["ping","-c","1","-W","1", host], timeout=2)
+            m = re.search(r"time=([0-9.]+)\s*ms", out or "")
+            if m:
+                rtt_ms = float(m.group(1))
+        except Exception:
+            pass
     return {"ip": ip or "0.0.0.0", "rtt_ms": rtt_ms or 0}
 
-def get_software_versions():
-    py = sys.version.split()[0]
+def _probe_ffmpeg_version():
     ff_ver = "installed"
     try:
         rc, out, err = run(["ffmpeg","-version"], timeout=5)
@@ -389,28 +1937,465 @@ def get_software_versions():
             ff_ver = m.group(1)
     except Exception:
         pass
-    return {"ffmpeg": ff_ver, "python": py}
+    return ff_ver
+
+def _probe_device_model():
+    try:
+        rc, out, err = run(["getprop","ro.product.model"], timeout=3)
+        return (out or "").strip() or None
+    except Exception:
+        return None
+
+def _probe_cpu_topology():
+    """Ядра, сгруппированные по максимальной частоте (big.LITTLE): [{"max_khz", "cpus"}]."""
+    groups = {}
+    for d in sorted(Path("/sys/devices/system/cpu").glob("cpu[0-9]*")):
+        try:
+            khz = int((d / "cpufreq" / "cpuinfo_max_freq").read_text().strip())
+        except Exception:
+            khz = 0
+        groups.setdefault(khz, []).append(int(d.name[3:]))
+    return [{"max_khz": k, "cpus": v} for k, v in sorted(groups.items(), reverse=True)]
+
+def _probe_whisper_caps():
+    """Какие флаги понимает whisper-бинарь (по -h)."""
+    exe = _whisper_exe()
+    if not exe:
+        return {"bin": None}
+    rc, out, err = run([exe, "-h"], timeout=10)
+    txt = (out or "") + (err or "")
+    flags = {f: (f in txt) for f in ("-ojf", "-fa", "-bs", "-bo", "-ac", "-nf", "-mc", "-ml", "-ot", "-d", "-dl")}
+    return {"bin": exe, "flags": flags}
+
+# Статические факты (версия ffmpeg, модель устройства, топология ядер, возможности whisper)
+# кэшируем на диске, ключ — mtime бинарей: после рестарта watchdog'ом их не надо пере-пробовать.
+STATIC_FACTS_FILE = BASE_DIR / "static_facts.json"
+_STATIC_FACTS = None
+
+def _static_facts_key():
+    import shutil
+    key = {"python": sys.version.split()[0]}
+    for name, path in (("ffmpeg", shutil.which("ffmpeg")), ("whisper", _whisper_exe())):
+        try:
+            key[name] = [path, int(os.stat(path).st_mtime)] if path else None
+        except Exception:
+            key[name] = None
+    return key
+
+async def load_static_facts():
+    """Факты из кэша по ключу mtime или параллельный перебор проб в executor'е."""
+    global _STATIC_FACTS
+    loop = asyncio.get_running_loop()
+    key = await loop.run_in_executor(None, _static_facts_key)
+    try:
+        cached = json.loads(STATIC_FACTS_FILE.read_text(encoding="utf-8"))
+        if cached.get("key") == key:
+            _STATIC_FACTS = cached["facts"]
+            return "cache"
+    except Exception:
+        pass
+    ff, model, topo, caps = await asyncio.gather(
+        loop.run_in_executor(None, _probe_ffmpeg_version),
+        loop.run_in_executor(None, _probe_device_model),
+        loop.run_in_executor(None, _probe_cpu_topology),
+        loop.run_in_executor(None, _probe_whisper_caps),
+    )
+    _STATIC_FACTS = {"ffmpeg": ff, "device_model": model, "cpu_topology": topo, "whisper": caps}
+    try:
+        STATIC_FACTS_FILE.write_text(json.dumps({"key": key, "facts": _STATIC_FACTS}), encoding="utf-8")
+    except Exception as e:
+        log("FACTS: save error", e)
+    return "probe"
+
+def get_software_versions():
+    py = sys.version.split()[0]
+    if _STATIC_FACTS is not None:
+        return {"ffmpeg": _STATIC_FACTS.get("ffmpeg") or "installed", "python": py}
+    return {"ffmpeg": _probe_ffmpeg_version(), "python": py}
 
 _env_logged = False
 def env_probe_once():
-    """Один раз при старте: базовые проверки без спама."""
+    """Один раз при старте: базовые проверки без спама (по уже собранным статическим фактам)."""
     global _env_logged
     if _env_logged:
         return
-    try:
-        rc, out, err = run(["getprop","ro.product.model"], timeout=3)
-        model = (out or "").strip()
-        if model:
-            log("Device:", model)
-    except Exception:
-        pass
+    facts = _STATIC_FACTS or {}
+    if facts.get("device_model"):
+        log("Device:", facts["device_model"])
     sw = get_software_versions()
     log("FFmpeg:", sw.get("ffmpeg","unknown"), "Python:", sw.get("python","?"))
-    net = get_network_info()
-    dbg("Initial net:", net)
     _env_logged = True
 
+# Разбивка времени старта (мс от запуска процесса) — логируется один раз после первого registration.ok
+_STARTUP_T = {}
+
+def _startup_mark(name):
+    _STARTUP_T.setdefault(name, int((time.time() - _AGENT_START_TS) * 1000))
+
+# ================== модель: проверка целостности и прогрев ==================
+# Эталон — внешний: MODEL_SHA256 или <MODEL_PATH>.sha256 (формат sha256sum, кладётся рядом при скачивании).
+# Без эталона модель не хэшируем и честно отвечаем verify="unverified" (ok=None): хэш файла, посчитанный
+# с него же, ничего не проверяет. Совпадение с эталоном кэшируется в <MODEL_PATH>.manifest.json
+# {"size","mtime","sha256"} — пересчёт только при смене файла или эталона. Полный хэш идёт в фоне
+# и registration не задерживает. Прогрев — последовательное чтение файла в page cache
+# (плюс POSIX_FADV_WILLNEED), чтобы первая задача не ждала флеш.
+MODEL_SHA256        = os.environ.get("MODEL_SHA256", "").strip().lower()  # опц: эталонный sha256
+MODEL_WARMUP        = os.environ.get("MODEL_WARMUP", "1") == "1"
+MODEL_WARMUP_WAIT_S = float(os.environ.get("MODEL_WARMUP_WAIT_S", "120"))  # сколько ждать прогрев до registration
+_MODEL_MAGICS = (b"lmgg", b"GGUF")  # ggml (0x67676d6c LE) / gguf
+_MODEL_STATE = {"ok": None, "error": None, "verify": None, "verify_ms": None, "warmup_ms": None}
+_MODEL_TASK = None
+_MODEL_READY = asyncio.Event()  # можно регистрироваться (быстрые проверки и прогрев позади)
+
+def _model_manifest_path(model: Path) -> Path:
+    return model.with_name(model.name + ".manifest.json")
+
+def _model_expected_sha(model: Path):
+    """Эталонный sha256: MODEL_SHA256, иначе первое слово <model>.sha256; None — эталона нет."""
+    if MODEL_SHA256:
+        return MODEL_SHA256
+    try:
+        words = model.with_name(model.name + ".sha256").read_text(encoding="utf-8").split()
+        return words[0].lower() if words and len(words[0]) == 64 else None
+    except Exception:
+        return None
+
+def verify_model(model: Path) -> dict:
+    """
+    Быстрые проверки: размер, магия, кэш сверки с эталоном. Возвращает {"ok", "error", "verify", "sha256"};
+    verify="pending" — нужен полный хэш (model_hash_check), "unverified" — эталона нет.
+    """
+    try:
+        st = model.stat()
+    except Exception:
+        return {"ok": False, "error": "model_missing", "verify": "stat"}
+    if st.st_size < 1 << 20:
+        return {"ok": False, "error": f"model_too_small:{st.st_size}", "verify": "stat"}
+    try:
+        with model.open("rb") as f:
+            magic = f.read(4)
+    except Exception as e:
+        return {"ok": False, "error": f"model_unreadable:{e!r}", "verify": "stat"}
+    if magic not in _MODEL_MAGICS:
+        return {"ok": False, "error": f"model_bad_magic:{magic!r}", "verify": "magic"}
+    expected = _model_expected_sha(model)
+    if not expected:
+        return {"ok": None, "error": None, "verify": "unverified"}
+    man = None
+    try:
+        man = json.loads(_model_manifest_path(model).read_text(encoding="utf-8"))
+    except Exception:
+        pass
+    if man and man.get("size") == st.st_size and man.get("mtime") == int(st.st_mtime) and man.get("sha256") == expected:
+        return {"ok": True, "error": None, "verify": "manifest", "sha256": expected}
+    return {"ok": None, "error": None, "verify": "pending"}
+
+def model_hash_check(model: Path) -> dict:
+    """Полный sha256 против эталона; совпадение запоминается в манифесте."""
+    expected = _model_expected_sha(model)
+    st = model.stat()
+    sha = sha256_file(model)
+    if sha != expected:
+        return {"ok": False, "error": "model_sha256_mismatch", "verify": "hash", "sha256": sha}
+    try:
+        _model_manifest_path(model).write_text(json.dumps({"size": st.st_size, "mtime": int(st.st_mtime), "sha256": sha}),
+                                               encoding="utf-8")
+    except Exception as e:
+        log("MODEL: manifest write error", e)
+    return {"ok": True, "error": None, "verify": "hash", "sha256": sha}
+
+def warmup_model(model: Path) -> int:
+    """Прочитать модель целиком, чтобы она оказалась в page cache. Возвращает мс."""
+    t0 = time.time()
+    fd = os.open(str(model), os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            except Exception:
+                pass
+        while os.read(fd, 4 << 20):
+            pass
+    finally:
+        os.close(fd)
+    return int((time.time() - t0) * 1000)
+
+async def model_startup():
+    """Проверка + прогрев модели вне event loop; результат — в _MODEL_STATE."""
+    loop = asyncio.get_running_loop()
+    model = Path(MODEL_PATH)
+    t0 = time.time()
+    try:
+        res = await loop.run_in_executor(None, verify_model, model)
+        _MODEL_STATE.update(ok=res["ok"], error=res["error"], verify=res["verify"],
+                            verify_ms=int((time.time() - t0) * 1000))
+        if res["ok"] is False:
+            log("MODEL: integrity FAILED", MODEL_PATH, res["error"])
+            return
+        if res["verify"] == "pending":
+            # хэш читает файл целиком (заодно прогрев) — регистрируемся, не дожидаясь его
+            _MODEL_READY.set()
+            try:
+                res = await loop.run_in_executor(None, model_hash_check, model)
+            except Exception as e:
+                res = {"ok": False, "error": f"model_unreadable:{e!r}", "verify": "hash"}
+            _MODEL_STATE.update(ok=res["ok"], error=res["error"], verify=res["verify"],
+                                verify_ms=int((time.time() - t0) * 1000), warmup_ms=0)
+            if not res["ok"]:
+                log("MODEL: integrity FAILED", MODEL_PATH, res["error"])
+                return
+        elif res["verify"] == "unverified":
+            log("MODEL: unverified — no MODEL_SHA256 or", MODEL_PATH + ".sha256")
+        log("MODEL:", res["verify"], "sha256:", (res.get("sha256") or "")[:12], "ms:", _MODEL_STATE["verify_ms"])
+        if MODEL_WARMUP and res["verify"] != "hash":
+            try:
+                _MODEL_STATE["warmup_ms"] = await loop.run_in_executor(None, warmup_model, model)
+                log("MODEL: warmup ms:", _MODEL_STATE["warmup_ms"])
+            except Exception as e:
+                log("MODEL: warmup error", repr(e))
+    finally:
+        _MODEL_READY.set()
+
+async def wait_model_ready():
+    """Дождаться быстрых проверок и прогрева (не дольше MODEL_WARMUP_WAIT_S), не отменяя фоновую задачу."""
+    global _MODEL_TASK
+    if _MODEL_TASK is None:
+        _MODEL_TASK = asyncio.create_task(model_startup())
+    if not _MODEL_READY.is_set():
+        try:
+            await asyncio.wait_for(_MODEL_READY.wait(), timeout=MODEL_WARMUP_WAIT_S)
+        except asyncio.TimeoutError:
+            log("MODEL: warmup still running, registering anyway")
+
 # ================== сетевые операции ==================
+class HttpClients:
+    """
+    Сессии aiohttp по профилям HTTP_PROFILES с DNS-кэшем и keep-alive.
+    Счётчики (новые соединения = TLS-рукопожатия, переиспользования, DNS hit/miss, запросы)
+    собираются через TraceConfig и уходят в heartbeat (metrics.http).
+    """
+
+    def __init__(self, profiles=None):
+        self.profiles = profiles or HTTP_PROFILES
+        self.sessions = {}
+        self.stats = {name: {"requests": 0, "conn_new": 0, "conn_reuse": 0, "dns_hit": 0, "dns_miss": 0}
+                      for name in self.profiles}
+
+    def _trace(self, name):
+        st = self.stats[name]
+        tc = aiohttp.TraceConfig()
+
+        def _inc(key):
+            async def _h(_session, _ctx, _params):
+                st[key] += 1
+            return _h
+        tc.on_request_start.append(_inc("requests"))
+        tc.on_connection_create_end.append(_inc("conn_new"))
+        tc.on_connection_reuseconn.append(_inc("conn_reuse"))
+        tc.on_dns_cache_hit.append(_inc("dns_hit"))
+        tc.on_dns_cache_miss.append(_inc("dns_miss"))
+        return tc
+
+    async def __aenter__(self):
+        for name, pr in self.profiles.items():
+            conn = aiohttp.TCPConnector(limit=pr["limit"], limit_per_host=pr["limit_per_host"],
+                                        keepalive_timeout=pr["keepalive_timeout"],
+                                        use_dns_cache=True, ttl_dns_cache=HTTP_DNS_TTL_S)
+            self.sessions[name] = aiohttp.ClientSession(connector=conn, timeout=pr["timeout"],
+                                                        trace_configs=[self._trace(name)])
+        return self
+
+    async def __aexit__(self, *exc):
+        for sess in self.sessions.values():
+            try:
+                await sess.close()
+            except Exception:
+                pass
+        self.sessions.clear()
+        return False
+
+    def __getattr__(self, name):
+        sessions = self.__dict__.get("sessions") or {}
+        if name in sessions:
+            return sessions[name]
+        raise AttributeError(name)
+
+    def timeout(self, name):
+        return self.profiles[name]["timeout"]
+
+    def snapshot(self):
+        out = {}
+        for name, st in self.stats.items():
+            conns = st["conn_new"] + st["conn_reuse"]
+            out[name] = dict(st, reuse_ratio=round(st["conn_reuse"] / conns, 3) if conns else None)
+        return out
+
+_HTTP = None  # HttpClients текущего процесса (ставит main)
+
+def _http_session(kind: str, fallback):
+    """Сессия профиля kind, если слой HttpClients поднят; иначе переданная (офлайн-режим, тесты)."""
+    if _HTTP is not None and kind in _HTTP.sessions:
+        return _HTTP.sessions[kind], _HTTP.timeout(kind)
+    return fallback, None
+
+# ================== упреждающая загрузка с Яндекс Диска ==================
+# Опционально (YADISK_PREFETCH=1): раз в YADISK_PREFETCH_POLL_S смотрим свежезагруженные записи под
+# YADISK_BASE_DIR (If-None-Match по ETag + водяной знак modified) и, пока сеть свободна (ни одна задача
+# не в стадии download, режим питания full), скачиваем новейшие в PREFETCH_DIR в пределах бюджета.
+# job.assign с input.file забирает локальную копию (или дожидается идущей загрузки). Файлы старше
+# YADISK_PREFETCH_TTL_S без задачи удаляются и считаются потраченными впустую байтами.
+YADISK_PREFETCH        = os.environ.get("YADISK_PREFETCH", "0") == "1"
+YADISK_BASE_DIR        = os.environ.get("YADISK_BASE_DIR", "/calls")
+YADISK_PREFETCH_MAX_MB = float(os.environ.get("YADISK_PREFETCH_MAX_MB", "300"))
+YADISK_PREFETCH_POLL_S = float(os.environ.get("YADISK_PREFETCH_POLL_S", "60"))
+YADISK_PREFETCH_AGE_S  = float(os.environ.get("YADISK_PREFETCH_AGE_S", "3600"))    # брать только свежие записи
+YADISK_PREFETCH_TTL_S  = float(os.environ.get("YADISK_PREFETCH_TTL_S", "21600"))
+YADISK_PREFETCH_SHARD  = os.environ.get("YADISK_PREFETCH_SHARD", "")  # "i/n": брать только свою долю путей
+PREFETCH_DIR = BASE_DIR / "prefetch"
+
+class YadiskPrefetcher:
+    def __init__(self):
+        from collections import OrderedDict
+        self.files = OrderedDict()   # disk-путь -> {"path", "size", "ts"}
+        self.inflight = {}           # disk-путь -> asyncio.Task
+        self.seen = OrderedDict()    # уже выданные задачами — не качать повторно
+        self.etag = None
+        self.since = 0.0             # водяной знак modified (epoch)
+        self.candidates = []
+        self.hits = self.misses = 0
+        self.bytes_fetched = self.bytes_used = self.bytes_wasted = 0
+        self.task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.task is not None
+
+    def start(self, session):
+        if not YADISK_PREFETCH or self.task is not None:
+            return
+        if not yadisk_token():
+            log("PREFETCH: YADISK_OAUTH_TOKEN is not set, disabled")
+            return
+        PREFETCH_DIR.mkdir(parents=True, exist_ok=True)
+        for p in PREFETCH_DIR.iterdir():  # копии прошлого запуска: без индекса не сопоставить
+            cleanup_files(p)
+        self.task = asyncio.create_task(self._loop(session))
+
+    def _mine(self, key: str) -> bool:
+        try:
+            i, n = (int(x) for x in YADISK_PREFETCH_SHARD.split("/"))
+        except ValueError:
+            return True
+        return int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16) % n == i
+
+    def _network_free(self) -> bool:
+        return _POWER.mode == "full" and not any(st.get("stage") == "download" for st in JOB_STAGES.values())
+
+    def _used(self) -> int:
+        return sum(f["size"] for f in self.files.values())
+
+    def _expire(self):
+        now = time.time()
+        for key in [k for k, f in self.files.items() if now - f["ts"] > YADISK_PREFETCH_TTL_S]:
+            f = self.files.pop(key)
+            cleanup_files(f["path"])
+            self.bytes_wasted += f["size"]
+            _M.inc("agent_prefetch_wasted_bytes_total", f["size"])
+
+    async def _poll(self, session):
+        from datetime import datetime
+        items, self.etag = await yadisk_list_recent(session, YADISK_BASE_DIR, yadisk_token(), etag=self.etag)
+        if items is None:
+            return  # 304: список не менялся, кандидаты — прежние
+        fresh = []
+        for it in items:
+            try:
+                mod = datetime.fromisoformat(it["modified"]).timestamp()
+            except Exception:
+                continue
+            if mod > self.since and time.time() - mod <= YADISK_PREFETCH_AGE_S:
+                fresh.append((mod, it["path"], int(it.get("size") or 0)))
+        if fresh:
+            self.since = max(m for m, _p, _s in fresh)
+        self.candidates = sorted(set(self.candidates) | set(fresh), reverse=True)
+
+    async def _fetch(self, session, key: str, size: int):
+        dst = PREFETCH_DIR / (hashlib.sha1(key.encode("utf-8")).hexdigest()[:20] + ".part")
+        t0 = time.time()
+        try:
+            await yadisk_download_cloud(session, key, dst, timeout=600)
+            real = dst.stat().st_size
+            final = dst.with_suffix(".audio")
+            os.replace(dst, final)
+            self.files[key] = {"path": final, "size": real, "ts": time.time()}
+            self.bytes_fetched += real
+            _M.inc("agent_prefetch_bytes_total", real)
+            dbg("PREFETCH: got", key, real, "B in", int((time.time() - t0) * 1000), "ms")
+        except Exception as e:
+            cleanup_files(dst)
+            log("PREFETCH: failed", key, repr(e))
+        finally:
+            self.inflight.pop(key, None)
+
+    async def _loop(self, session):
+        log("PREFETCH: watching", YADISK_BASE_DIR, "budget MB:", YADISK_PREFETCH_MAX_MB)
+        while True:
+            try:
+                sess, _t = _http_session("bulk", session)
+                self._expire()
+                await self._poll(sess)
+                budget = YADISK_PREFETCH_MAX_MB * 1048576
+                rest = []
+                for mod, key, size in self.candidates:
+                    if key in self.files or key in self.seen or key in self.inflight or not self._mine(key):
+                        continue
+                    if time.time() - mod > YADISK_PREFETCH_AGE_S:
+                        continue
+                    if not self._network_free() or self._used() + size > budget:
+                        rest.append((mod, key, size))
+                        continue
+                    self.inflight[key] = asyncio.create_task(self._fetch(sess, key, size))
+                    await asyncio.shield(self.inflight[key])  # по одной: фоновая загрузка не спорит с задачами
+                self.candidates = rest
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log("PREFETCH: poll failed:", repr(e))
+            await asyncio.sleep(YADISK_PREFETCH_POLL_S)
+
+    async def take(self, remote: str):
+        """Локальная копия для input.file (путь уходит вызывающему) или None; идущую загрузку дожидаемся."""
+        key = _normalize_disk_path(remote)
+        self.seen[key] = True
+        while len(self.seen) > 5000:
+            self.seen.popitem(last=False)
+        task = self.inflight.get(key)
+        if task is not None:
+            try:
+                await asyncio.shield(task)
+            except Exception:
+                pass
+        f = self.files.pop(key, None)
+        if f is None or not f["path"].exists():
+            self.misses += 1
+            _M.inc("agent_prefetch_total", result="miss")
+            return None
+        self.hits += 1
+        self.bytes_used += f["size"]
+        _M.inc("agent_prefetch_total", result="hit")
+        return f["path"]
+
+    def snapshot(self):
+        if not self.enabled:
+            return None
+        n = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / n, 3) if n else None,
+                "files": len(self.files), "mb": round(self._used() / 1048576, 1),
+                "fetched_mb": round(self.bytes_fetched / 1048576, 1),
+                "wasted_mb": round(self.bytes_wasted / 1048576, 1), "inflight": len(self.inflight)}
+
+_PREFETCH = YadiskPrefetcher()
+
 async def http_download(session: ClientSession, url: str, dst: Path, timeout=120):
     log("DOWNLOAD:", url, "->", dst)
     async with session.get(url, timeout=timeout) as r:
@@ -424,27 +2409,306 @@ async def http_download(session: ClientSession, url: str, dst: Path, timeout=120
 
 
 
+# ================== формат результата ==================
+# Воркер объявляет capabilities.result_formats / result_encodings при регистрации,
+# сервер выбирает в registration.ok (result_format / result_encoding). По умолчанию — JSON.
+#   columnar-v1: meta.segments заменяется на meta.segments_columnar —
+#   словарь спикеров + параллельные массивы start_ms/end_ms/text_off(+confidence),
+#   тексты склеены в одну строку.
+try:
+    import zstandard as _zstd  # type: ignore
+except Exception:
+    _zstd = None
+
+RESULT_FORMATS   = ["columnar-v1", "json"]
+RESULT_ENCODINGS = (["zstd"] if _zstd else []) + ["gzip", "identity"]
+_RESULT_NEGOTIATED = {"format": "json", "encoding": "gzip"}
+
+def negotiate_result_format(reg_ok: dict):
+    fmt = reg_ok.get("result_format")
+    enc = reg_ok.get("result_encoding")
+    _RESULT_NEGOTIATED["format"] = fmt if fmt in RESULT_FORMATS else "json"
+    _RESULT_NEGOTIATED["encoding"] = enc if enc in RESULT_ENCODINGS else "gzip"
+    log("RESULT: format", _RESULT_NEGOTIATED["format"], "encoding", _RESULT_NEGOTIATED["encoding"])
+
+def _segments_columnar(segments):
+    speakers, spk_idx = [], {}
+    col = {"v": 1, "speakers": speakers, "speaker": [], "start_ms": [], "end_ms": [], "text_off": [], "text": ""}
+    confs = []
+    parts, off = [], 0
+    for s in segments:
+        sp = s.get("speaker")
+        if sp not in spk_idx:
+            spk_idx[sp] = len(speakers)
+            speakers.append(sp)
+        col["speaker"].append(spk_idx[sp])
+        col["start_ms"].append(None if s.get("start") is None else int(round(s["start"] * 1000)))
+        col["end_ms"].append(None if s.get("end") is None else int(round(s["end"] * 1000)))
+        t = s.get("text") or ""
+        col["text_off"].append(off)
+        parts.append(t)
+        off += len(t)
+        confs.append(s.get("confidence"))
+    col["text_off"].append(off)
+    col["text"] = "".join(parts)
+    if any(c is not None for c in confs):
+        col["confidence"] = confs
+    return col
+
+def encode_result_body(payload: dict, fmt: str = "json", enc: str = "gzip"):
+    """Сериализация + сжатие результата (CPU-тяжёлое — вызывать в executor). Возвращает (body, headers)."""
+    hdrs = {"Content-Type": "application/json", "X-Result-Format": fmt}
+    if fmt == "columnar-v1":
+        meta = dict(payload.get("meta") or {})
+        meta["segments_columnar"] = _segments_columnar(meta.pop("segments", None) or [])
+        payload = dict(payload, meta=meta, result_format=fmt)
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        min_compress = 1024
+    else:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        min_compress = 100_000
+    if len(body) > min_compress:
+        if enc == "zstd" and _zstd is not None:
+            body = _zstd.ZstdCompressor(level=6).compress(body)
+            hdrs["Content-Encoding"] = "zstd"
+        elif enc != "identity":
+            import gzip
+            body = gzip.compress(body, compresslevel=6)
+            hdrs["Content-Encoding"] = "gzip"
+    return body, hdrs
+
 async def post_result(session: ClientSession, payload: dict):
     url = SERVER_API
-    hdrs = {"Authorization": f"Bearer {TOKEN}"}
+    session, _t = _http_session("upload", session)
+    fmt, enc = _RESULT_NEGOTIATED["format"], _RESULT_NEGOTIATED["encoding"]
+    body, hdrs = await asyncio.get_running_loop().run_in_executor(None, encode_result_body, payload, fmt, enc)
+    hdrs["Authorization"] = f"Bearer {TOKEN}"
     hdrs["X-Worker-Id"] = WORKER_ID
-    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-    if len(body) > 100_000:
-        import gzip
-        body = gzip.compress(body)
-        hdrs["Content-Encoding"] = "gzip"
-        hdrs["Content-Type"] = "application/json"
-    else:
-        hdrs["Content-Type"] = "application/json"
-    log("POST result →", url, "(gzipped)" if hdrs.get("Content-Encoding")=="gzip" else "")
+    log("POST result →", url, fmt, hdrs.get("Content-Encoding", "identity"), len(body), "B")
+    _M.inc("agent_result_bytes_total", len(body), transport="http")
+    _t0 = time.time()
     async with session.post(url, headers=hdrs, data=body) as r:
         text = await r.text()
         log("POST status", r.status, text[:500])
+        _M.inc("agent_result_posts_total", code=r.status)
+        _M.observe("agent_result_post_seconds", time.time() - _t0)
         r.raise_for_status()
 
+# ================== доставка результата: WS или HTTP ==================
+# Транспорт выбирается при регистрации: capabilities.result_transports → registration.ok.result_transport.
+# WS: job.result.begin (JSON) → бинарные чанки "RSC1"+len+JSON-заголовок+данные, окно
+# RESULT_WS_WINDOW неподтверждённых чанков; сервер шлёт job.result.ack {result_id, seq}
+# (seq — последний принятый подряд). После переподключения begin уходит заново с
+# resume_from=acked+1, сервер может ответить ack'ом со своим seq. Если WS не справился
+# за RESULT_WS_TIMEOUT_S — фолбэк на post_result по HTTP (идемпотентно по result_id).
+RESULT_TRANSPORTS     = ["ws", "http"]
+RESULT_WS_CHUNK       = int(os.environ.get("RESULT_WS_CHUNK", str(256 * 1024)))
+RESULT_WS_WINDOW      = int(os.environ.get("RESULT_WS_WINDOW", "8"))
+RESULT_WS_ACK_TIMEOUT = float(os.environ.get("RESULT_WS_ACK_TIMEOUT", "30"))
+RESULT_WS_TIMEOUT_S   = float(os.environ.get("RESULT_WS_TIMEOUT_S", "180"))
+_RESULT_NEGOTIATED["transport"] = "http"
+
+class _WsLink:
+    """Текущий WS-сокет процесса; меняется при переподключениях."""
+
+    def __init__(self):
+        self.ws = None
+        self.ready = asyncio.Event()
+        self.lost_at = None
+
+    def attach(self, ws):
+        self.ws = ws
+        self.ready.set()
+
+    def detach(self, ws=None):
+        if ws is None or self.ws is ws:
+            if self.ws is not None:
+                self.lost_at = time.time()
+            self.ws = None
+            self.ready.clear()
+
+    async def wait(self, timeout):
+        await asyncio.wait_for(self.ready.wait(), timeout=timeout)
+        return self.ws
+
+_WS_LINK = _WsLink()
+
+# ================== исходящие кадры задач, переживающие реконнект ==================
+# Задачи шлют ack/error/done не в конкретный сокет, а в _OUTBOX: если связи нет или
+# отправка упала — кадр буферизуется и досылается по порядку после registration.ok
+# на новом соединении. Так обрыв сети не приводит к повторному распознаванию.
+OUTBOX_MAX = int(os.environ.get("OUTBOX_MAX", "1000"))
+OUTBOX_RESEND_S = float(os.environ.get("OUTBOX_RESEND_S", "10"))  # кадры, ушедшие незадолго до обрыва, дублируем
+JOB_STAGES = {}  # job_id -> {"stage", "since"} для registration.in_flight_jobs
+
+def _set_stage(job_id, stage):
+    JOB_STAGES[job_id] = {"stage": stage, "since": int(time.time())}
+
+class _Outbox:
+    def __init__(self, link: _WsLink):
+        from collections import deque
+        self.link = link
+        self.buf = deque(maxlen=OUTBOX_MAX)
+        self.recent = deque(maxlen=50)  # (ts, кадр) — уже отправленные; могли потеряться в закрывающемся сокете
+        self.lock = asyncio.Lock()
+        self.replayed = 0
+        self.dropped = 0
+
+    async def send_json(self, obj):
+        async with self.lock:
+            ws = self.link.ws
+            if ws is not None and not self.buf and not getattr(ws, "closed", False):
+                try:
+                    await ws.send_json(obj)
+                    self.recent.append((time.time(), obj))
+                    return
+                except Exception as e:
+                    log("OUTBOX: send failed, buffering:", obj.get("type"), repr(e))
+                    self.link.detach(ws)
+            if len(self.buf) == self.buf.maxlen:
+                self.dropped += 1
+            self.buf.append(obj)
+
+    async def flush(self, ws):
+        """Дослать накопленные кадры в новый сокет (после registration.ok)."""
+        async with self.lock:
+            lost = self.link.lost_at
+            if lost is not None:
+                # дубль ack/done безопасен для сервера, потерянный done — нет
+                again = [o for ts, o in self.recent if ts >= lost - OUTBOX_RESEND_S]
+                self.recent.clear()
+                for o in again:
+                    await ws.send_json(o)
+                if again:
+                    log("OUTBOX: re-sent", len(again), "frames from before disconnect")
+            n = 0
+            while self.buf:
+                await ws.send_json(self.buf[0])
+                self.recent.append((time.time(), self.buf.popleft()))
+                n += 1
+            if n:
+                self.replayed += n
+                log("OUTBOX: replayed", n, "frames")
+
+_OUTBOX = _Outbox(_WS_LINK)
+_RECENT_DONE = {}  # job_id -> последний финальный кадр (job.done/job.error), для повторных job.assign
+
+def _final_frame(frame: dict) -> dict:
+    """Запомнить финальный кадр задачи (последние 100) — его и отдаём на повторный job.assign."""
+    _RECENT_DONE[frame["job_id"]] = frame
+    while len(_RECENT_DONE) > 100:
+        _RECENT_DONE.pop(next(iter(_RECENT_DONE)))
+    return frame
+
+class _PendingResult:
+    def __init__(self, payload: dict, body: bytes, hdrs: dict):
+        self.job_id = payload.get("job_id")
+        self.result_id = (payload.get("meta") or {}).get("result_id") or hashlib.sha256(body).hexdigest()
+        self.body = body
+        self.hdrs = hdrs
+        self.total = max(1, (len(body) + RESULT_WS_CHUNK - 1) // RESULT_WS_CHUNK)
+        self.acked = -1
+        self.ack_event = asyncio.Event()
+
+    def chunk_frame(self, seq: int) -> bytes:
+        import struct
+        hdr = json.dumps({"result_id": self.result_id, "job_id": self.job_id, "seq": seq,
+                          "last": seq == self.total - 1}).encode("utf-8")
+        return b"RSC1" + struct.pack(">I", len(hdr)) + hdr + self.body[seq * RESULT_WS_CHUNK:(seq + 1) * RESULT_WS_CHUNK]
+
+class WsResultTransport:
+    """Чанковая доставка job.result по WS с подтверждениями и докачкой после реконнекта."""
+
+    def __init__(self, link: _WsLink):
+        self.link = link
+        self.pending = {}  # result_id -> _PendingResult
+
+    def on_ack(self, data: dict):
+        res = self.pending.get(data.get("result_id"))
+        if res is None:
+            return
+        try:
+            res.acked = max(res.acked, int(data.get("seq", -1)))
+        except Exception:
+            return
+        res.ack_event.set()
+
+    def snapshot(self):
+        return [{"result_id": r.result_id, "job_id": r.job_id, "acked": r.acked, "total": r.total}
+                for r in self.pending.values()]
+
+    async def _pump(self, ws, res: _PendingResult):
+        await ws.send_json({"type": "job.result.begin", "job_id": res.job_id, "worker_id": WORKER_ID,
+                            "result_id": res.result_id, "size": len(res.body), "chunks": res.total,
+                            "chunk_size": RESULT_WS_CHUNK, "resume_from": res.acked + 1,
+                            "format": res.hdrs.get("X-Result-Format", "json"),
+                            "encoding": res.hdrs.get("Content-Encoding", "identity")})
+        nxt = res.acked + 1
+        while res.acked < res.total - 1:
+            nxt = max(nxt, res.acked + 1)
+            res.ack_event.clear()
+            while nxt < res.total and nxt - res.acked <= RESULT_WS_WINDOW:
+                await ws.send_bytes(res.chunk_frame(nxt))
+                nxt += 1
+            if res.acked >= res.total - 1:
+                break
+            await asyncio.wait_for(res.ack_event.wait(), timeout=RESULT_WS_ACK_TIMEOUT)
+            if self.link.ws is not ws:
+                raise ConnectionError("ws replaced")
+
+    async def deliver(self, payload: dict, body: bytes, hdrs: dict):
+        res = _PendingResult(payload, body, hdrs)
+        self.pending[res.result_id] = res
+        deadline = time.time() + RESULT_WS_TIMEOUT_S
+        try:
+            while True:
+                left = deadline - time.time()
+                if left <= 0:
+                    raise TimeoutError(f"ws result delivery timeout, acked {res.acked + 1}/{res.total}")
+                ws = await self.link.wait(timeout=left)
+                try:
+                    await self._pump(ws, res)
+                    log("RESULT: ws delivered", res.result_id[:12], res.total, "chunks", len(body), "B")
+                    return
+                except asyncio.TimeoutError:
+                    # сервер молчит — возможно, не знает протокол; докачка на следующем соединении или фолбэк
+                    if getattr(ws, "closed", False):
+                        self.link.detach(ws)
+                    if res.acked < 0:
+                        raise TimeoutError("no ack for ws result")
+                except Exception as e:
+                    log("RESULT: ws send interrupted, resume later:", repr(e), "acked:", res.acked + 1, "/", res.total)
+                    _M.inc("agent_result_ws_resumes_total")
+                    if getattr(ws, "closed", False):
+                        self.link.detach(ws)
+                    await asyncio.sleep(0.5)
+        finally:
+            self.pending.pop(res.result_id, None)
+
+_WS_RESULTS = WsResultTransport(_WS_LINK)
+
+def negotiate_result_transport(reg_ok: dict):
+    tr = reg_ok.get("result_transport")
+    _RESULT_NEGOTIATED["transport"] = tr if tr in RESULT_TRANSPORTS else "http"
+    log("RESULT: transport", _RESULT_NEGOTIATED["transport"])
+
+async def deliver_result(session: ClientSession, payload: dict):
+    """Отправить job.result согласованным транспортом; при сбое WS — HTTP POST."""
+    if _RESULT_NEGOTIATED["transport"] == "ws":
+        fmt, enc = _RESULT_NEGOTIATED["format"], _RESULT_NEGOTIATED["encoding"]
+        body, hdrs = await asyncio.get_running_loop().run_in_executor(None, encode_result_body, payload, fmt, enc)
+        try:
+            await _WS_RESULTS.deliver(payload, body, hdrs)
+            _M.inc("agent_result_bytes_total", len(body), transport="ws")
+            return
+        except Exception as e:
+            log("RESULT: ws delivery failed → HTTP fallback:", repr(e))
+            _M.inc("agent_result_fallback_total")
+    await post_result(session, payload)
+
 # ================== обработка заданий ==================
 
-async def handle_job(session: ClientSession, ws, job: dict):
+async def handle_job(session: ClientSession, ws, job: dict, deliver=None):
     """
     Ожидаем:
     {
@@ -455,16 +2719,35 @@ async def handle_job(session: ClientSession, ws, job: dict):
          "file": "/calls/...mp3"     (опц.)
         ,"channels": ["left","right"]
         ,"channel_roles": {"left":"operator","right":"client"}  (опц., присылает диспетчер)
+        ,"local_path": "/path/to/file.mp3"  (опц., офлайн-батч: без загрузки)
+        ,"range": {"start_s": 1800, "end_s": 2400, "overlap_s": 5}  (опц., кусок длинного звонка)
       }
     }
+    deliver: опц. корутина deliver(payload) вместо post_result (офлайн-батч).
     """
     slog("EVT:job.assign", job)
+    status = "exception"
+    _POWER.job_started(job["job_id"])
+    try:
+        with _SCRATCH.job(job["job_id"]) as scratch:
+            status = await _handle_job_stages(session, ws, job, scratch, deliver=deliver) or "ok"
+    finally:
+        _M.inc("agent_jobs_total", status=status)
+        await asyncio.get_running_loop().run_in_executor(None, _POWER.job_finished, job["job_id"])
+        await ensure_cache_quota_async()
+
+
+async def _handle_job_stages(session: ClientSession, ws, job: dict, scratch: "JobScratch", deliver=None):
+    """Этапы задачи: загрузка → split → whisper → сегменты → результат. Промежуточные файлы — в scratch."""
     job_id = job["job_id"]
     t0 = time.time()
     t_dl_ms = t_sp_ms = t_w_ms = 0
+    lang_hint = LANG_HINT  # снимок: set_config может поменять подсказку посреди задачи
     j_input = job.get("input") or {}
     audio_url = job.get("audio_url") or None
     input_file = j_input.get("file") if isinstance(j_input, dict) else None
+    local_path = j_input.get("local_path") if isinstance(j_input, dict) else None
+    rng = chunk_window(j_input.get("range") if isinstance(j_input, dict) else None)
 
     # Роли каналов: если передали channel_roles — используем; иначе дефолт left/right
     channel_roles = j_input.get("channel_roles")
@@ -475,13 +2758,17 @@ async def handle_job(session: ClientSession, ws, job: dict):
 
     await ws.send_json({"type":"job.ack","job_id":job_id,"worker_id":WORKER_ID})
     slog("EVT:job.ack", {"job_id": job_id})
+    _set_stage(job_id, "download")
 
-    # Файлы
-    mp3_path    = CACHE_DIR / f"{job_id}.mp3"
-    left_wav    = CACHE_DIR / f"{job_id}_left.wav"
-    right_wav   = CACHE_DIR / f"{job_id}_right.wav"
+    # Файлы: mp3/wav — во временном scratch, JSON/SRT/TXT — в кэше
+    if local_path:
+        mp3_path = Path(local_path)  # локальный файл читаем на месте, не копируем и не удаляем
+    else:
+        mp3_path = scratch.path("mp3", ".mp3", SCRATCH_MP3_EST_MB * 1024 * 1024)
     left_pref   = str(CACHE_DIR / f"{job_id}_left")
     right_pref  = str(CACHE_DIR / f"{job_id}_right")
+    left_json   = CACHE_DIR / f"{job_id}_left.json"
+    right_json  = CACHE_DIR / f"{job_id}_right.json"
     left_txt    = CACHE_DIR / f"{job_id}_left.txt"
     right_txt   = CACHE_DIR / f"{job_id}_right.txt"
     left_srt    = CACHE_DIR / f"{job_id}_left.srt"
@@ -489,146 +2776,164 @@ async def handle_job(session: ClientSession, ws, job: dict):
 
     # Загрузка
     _t_dl0 = time.time()
-    if audio_url:
-        await http_download(session, audio_url, mp3_path, timeout=300)
+    hit = None  # локальная копия от упреждающей загрузки
+    if local_path:
+        pass
+    elif audio_url:
+        dl_sess, dl_timeout = _http_session("bulk", session)
+        await http_download(dl_sess, audio_url, mp3_path, timeout=dl_timeout or 300)
     elif input_file:
-        await yadisk_download_cloud(session, input_file, mp3_path, timeout=300)
+        hit = await _PREFETCH.take(input_file) if _PREFETCH.enabled else None
+        if hit is not None:
+            import shutil
+            await asyncio.get_running_loop().run_in_executor(None, shutil.move, str(hit), str(mp3_path))
+        else:
+            dl_sess, dl_timeout = _http_session("bulk", session)
+            await yadisk_download_cloud(dl_sess, input_file, mp3_path, timeout=dl_timeout or 300)
     else:
-        await ws.send_json({"type":"job.error","job_id":job_id,"worker_id":WORKER_ID,"error":{"code":"no_input","detail":"Neither audio_url nor input.file provided"}})
+        await ws.send_json(_final_frame({"type":"job.error","job_id":job_id,"worker_id":WORKER_ID,"error":{"code":"no_input","detail":"Neither audio_url nor input.file provided"}}))
         slog("EVT:job.error", {"job_id": job_id, "error": "no_input"})
-        return
+        return "no_input"
     t_dl_ms = int((time.time() - _t_dl0) * 1000)
+    if not local_path:
+        try:
+            _M.inc("agent_download_bytes_total", mp3_path.stat().st_size,
+                   source="url" if audio_url else ("prefetch" if hit is not None else "yadisk"))
+        except Exception:
+            pass
+    try:
+        wav_est = int(mp3_path.stat().st_size * SCRATCH_WAV_FACTOR / 2)
+    except Exception:
+        wav_est = 0
+    left_wav    = scratch.path("wav", "_left.wav", wav_est)
+    right_wav   = scratch.path("wav", "_right.wav", wav_est)
 
-    # Разделение стерео
+    # Разделение по каналам: формат — по заголовкам, PCM 16 кГц — без ffmpeg, моно — один канал
+    _set_stage(job_id, "split")
     _t_sp0 = time.time()
-    rc, out, err = ffmpeg_split_stereo(mp3_path, left_wav, right_wav, timeout=TIMEOUT_S)
+    # декодирование mp3 — порядка секунд на мегабайт
+    sp_deadline = min(TIMEOUT_S, DEADLINE_BASE_S + wav_est / 1048576 * DEADLINE_MULT)
+    in_info = await asyncio.get_running_loop().run_in_executor(None, sniff_audio, mp3_path)
+    mono = in_info.get("channels") == 1
+    (rc, out, err), ff_use = await asyncio.get_running_loop().run_in_executor(
+        None, lambda: with_run_usage(split_channels, mp3_path, left_wav, right_wav, in_info,
+                                     timeout=sp_deadline, stall_s=STALL_S,
+                                     start_s=rng and rng["window"][0], dur_s=rng and rng["window_s"]))
+    ff_peak = (usage_summary(ff_use) or {}).get("maxrss_mb")
+    usage = {"split": ff_use}
     t_sp_ms = int((time.time() - _t_sp0) * 1000)
     if rc != 0:
         log(f"ffmpeg split failed rc={rc}: {err[-400:]}")
-        await ws.send_json({"type":"job.error","job_id":job_id,"worker_id":WORKER_ID,"error":"ffmpeg_split_failed"})
+        await ws.send_json(_final_frame({"type":"job.error","job_id":job_id,"worker_id":WORKER_ID,"error":"ffmpeg_split_failed"}))
         slog("EVT:job.error", {"job_id": job_id, "error": "ffmpeg_split_failed"})
-        cleanup_files(mp3_path, left_wav, right_wav)
-        ensure_cache_quota()
-        return
+        return "ffmpeg_split_failed"
 
     # Проверка размеров WAV — если пустые, останавливаемся раньше
     try:
-        if left_wav.stat().st_size < 1000 or right_wav.stat().st_size < 1000:
-            await ws.send_json({"type":"job.error","job_id":job_id,"worker_id":WORKER_ID,"error":"split_empty_output"})
+        if left_wav.stat().st_size < 1000 or (not mono and right_wav.stat().st_size < 1000):
+            await ws.send_json(_final_frame({"type":"job.error","job_id":job_id,"worker_id":WORKER_ID,"error":"split_empty_output"}))
             slog("EVT:job.error", {"job_id": job_id, "error": "split_empty_output"})
-            cleanup_files(mp3_path, left_wav, right_wav)
-            ensure_cache_quota()
-            return
+            return "split_empty_output"
     except Exception:
         pass
 
-    # Параллельное распознавание в SRT
+    # Параллельное распознавание в JSON (короткие звонки — через общий батч)
+    _set_stage(job_id, "whisper")
     _t_w0 = time.time()
-    loop = asyncio.get_running_loop()
-    tL = loop.run_in_executor(None, lambda: whisper_run_srt(left_wav,  left_pref, timeout=TIMEOUT_S))
-    tR = loop.run_in_executor(None, lambda: whisper_run_srt(right_wav, right_pref, timeout=TIMEOUT_S))
-    (rcL, outL, errL), (rcR, outR, errR) = await asyncio.gather(tL, tR)
-    t_w_ms = int((time.time() - _t_w0) * 1000)
-
-    srt_ok = left_srt.exists() and right_srt.exists()
-    if (rcL != 0 or rcR != 0) and not srt_ok:
-        log("whisper_srt rcL/rcR =", rcL, rcR)
-        await ws.send_json({"type":"job.error","job_id":job_id,"worker_id":WORKER_ID,"error":"whisper_failed"})
-        slog("EVT:job.error", {"job_id": job_id, "error": "whisper_failed", "rcL": rcL, "rcR": rcR, "stderrL_tail": (errL or "")[-400:], "stderrR_tail": (errR or "")[-400:]})
-        cleanup_files(mp3_path, left_wav, right_wav)
-        ensure_cache_quota()
-        return
-    # Парсинг сегментов
-    segments = []
-    if srt_ok:
-        segL = _parse_srt_to_segments(left_srt,  "left")
-        segR = _parse_srt_to_segments(right_srt, "right")
-
-        # маппинг ролей: left/right -> operator/client (если так прислали)
-        def _map_role(side: str) -> str:
-            v = (channels.get(side) or side).lower()
-            if v in ("operator","client"): return v
-            if v in ("left","l"):  return "operator"
-            if v in ("right","r"): return "client"
-            return v
-
-        for s in segL: s["speaker"] = _map_role("left")
-        for s in segR: s["speaker"] = _map_role("right")
-        segments = sorted(segL + segR, key=lambda x: (x.get("start") or 0, x.get("end") or 0))
-
-        # если сегменты не распарсились, соберём plain из SRT
-        if not segments:
-            def _srt_plain_text(_p: Path) -> str:
-                try:
-                    t = _p.read_text(encoding="utf-8", errors="ignore")
-                except Exception:
-                    t = ""
-                lines = []
-                for ln in (t.splitlines() if t else []):
-                    s = ln.strip()
-                    if not s: continue
-                    if "-->" in s: continue
-                    if s.isdigit(): continue
-                    lines.append(s)
-                return " ".join(lines)
-
-            left_plain  = _srt_plain_text(left_srt)
-            right_plain = _srt_plain_text(right_srt)
-
-            def _role2(side: str) -> str:
-                v = (channels.get(side) or side).lower()
-                if v in ("operator","client"): return v
-                if v in ("left","l"):  return "operator"
-                if v in ("right","r"): return "client"
-                return v
-
-            if left_plain:
-                segments.append({"speaker": _role2("left"),  "text": left_plain,  "start": None, "end": None})
-            if right_plain:
-                segments.append({"speaker": _role2("right"), "text": right_plain, "start": None, "end": None})
-
-        full_text = " ".join(s.get("text","") for s in segments if s.get("text")).strip()
-
+    batch_info = None
+    watch = {}
+    audio_s = max(_wav_duration_s(left_wav), _wav_duration_s(right_wav))
+    profile = job.get("decoder_profile") or DECODER_PROFILE
+    _thr, _model, _extra = await asyncio.get_running_loop().run_in_executor(None, decoder_setup, profile)
+    rtf_key = RtfTracker.key(_model, _thr, profile if _extra else "")
+    deadline_s = _RTF.deadline_s(audio_s, rtf_key)
+    langs = await asyncio.get_running_loop().run_in_executor(None, known_languages, job, lang_hint)
+    if langs is None:
+        async with _WHISPER_LOCK:
+            langs, usage["lang"] = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: with_run_usage(probe_languages, job, left_wav, None if mono else right_wav,
+                                             scratch, lang_hint, _thr, _model))
+        _M.observe("agent_lang_probe_seconds", langs["probe_ms"] / 1000.0)
+    log(f"LANG: left={langs['left']} right={langs['right']} ({langs['source']})")
+    if (BATCH_WINDOW_S > 0 and 0 < audio_s <= BATCH_SHORT_S and not mono
+            and langs["left"] == langs["right"] == lang_hint):
+        (rcL, errL), (rcR, errR), batch_info = await _BATCHER.submit(job_id, left_wav, right_wav, left_pref, right_pref,
+                                                                     lang_hint, profile)
+        eff_threads = batch_info.get("batch_threads") or _thr
     else:
-        # Fallback: TXT без таймкодов
-        left_text  = left_txt.read_text(encoding="utf-8", errors="ignore") if left_txt.exists()  else ""
-        right_text = right_txt.read_text(encoding="utf-8", errors="ignore") if right_txt.exists() else ""
-
-        def _role(side: str) -> str:
-            v = (channels.get(side) or side).lower()
-            if v in ("operator","client"): return v
-            if v in ("left","l"):  return "operator"
-            if v in ("right","r"): return "client"
-            return v
-
-        segments = []
-        if left_text.strip():
-            segments.append({"speaker": _role("left"),  "text": left_text.strip(),  "start": None, "end": None})
-        if right_text.strip():
-            segments.append({"speaker": _role("right"), "text": right_text.strip(), "start": None, "end": None})
-
-        full_text = " ".join(s.get("text","") for s in segments if s.get("text")).strip()
-
-    # Очистка сегментов + ограничение текста
-    segments = [s for s in segments if s.get("text")]
-    for s in segments:
-        s["text"] = _clean_segment_text(s["text"])
-    segments = [s for s in segments if s["text"]]
-
-    full_text = " ".join(s["text"] for s in segments).strip()
+        loop = asyncio.get_running_loop()
+        async with _WHISPER_LOCK:
+            _t_run0 = time.time()  # без ожидания лока — для RTF
+            mem = await loop.run_in_executor(None, _MEM.plan, _model, _thr, audio_s)
+            run_l = lambda: whisper_run_guarded(left_wav,  left_pref, deadline_s, profile, mem["model"], langs["left"])
+            run_r = lambda: (whisper_run_guarded(right_wav, right_pref, deadline_s, profile, mem["model"], langs["right"])
+                             if not mono else (0, "", "", {"attempts": 0, "killed": None}))
+            if mem["mode"] == "parallel":
+                (rcL, outL, errL, wL), (rcR, outR, errR, wR) = await asyncio.gather(
+                    loop.run_in_executor(None, run_l), loop.run_in_executor(None, run_r))
+            else:
+                log(f"MEM: channels serialised (need ~{mem['est_mb']} MB ×2, available {mem['avail_mb']} MB)"
+                    + (f", model → {os.path.basename(mem['model'])}" if mem["model"] != _model else ""))
+                rcL, outL, errL, wL = await loop.run_in_executor(None, run_l)
+                rcR, outR, errR, wR = await loop.run_in_executor(None, run_r)
+        for w in (wL, wR) if not mono else (wL,):
+            await loop.run_in_executor(None, _MEM.observe, mem["model"], w.get("threads") or _thr, audio_s, w.get("peak_rss_mb"))
+        # фактическое число потоков (режим питания, профиль, повтор после зависания), а не THREADS из env
+        eff_threads = max((w.get("threads") or _thr) for w in ((wL, wR) if not mono else (wL,)))
+        mem_info = {"plan": mem["mode"], "est_mb": mem["est_mb"], "avail_mb": mem["avail_mb"],
+                    "model": os.path.basename(mem["model"]),
+                    "peak_rss_mb": {"ffmpeg": ff_peak, "whisper_left": wL.get("peak_rss_mb"),
+                                    "whisper_right": wR.get("peak_rss_mb"),
+                                    "agent": (_proc_status_kb("self", "VmHWM") or 0) // 1024}}
+        watch = {"deadline_s": int(deadline_s),
+                 "decoder_profile": profile if _extra else None,
+                 "repetition_spans": {side: w["repetition_spans"] for side, w in (("left", wL), ("right", wR))
+                                      if w.get("repetition_spans")} or None,
+                 "repetition_wasted_s": round(wL.get("repetition_wasted_s", 0) + wR.get("repetition_wasted_s", 0), 2),
+                 "whisper_attempts": max(wL["attempts"], wR["attempts"]),
+                 "killed": [k for k in (wL["killed"], wR["killed"]) if k]}
+        watch["mem"] = mem_info
+        usage["whisper"] = wL.get("usage", []) + wR.get("usage", [])
+        if watch["repetition_wasted_s"]:
+            _M.inc("agent_whisper_repetition_wasted_seconds_total", watch["repetition_wasted_s"])
+        if (rcL == 0 and rcR == 0 and watch["whisper_attempts"] == 1 and not watch["repetition_spans"]
+                and mem["mode"] == "parallel"):
+            await loop.run_in_executor(None, _RTF.update, audio_s, time.time() - _t_run0, rtf_key)
+    t_w_ms = int((time.time() - _t_w0) * 1000)
+    _CACHE_INDEX.register(left_json, right_json, left_srt, right_srt, left_txt, right_txt)
+
+    out_ok = all(any(p.exists() for p in side) for side in ((left_json, left_srt, left_txt),)
+                 + (() if mono else ((right_json, right_srt, right_txt),)))
+    if (rcL != 0 or rcR != 0) and not out_ok:
+        log("whisper rcL/rcR =", rcL, rcR)
+        await ws.send_json(_final_frame({"type":"job.error","job_id":job_id,"worker_id":WORKER_ID,"error":"whisper_failed", "detail": watch or None}))
+        slog("EVT:job.error", {"job_id": job_id, "error": "whisper_failed", "rcL": rcL, "rcR": rcR, **watch, "stderrL_tail": (errL or "")[-400:], "stderrR_tail": (errR or "")[-400:]})
+        return "whisper_failed"
+
+    # маппинг ролей: left/right -> operator/client (если так прислали)
+    def _map_role(side: str) -> str:
+        v = (channels.get(side) or side).lower()
+        if v in ("operator","client"): return v
+        if v in ("left","l","mono"): return "operator"  # моно-запись: ролей не различить, протокол знает только две
+        if v in ("right","r"): return "client"
+        return v
+
+    # Сегменты: чистка + роли + слияние за один проход по двум отсортированным потокам
+    _set_stage(job_id, "segments")
+    segments = await asyncio.get_running_loop().run_in_executor(None, lambda: _build_segments(
+        [(_map_role("mono"), _channel_segments(left_pref))] if mono else
+        [(_map_role("left"),  _channel_segments(left_pref)),
+         (_map_role("right"), _channel_segments(right_pref))],
+        max_gap_s=float(os.environ.get("SEG_MERGE_GAP_S","0.6")),
+    ))
+    if rng:
+        # время — абсолютное по звонку; сегменты из перекрытий помечены, в text не идут
+        segments = chunk_segments(segments, rng)
+        rng["window"][1] = round(rng["window"][0] + audio_s, 3)
+    full_text = " ".join(s["text"] for s in segments if not s.get("overlap")).strip()
     if len(full_text) > MAX_TEXT_LEN:
         log(f"TEXT: truncated {len(full_text)} -> {MAX_TEXT_LEN}")
         full_text = full_text[:MAX_TEXT_LEN]
-    # Слить соседние сегменты одного спикера и близкие по времени
-    try:
-        segments = _merge_adjacent_segments(segments, max_gap_s=float(os.environ.get("SEG_MERGE_GAP_S","0.6")))
-        # Пересобрать full_text по сегментам (если он ещё не пустой)
-        full_text = " ".join(s.get("text","") for s in segments if s.get("text"))
-    except Exception:
-        pass
-
-
-
 
     # Метрики
     metrics = {
@@ -636,7 +2941,37 @@ async def handle_job(session: ClientSession, ws, job: dict):
         "split_ms": int(t_sp_ms),
         "whisper_ms": int(t_w_ms),
         "total_ms": int((time.time() - t0) * 1000),
+        "audio_s": round(audio_s, 2),
+        "scratch_tier": scratch.report(),
+        "power_mode": _POWER.mode,
     }
+    if hit is not None:
+        metrics["download_source"] = "prefetch"
+    if "probe_ms" in langs:
+        metrics["lang_probe_ms"] = langs["probe_ms"]
+    metrics["input"] = {k: in_info.get(k) for k in ("container", "codec", "sample_rate", "channels", "bits",
+                                                     "bitrate_kbps", "vbr", "duration_s", "split") if k in in_info}
+    resources = {stage: usage_summary(ch) for stage, ch in usage.items() if ch}
+    if resources:
+        resources["job"] = usage_summary([c for ch in usage.values() for c in ch])
+        metrics["resources"] = resources
+        eff = (resources.get("whisper") or {}).get("cpu_eff")
+        if eff is not None:
+            metrics["cpu_eff"] = eff
+            _M.observe("agent_whisper_cpu_efficiency", eff, buckets=(0.2, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+            if eff < CPU_EFF_WARN and resources["whisper"]["wall_s"] >= 5:  # короткие прогоны — в основном загрузка модели
+                log(f"RES: whisper cpu_eff {eff} < {CPU_EFF_WARN} (threads oversubscribed?):", resources["whisper"])
+    if watch:
+        metrics.update(watch)
+        metrics["deadline_miss"] = "deadline" in watch["killed"]
+    if batch_info:
+        metrics.update(batch_info)
+        _M.observe("agent_batch_wait_seconds", batch_info["batch_wait_ms"] / 1000.0)
+    for _stage, _ms in (("download", t_dl_ms), ("split", t_sp_ms), ("whisper", t_w_ms)):
+        _M.observe("agent_stage_seconds", _ms / 1000.0, stage=_stage)
+    _M.observe("agent_audio_seconds", audio_s, buckets=(15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 5400))
+
+    audio_sha = j_input.get("sha256") or await asyncio.get_running_loop().run_in_executor(None, sha256_file, mp3_path)
 
     # result_id для идемпотентности
     result_id = hashlib.sha256(
@@ -653,27 +2988,38 @@ async def handle_job(session: ClientSession, ws, job: dict):
         "text": full_text,
         "meta": {
             "segments": segments,
-            "audio_sha256": sha256_file(mp3_path),
+            "audio_sha256": audio_sha,
             "model_path": MODEL_PATH,
-            "lang_hint": LANG_HINT,
-            "threads": THREADS,
+            "lang_hint": lang_hint,
+            "lang": {"left": langs["left"], "right": langs["right"]},
+            "lang_source": langs["source"],
+            "lang_p": langs.get("p") or None,
+            "range": ({k: v for k, v in rng.items() if k != "window_s"} if rng else None),
+            "threads": eff_threads,
             "result_id": result_id,
         },
     }
-    # Пути до артефактов для отладки
+    # Пути до артефактов — только для отладки (в бою это лишние байты по мобильному аплинку)
     try:
-        if left_srt.exists():  payload["meta"]["left_srt_path"]  = str(left_srt)
-        if right_srt.exists(): payload["meta"]["right_srt_path"] = str(right_srt)
+        if _should_debug():
+            for k, pth in (("left_json_path", left_json), ("right_json_path", right_json),
+                           ("left_srt_path", left_srt), ("right_srt_path", right_srt)):
+                if pth.exists():
+                    payload["meta"][k] = str(pth)
     except Exception:
         pass
 
-    await post_result(session, payload)
-    await ws.send_json({"type":"job.done","job_id":job_id,"worker_id":WORKER_ID})
+    _set_stage(job_id, "deliver")
+    _t_dv0 = time.time()
+    if deliver is not None:
+        await deliver(payload)
+    else:
+        await deliver_result(session, payload)
+    _M.observe("agent_stage_seconds", time.time() - _t_dv0, stage="deliver")
+    _M.observe("agent_stage_seconds", time.time() - t0, stage="total")
+    await ws.send_json(_final_frame({"type":"job.done","job_id":job_id,"worker_id":WORKER_ID}))
     slog("EVT:job.done", {"job_id": job_id, "segments_cnt": len(segments)})
 
-    cleanup_files(mp3_path, left_wav, right_wav)
-    ensure_cache_quota()
-
 
 async def recv_json(ws, *, first=False, timeout=None):
     """Унифицированный приём JSON-кадра с понятными ошибками + лог входящих кадров."""
@@ -694,22 +3040,227 @@ async def recv_json(ws, *, first=False, timeout=None):
         pass
     return data
 
-async def heartbeat_loop(ws):
-    while True:
-        m = get_metrics()
-        # fallback: если системный uptime не доступен — используем аптайм процесса агента
-        if m.get("uptime_s") is None:
+# ================== запись WS-трафика (для agent.py replay) ==================
+# WS_RECORD_FILE=path.jsonl — каждый входящий/исходящий кадр строкой {"t": мс от старта, "c": № соединения,
+# "d": in|out|ev, "f": кадр}. Секреты (ключи token/secret/…, подписи в query) вырезаются, длинные строки и
+# списки (текст, сегменты) — укорачиваются: для воспроизведения нагрузки нужен ритм кадров, а не содержимое.
+WS_RECORD_FILE   = os.environ.get("WS_RECORD_FILE", "")
+WS_RECORD_MAX_MB = float(os.environ.get("WS_RECORD_MAX_MB", "50"))
+_REC_SECRET_KEY = re.compile(r"token|secret|passw|authorization|cookie|api_?key", re.I)
+_REC_SECRET_QS  = re.compile(r"([?&](?:token|access_token|sig|signature|key|X-Amz-[A-Za-z-]+)=)[^&#\s\"]+", re.I)
+
+def _rec_compact(obj):
+    """Копия кадра без секретов и без длинного содержимого."""
+    if isinstance(obj, dict):
+        return {k: ("****" if _REC_SECRET_KEY.search(str(k)) else _rec_compact(v)) for k, v in obj.items()}
+    if isinstance(obj, list):
+        head = [_rec_compact(v) for v in obj[:20]]
+        return head + [f"…(+{len(obj) - 20})"] if len(obj) > 20 else head
+    if isinstance(obj, str):
+        obj = _REC_SECRET_QS.sub(r"\1****", obj)
+        return obj if len(obj) <= 256 else obj[:64] + f"…(+{len(obj) - 64})"
+    return obj
+
+class WsRecorder:
+    def __init__(self, path: str):
+        self.path = Path(path) if path else None
+        self.f = None
+        self.t0 = time.time()
+        self.conn = 0
+        self.size = 0
+        self.flushed = 0.0
+
+    def wrap(self, ws):
+        """Новое соединение: вернуть ws-обёртку, пишущую кадры (или сам ws, если запись выключена)."""
+        if self.path is None:
+            return ws
+        self.conn += 1
+        self.event("connect")
+        return _RecordingWs(ws, self)
+
+    def _write(self, rec: dict):
+        if self.path is None:
+            return
+        try:
+            if self.f is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self.f = self.path.open("a", encoding="utf-8")
+                self._line({"rec": 1, "worker_id": WORKER_ID, "started": round(self.t0, 3)})
+            self._line(rec)
+            now = time.time()
+            if rec["d"] == "ev" or now - self.flushed > 1:
+                self.f.flush()
+                self.flushed = now
+            if self.size > WS_RECORD_MAX_MB * 1048576:
+                log("WSREC: size limit reached, recording stopped:", self.path)
+                self.close()
+                self.path = None
+        except Exception as e:
+            log("WSREC: write failed, recording stopped:", repr(e))
+            self.path = None
+
+    def _line(self, rec):
+        line = json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n"
+        self.f.write(line)
+        self.size += len(line)
+
+    def frame(self, direction: str, obj):
+        self._write({"t": round((time.time() - self.t0) * 1000, 1), "c": self.conn, "d": direction,
+                     "f": _rec_compact(obj)})
+
+    def event(self, name: str, **kw):
+        self._write({"t": round((time.time() - self.t0) * 1000, 1), "c": self.conn, "d": "ev",
+                     "f": dict(type=name, **kw)})
+
+    def close(self):
+        if self.f is not None:
+            try:
+                self.f.close()
+            except Exception:
+                pass
+            self.f = None
+
+class _RecordingWs:
+    """Прозрачная обёртка над ClientWebSocketResponse: дублирует кадры в WsRecorder."""
+
+    def __init__(self, ws, rec: WsRecorder):
+        self._ws = ws
+        self._rec = rec
+
+    def __getattr__(self, name):
+        return getattr(self._ws, name)
+
+    async def send_json(self, obj, **kw):
+        await self._ws.send_json(obj, **kw)
+        self._rec.frame("out", obj)
+
+    async def send_bytes(self, data: bytes, **kw):
+        await self._ws.send_bytes(data, **kw)
+        head = {"type": "binary", "bytes": len(data)}
+        if data[:4] == b"RSC1":
+            try:
+                import struct
+                hl = struct.unpack(">I", data[4:8])[0]
+                head.update(json.loads(data[8:8 + hl]))
+            except Exception:
+                pass
+        self._rec.frame("out", head)
+
+    async def receive(self, *a, **kw):
+        msg = await self._ws.receive(*a, **kw)
+        if msg.type == aiohttp.WSMsgType.TEXT:
             try:
-                import time as _t2
-                m["uptime_s"] = int(_t2.time() - _AGENT_START_TS)
+                self._rec.frame("in", json.loads(msg.data))
             except Exception:
-                m["uptime_s"] = 0
+                self._rec.frame("in", {"type": "non-json", "bytes": len(msg.data)})
+        elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+            self._rec.event("close", msg=str(msg.type))
+        return msg
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.receive()
+        if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED):
+            raise StopAsyncIteration
+        return msg
+
+_WS_REC = WsRecorder(WS_RECORD_FILE)
+
+# ================== heartbeat: дельты и адаптивный темп ==================
+# Первый heartbeat соединения — полный снимок, дальше (если сервер согласился на
+# heartbeat_mode=delta) — только изменившиеся поля, с полным снимком раз в HB_FULL_EVERY_S.
+# В простое интервал удваивается, пока ничего не меняется (до HB_IDLE_MAX_S); смена
+# состояния (idle↔busy, тепловой порог, threads/lang, модель) отправляет heartbeat сразу.
+# Все параметры меняются на лету через control.set_config {"heartbeat": {...}}.
+HB_MODE         = os.environ.get("HB_MODE", "delta")   # delta | full
+HB_BUSY_S       = float(os.environ.get("HB_BUSY_S", str(HEARTBEAT_INTERVAL_S)))
+HB_IDLE_S       = float(os.environ.get("HB_IDLE_S", str(HEARTBEAT_INTERVAL_S)))
+HB_IDLE_MAX_S   = float(os.environ.get("HB_IDLE_MAX_S", "120"))
+HB_FULL_EVERY_S = float(os.environ.get("HB_FULL_EVERY_S", "900"))
+HB_PING_EVERY_S = float(os.environ.get("HB_PING_EVERY_S", "300"))  # как часто мерить RTT ping'ом
+HB_PROBE_S      = float(os.environ.get("HB_PROBE_S", "5"))         # опрос дешёвого ключа состояния
+HB_DELTA_TOL    = float(os.environ.get("HB_DELTA_TOL", "0.1"))     # относительный допуск для float
+WS_PING_S       = int(os.environ.get("WS_PING_S", str(max(HEARTBEAT_INTERVAL_S, 30))))
+HB_MODES = ["delta", "full"]
+_HB_VOLATILE = {"uptime_s"}  # сервер выводит из ts, в дельты не попадает
+# абсолютные пороги «шума» для быстро плавающих полей; прочие float — по HB_DELTA_TOL, int — точно
+_HB_NOISE = {"cpu_percent": 10.0, "temp_c": 1.0, "mem_free_kb": 65536, "disk_free_mb": 64, "rtt_ms": 30,
+             "lag_p50_ms": 5.0, "lag_p99_ms": 20.0, "lag_max_ms": 50.0}
+
+class HeartbeatShaper:
+    def __init__(self):
+        self.cfg = {"mode": HB_MODE, "busy_s": HB_BUSY_S, "idle_s": HB_IDLE_S, "idle_max_s": HB_IDLE_MAX_S,
+                    "full_every_s": HB_FULL_EVERY_S, "ping_every_s": HB_PING_EVERY_S}
+        self.server_delta = False
+        self.wake = asyncio.Event()
+        self.reason = None
+        self.last_rtt = None
+        self.last_ping = 0.0
+        self.reset()
+
+    def reset(self):
+        """Новое соединение: базы у сервера нет, первым уходит полный снимок."""
+        self.base = None
+        self.seq = 0
+        self.last_full = 0.0
+        self.idle_streak = 0
+        self.key = None
+
+    def negotiate(self, reg_ok: dict):
+        self.server_delta = reg_ok.get("heartbeat_mode") == "delta"
+        if isinstance(reg_ok.get("heartbeat"), dict):
+            self.configure(reg_ok["heartbeat"])
+        log("HB: mode", "delta" if self.delta_on else "full", self.cfg)
+
+    def configure(self, conf: dict) -> dict:
+        for k, v in (conf or {}).items():
+            if k == "mode":
+                if v in HB_MODES:
+                    self.cfg["mode"] = v
+            elif k in self.cfg:
+                try:
+                    self.cfg[k] = max(1.0, float(v))
+                except (TypeError, ValueError):
+                    pass
+        self.kick("config")
+        return dict(self.cfg)
+
+    def kick(self, reason: str):
+        self.reason = reason
+        self.wake.set()
+
+    @property
+    def delta_on(self) -> bool:
+        return self.cfg["mode"] == "delta" and self.server_delta
+
+    @staticmethod
+    def state_key():
+        return (os.environ.get("AGENT_STATUS", "idle"), _thermal_band(_read_temp_c()),
+                THREADS, LANG_HINT, _MODEL_STATE["ok"], _POWER.mode)
+
+    def interval(self, status: str) -> float:
+        if status == "busy":
+            return self.cfg["busy_s"]
+        return min(self.cfg["idle_max_s"], self.cfg["idle_s"] * (2 ** self.idle_streak))
+
+    def snapshot(self) -> dict:
+        """Полный снимок (блокирующий: выборка CPU, ping) — вызывать в executor."""
+        m = get_metrics()
+        if m.get("uptime_s") is None:
+            m["uptime_s"] = int(time.time() - _AGENT_START_TS)
         adjust_threads_by_temp(m.get("temp_c"))
-        hb = {
-            "type":"heartbeat",
-            "worker_id": WORKER_ID,
-            "ts": int(time.time()),
-            "status": os.environ.get("AGENT_STATUS","idle"),
+        now = time.time()
+        if self.last_rtt is None or now - self.last_ping >= self.cfg["ping_every_s"]:
+            net = get_network_info()
+            self.last_ping, self.last_rtt = now, net["rtt_ms"]
+        else:
+            net = get_network_info(ping=False)
+            net["rtt_ms"] = self.last_rtt
+        self.key = self.state_key()
+        return {
+            "status": self.key[0],
             "metrics": m,
             "software": {
                 "termux":"0.118+",
@@ -717,58 +3268,196 @@ async def heartbeat_loop(ws):
                 "python": sys.version.split()[0],
                 "whisper_cli":"local_build"
             },
-            "network": get_network_info(),
+            "network": net,
             "model_config": {
                 "model_path": MODEL_PATH,
                 "threads": THREADS,
-                "lang_hint": LANG_HINT
+                "lang_hint": LANG_HINT,
+                "model_ok": _MODEL_STATE["ok"],
+                "warmup_ms": _MODEL_STATE["warmup_ms"]
             }
         }
-        # Не пытаться слать HB в закрытый сокет
-        if getattr(ws, 'closed', False):
-            log('HB: ws is closed → stop loop')
-            break
-        try:
-            await ws.send_json(hb)
-            slog("EVT:heartbeat.sent", hb)
-        except Exception as e:
-            log("HB send error:", e)
-            break
-        try:
-            await asyncio.sleep(HEARTBEAT_INTERVAL_S)
-        except asyncio.CancelledError:
-            break
+
+    @staticmethod
+    def _diff(prev: dict, cur: dict, tol: float) -> dict:
+        out = {}
+        for k, v in cur.items():
+            if k in _HB_VOLATILE:
+                continue
+            p = prev.get(k)
+            if isinstance(v, dict) and isinstance(p, dict):
+                d = HeartbeatShaper._diff(p, v, tol)
+                if d:
+                    out[k] = d
+            elif (isinstance(v, (int, float)) and isinstance(p, (int, float)) and not isinstance(p, bool)
+                  and (k in _HB_NOISE or isinstance(v, float))
+                  and abs(v - p) <= _HB_NOISE.get(k, tol * max(abs(p), 1.0))):
+                continue  # шум; база не обновляется, так что медленный дрейф всё равно всплывёт
+            elif k not in prev or v != p:
+                out[k] = v
+        for k in prev:
+            if k not in cur:
+                out[k] = None
+        return out
+
+    @staticmethod
+    def _apply(base: dict, delta: dict):
+        for k, v in delta.items():
+            if isinstance(v, dict) and isinstance(base.get(k), dict):
+                HeartbeatShaper._apply(base[k], v)
+            else:
+                base[k] = v
+
+    async def _wait(self, timeout: float) -> str:
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return "timer"
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=min(left, HB_PROBE_S))
+                self.wake.clear()
+                return self.reason or "kick"
+            except asyncio.TimeoutError:
+                pass
+            if await loop.run_in_executor(None, self.state_key) != self.key:
+                return "state"
+
+    async def run(self, ws):
+        loop = asyncio.get_running_loop()
+        self.reset()
+        self.wake.clear()
+        reason = "connect"
+        while True:
+            cur = await loop.run_in_executor(None, self.snapshot)
+            now = time.time()
+            delta = self._diff(self.base or {}, cur, HB_DELTA_TOL)
+            full = not self.delta_on or self.base is None or now - self.last_full >= self.cfg["full_every_s"]
+            self.seq += 1
+            hb = {"type": "heartbeat", "worker_id": WORKER_ID, "ts": int(now), "seq": self.seq, "reason": reason}
+            if full:
+                hb.update(cur)
+            else:
+                hb["delta"] = True
+                hb["status"] = cur["status"]
+                hb.update(delta)
+            # Не пытаться слать HB в закрытый сокет
+            if getattr(ws, 'closed', False):
+                log('HB: ws is closed → stop loop')
+                break
+            try:
+                await ws.send_json(hb)
+            except Exception as e:
+                log("HB send error:", e)
+                break
+            if full:
+                self.base, self.last_full = json.loads(json.dumps(cur)), now
+            else:
+                self._apply(self.base, delta)
+            _M.inc("agent_heartbeats_total", kind="full" if full else "delta")
+            if _should_debug():
+                slog("EVT:heartbeat.sent", hb)
+            elif _throttle("hb.sent", 600):
+                log("HB: seq", self.seq, "full" if full else "delta", reason, "changed:", sorted(delta))
+            self.idle_streak = self.idle_streak + 1 if (cur["status"] == "idle" and not delta) else 0
+            reason = await self._wait(self.interval(cur["status"]))
+
+_HB = HeartbeatShaper()
+
+async def heartbeat_loop(ws):
+    await _HB.run(ws)
 
 # ================== основной цикл ==================
+def _batch_eligible(duration_s) -> bool:
+    """Короткий звонок по подсказке duration_s; без подсказки — нет (длинный занял бы лок whisper надолго)."""
+    try:
+        return 0 < float(duration_s) <= BATCH_SHORT_S
+    except (TypeError, ValueError):
+        return False
+
+def _can_accept_job(duration_s=None) -> bool:
+    """
+    Свободен — берём. Занят — только при батчинге (до BATCH_MAX_JOBS задач) и только если и новая,
+    и все идущие задачи короткие: иначе короткие ждали бы на _WHISPER_LOCK весь прогон длинной.
+    """
+    active = [jid for jid, t in ACTIVE_JOBS.items() if not t.done()]
+    if not active:
+        return True
+    return (BATCH_WINDOW_S > 0 and len(active) < BATCH_MAX_JOBS and _POWER.mode == "full"
+            and _batch_eligible(duration_s) and all(_batch_eligible(JOB_DURATION_HINT.get(j)) for j in active))
+
 async def main():
-    global THREADS, LANG_HINT
+    global THREADS, LANG_HINT, DECODER_PROFILE, _MODEL_TASK, _HTTP
     log("START agent", WORKER_ID)
+    _startup_mark("main")
+    _LOOP_WD.start()
+    await asyncio.get_running_loop().run_in_executor(None, _POWER.refresh)
+    _POWER.start()
+    _MODEL_TASK = asyncio.create_task(model_startup())  # прогрев модели параллельно с остальным стартом
+    # статические факты и индекс кэша — параллельно, вне event loop
+    facts_src, ci_src = await asyncio.gather(load_static_facts(), asyncio.get_running_loop().run_in_executor(None, _CACHE_INDEX.load))
+    _startup_mark("facts_" + facts_src)
     env_probe_once()  # выполняется один раз при старте процесса
+    log("CACHE: index", ci_src, "files:", len(_CACHE_INDEX.files), "MB:", round(_CACHE_INDEX.total / 1048576, 1))
+    _startup_mark("cache_index")
+    await ensure_cache_quota_async()
+    try:
+        await start_metrics_server()
+    except Exception as e:
+        log("METRICS: endpoint failed:", repr(e))
 
     headers = {"Authorization": f"Bearer {TOKEN}"} if TOKEN else {}
     backoff = 1
 
-    async with aiohttp.ClientSession(timeout=_HTTP_TIMEOUT) as session:
+    async with HttpClients() as http:
+        _HTTP = http
+        _PREFETCH.start(http.control)
+        session = http.control
         while True:
+            hb_task = None
             try:
+                # прогрев ждём до подключения: иначе сокет висит без registration и сервер может его закрыть
+                await wait_model_ready()
+                _startup_mark("model_ready")
                 log("WS connect →", SERVER_WS)
                 async with session.ws_connect(
                     SERVER_WS,
                     headers=headers,
-                    heartbeat=HEARTBEAT_INTERVAL_S,
+                    heartbeat=WS_PING_S,
                     max_msg_size=64 * 1024 * 1024
                 ) as ws:
+                    ws = _WS_REC.wrap(ws)
                     log("WS connected ✓")
+                    _startup_mark("ws_connected")
 
                     # --- registration: ОДИН РАЗ на соединение ---
+                    # ip route и /proc — в executor'е, не на event loop перед registration
+                    _loop = asyncio.get_running_loop()
+                    device, network = await asyncio.gather(
+                        _loop.run_in_executor(None, get_device_info),
+                        _loop.run_in_executor(None, get_network_info, False))  # RTT — после registration.ok
                     reg = {
                         "type": "registration",
                         "worker_id": WORKER_ID,
-                        "device": get_device_info(),
+                        "device": device,
                         "software": get_software_versions(),
-                        "capabilities": {"supports_models": [os.path.basename(MODEL_PATH)]},
-                        "model_config": {"model_path": MODEL_PATH, "threads": THREADS, "lang_hint": LANG_HINT},
-                        "network": get_network_info()
+                        "capabilities": {"supports_models": [os.path.basename(MODEL_PATH)] if _MODEL_STATE["ok"] is not False else [],
+                                         "model_ok": _MODEL_STATE["ok"],
+                                         "result_formats": RESULT_FORMATS,
+                                         "result_encodings": RESULT_ENCODINGS,
+                                         "result_transports": RESULT_TRANSPORTS,
+                                         "heartbeat_modes": HB_MODES,
+                                         "input_range": True,
+                                         "batch": ({"max_jobs": BATCH_MAX_JOBS, "short_s": BATCH_SHORT_S,
+                                                    "requires": ["duration_s"]} if BATCH_WINDOW_S > 0 else None)},
+                        "pending_results": _WS_RESULTS.snapshot(),
+                        "in_flight_jobs": [dict(job_id=j, **st) for j, st in JOB_STAGES.items()],
+                        "recent_done": list(_RECENT_DONE),
+                        "power": _POWER.snapshot(),
+                        "model_config": {"model_path": MODEL_PATH, "threads": THREADS, "lang_hint": LANG_HINT,
+                                         "warmup_ms": _MODEL_STATE["warmup_ms"], "verify": _MODEL_STATE["verify"]},
+                        "network": network
                     }
                     if REG_INCLUDE_TOKEN:
                         reg["token"] = TOKEN  # включать только если сервер требует это дополнительно
@@ -783,20 +3472,15 @@ async def main():
                         t = data.get("type")
                         if t == "registration.ok" and data.get("worker_id") == WORKER_ID:
                             log("registration.ok")
-                            # немедленный однократный heartbeat для верификации канала
-                            try:
-                                hb_once = {
-                                    "type":"heartbeat","worker_id":WORKER_ID,"ts":int(time.time()),
-                                    "status": os.environ.get("AGENT_STATUS","idle"),
-                                    "metrics": get_metrics(),
-                                    "software": {"python": sys.version.split()[0]},
-                                    "network": get_network_info(),
-                                    "model_config": {"model_path": MODEL_PATH,"threads": THREADS,"lang_hint": LANG_HINT}
-                                }
-                                await ws.send_json(hb_once)
-                                slog("EVT:heartbeat.sent.immediate", hb_once)
-                            except Exception as _e:
-                                log("EVT:heartbeat.immediate.error", repr(_e))
+                            _M.inc("agent_ws_registrations_total")
+                            negotiate_result_format(data)
+                            negotiate_result_transport(data)
+                            _HB.negotiate(data)
+                            await _OUTBOX.flush(ws)
+                            _WS_LINK.attach(ws)
+                            if "registration_ok" not in _STARTUP_T:
+                                _startup_mark("registration_ok")
+                                slog("STARTUP: ms", _STARTUP_T)
                             break
                         if t == "control.ping":
                             await ws.send_json({"type": "control.pong", "worker_id": WORKER_ID})
@@ -805,7 +3489,7 @@ async def main():
                         # если пришло что-то иное на этапе рукопожатия — ошибка
                         raise RuntimeError(f"registration_failed: {data}")
 
-                    # heartbeat
+                    # heartbeat: первый (полный) уходит сразу, метрики и ping — вне loop
                     hb_task = asyncio.create_task(heartbeat_loop(ws))
 
                     # основной цикл сообщений
@@ -818,26 +3502,56 @@ async def main():
                                 continue
                             slog("EVT:ws.recv.loop", data)
                             t = data.get("type")
+                            _M.inc("agent_ws_frames_in_total", type=t if t in _WS_IN_TYPES else "other")
 
                             if t == "job.assign":
 
                                 global CURRENT_JOB
 
-                                if CURRENT_JOB and not CURRENT_JOB.done():
+                                jid = data.get("job_id")
+
+                                if jid in ACTIVE_JOBS and not ACTIVE_JOBS[jid].done():
+
+                                    # повторная выдача после реконнекта — задача уже идёт, не перезапускаем
+
+                                    await _OUTBOX.send_json({"type":"job.ack","job_id":jid,"worker_id":WORKER_ID,"stage":(JOB_STAGES.get(jid) or {}).get("stage")})
+
+                                    continue
+
+                                if jid in _RECENT_DONE:
+
+                                    await _OUTBOX.send_json(_RECENT_DONE[jid])
+
+                                    continue
+
+                                if _MODEL_STATE["ok"] is False:
+                                    _M.inc("agent_jobs_rejected_total", reason="model_invalid")
+                                    await _OUTBOX.send_json({"type":"job.error","job_id":data.get("job_id"),"worker_id":WORKER_ID,"error":{"code":"model_invalid","detail":_MODEL_STATE["error"]}})
+
+                                    continue
 
-                                    await ws.send_json({"type":"job.error","job_id":data.get("job_id"),"worker_id":WORKER_ID,"error":{"code":"busy","detail":"Worker is processing another job"}})
+                                _dur = data.get("duration_s") or (data.get("input") or {}).get("duration_s")
+                                if not _POWER.accepts(_dur):
+                                    _M.inc("agent_jobs_rejected_total", reason="power_" + _POWER.mode)
+                                    await _OUTBOX.send_json({"type":"job.error","job_id":data.get("job_id"),"worker_id":WORKER_ID,"error":{"code":"power_" + _POWER.mode,"detail":_POWER.snapshot()}})
+                                    continue
+
+                                if not _can_accept_job(_dur):
+                                    _M.inc("agent_jobs_rejected_total", reason="busy")
+                                    await _OUTBOX.send_json({"type":"job.error","job_id":data.get("job_id"),"worker_id":WORKER_ID,"error":{"code":"busy","detail":"Worker is processing another job"}})
 
                                     continue
 
 
                                 os.environ["AGENT_STATUS"] = "busy"
+                                _HB.kick("busy")
 
 
-                                async def _run_job():
+                                async def _run_job(data=data):
 
                                     try:
 
-                                        await handle_job(session, ws, data)
+                                        await handle_job(session, _OUTBOX, data)
 
                                     except Exception as e:
 
@@ -845,7 +3559,7 @@ async def main():
 
                                         try:
 
-                                            await ws.send_json({"type":"job.error","job_id":data.get("job_id"),"worker_id":WORKER_ID,"error":{"code":"exception","detail":repr(e)}})
+                                            await _OUTBOX.send_json(_final_frame({"type":"job.error","job_id":data.get("job_id"),"worker_id":WORKER_ID,"error":{"code":"exception","detail":repr(e)}}))
 
                                         except Exception:
 
@@ -853,17 +3567,40 @@ async def main():
 
                                     finally:
 
-                                        os.environ["AGENT_STATUS"] = "idle"
+                                        ACTIVE_JOBS.pop(data.get("job_id"), None)
+
+                                        JOB_STAGES.pop(data.get("job_id"), None)
+                                        JOB_DURATION_HINT.pop(data.get("job_id"), None)
+
+                                        if not ACTIVE_JOBS:
+
+                                            os.environ["AGENT_STATUS"] = "idle"
+                                            _HB.kick("idle")
 
 
                                 CURRENT_JOB = asyncio.create_task(_run_job())
 
+                                ACTIVE_JOBS[data.get("job_id")] = CURRENT_JOB
+                                JOB_DURATION_HINT[data.get("job_id")] = _dur
+
                                 continue
 
+                            elif t == "job.result.ack":
+                                _WS_RESULTS.on_ack(data)
                             elif t == "control.set_config":
                                 THREADS = int(data.get("threads", THREADS))
                                 LANG_HINT = data.get("lang_hint", LANG_HINT)
-                                await ws.send_json({"type":"control.ack","worker_id":WORKER_ID})
+                                ack = {"type":"control.ack","worker_id":WORKER_ID}
+                                if "decoder_profile" in data:
+                                    DECODER_PROFILE = data.get("decoder_profile") or ""
+                                    ack["decoder_profile"] = DECODER_PROFILE
+                                    ack["decoder_profiles"] = sorted(((await asyncio.get_running_loop().run_in_executor(
+                                        None, lambda: load_decoder_profiles(reload=True).get(decoder_profile_key()))) or {}).get("profiles", {}))
+                                if isinstance(data.get("heartbeat"), dict):
+                                    ack["heartbeat"] = _HB.configure(data["heartbeat"])
+                                else:
+                                    _HB.kick("config")
+                                await ws.send_json(ack)
                             elif t == "control.ping":
                                 slog("EVT:control.ping", data)
                                 await ws.send_json({"type":"control.pong","worker_id":WORKER_ID})
@@ -876,45 +3613,232 @@ async def main():
                             raise RuntimeError(f"WS closed: {msg.type}")
 
                     # нормальный выход из цикла означает закрытие сокета
+                    _WS_LINK.detach(ws)
                     if not hb_task.done():
                         hb_task.cancel()
                     backoff = 1  # сбросить бэкофф после успешной сессии
 
             except Exception as e:
+                _WS_LINK.detach()
+                _WS_REC.event("error", error=repr(e)[:200])
+                _M.inc("agent_ws_reconnects_total")
+                if hb_task is not None and not hb_task.done():
+                    hb_task.cancel()
+                if ACTIVE_JOBS:
+                    log("WS: jobs keep running across reconnect:", list(ACTIVE_JOBS))
                 log("WS error:", repr(e), "reconnect in", backoff, "s")
                 await asyncio.sleep(backoff)
                 backoff = min(backoff*2, 60)
 
 # --- FFmpeg: разложить стерео в два моно WAV 16 kHz ---
-def ffmpeg_split_stereo(src_mp3: Path, left_wav: Path, right_wav: Path, timeout=TIMEOUT_S):
-    """Split stereo MP3 into 2 mono WAV 16kHz in ONE ffmpeg run (faster, fewer I/O ops)."""
+def ffmpeg_split_stereo(src_mp3: Path, left_wav: Path, right_wav: Path, timeout=TIMEOUT_S, stall_s=None,
+                        start_s=None, dur_s=None):
+    """
+    Split stereo MP3 into 2 mono WAV 16kHz in ONE ffmpeg run (faster, fewer I/O ops).
+    start_s/dur_s — only this window (input seek: ffmpeg skips the rest without decoding it).
+    """
     left_wav.parent.mkdir(parents=True, exist_ok=True)
     right_wav.parent.mkdir(parents=True, exist_ok=True)
+    window = (["-ss", f"{start_s:.3f}"] if start_s else []) + (["-t", f"{dur_s:.3f}"] if dur_s else [])
     cmd = [
         "ffmpeg","-y","-hide_banner","-loglevel","error",
+        *window,
         "-i", str(src_mp3),
         "-filter_complex","[0:a]channelsplit=channel_layout=stereo[FL][FR]",
         "-map","[FL]","-ar","16000","-ac","1", str(left_wav),
         "-map","[FR]","-ar","16000","-ac","1", str(right_wav),
     ]
-    rc, out, err = run(cmd, timeout=timeout)
+    rc, out, err = run(cmd, timeout=timeout, stall_s=stall_s)
     if rc != 0:
         log("ffmpeg_split(one-pass) failed:", (err or "")[-400:])
         return rc, out, err
     return 0, out, err
 
-# --- Whisper.cpp launcher (создаёт <out_prefix>.txt) ---
-
-def whisper_run(wav_path: Path, out_prefix: str, timeout=3600):
+def ffmpeg_to_mono(src: Path, dst: Path, timeout=TIMEOUT_S, stall_s=None, start_s=None, dur_s=None):
+    """Mono source → one mono WAV 16kHz (channelsplit needs stereo input)."""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    window = (["-ss", f"{start_s:.3f}"] if start_s else []) + (["-t", f"{dur_s:.3f}"] if dur_s else [])
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", *window, "-i", str(src),
+           "-ar", "16000", "-ac", "1", str(dst)]
+    rc, out, err = run(cmd, timeout=timeout, stall_s=stall_s)
+    if rc != 0:
+        log("ffmpeg_to_mono failed:", (err or "")[-400:])
+    return rc, out, err
+
+# ================== разбор входного файла ==================
+# Заголовки WAV (RIFF/RF64) и MP3 (ID3v2, заголовок кадра, Xing/Info/VBRI) разбираются на Python —
+# без ffprobe. PCM s16 16 кГц раскладывается по каналам прямо из файла (NumPy по memmap, если
+# установлен, иначе array); ffmpeg зовётся, только когда нужно декодировать или передискретизировать.
+# Моно-вход распознаётся одним каналом (channelsplit на нём падает).
+try:
+    import numpy as _np  # type: ignore
+except Exception:
+    _np = None
+
+PCM_SPLIT_FRAMES = 1 << 18  # кадров за проход при раскладке PCM
+_MP3_KBPS = {1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),   # MPEG-1 Layer III
+             2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}       # MPEG-2/2.5 Layer III
+_MP3_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def _sniff_wav(f, size: int):
+    import struct
+    hdr = f.read(12)
+    if len(hdr) < 12 or hdr[:4] not in (b"RIFF", b"RF64") or hdr[8:12] != b"WAVE":
+        return None
+    info, pos = {"container": "wav"}, 12
+    while True:
+        f.seek(pos)
+        ch = f.read(8)
+        if len(ch) < 8:
+            return None
+        cid, clen = ch[:4], struct.unpack("<I", ch[4:])[0]
+        if cid == b"fmt ":
+            body = f.read(clen)
+            tag, channels, rate, _bps, align, bits = struct.unpack("<HHIIHH", body[:16])
+            if tag == 0xFFFE and len(body) >= 26:  # WAVE_FORMAT_EXTENSIBLE: кодек — в SubFormat
+                tag = struct.unpack("<H", body[24:26])[0]
+            info.update(codec={1: "pcm", 3: "float"}.get(tag, f"0x{tag:04x}"), channels=channels,
+                        sample_rate=rate, bits=bits, block_align=align)
+        elif cid == b"data":
+            if "block_align" not in info:
+                return None
+            info["data_offset"] = pos + 8
+            # потоковые writer'ы и RF64 пишут 0 / 0xFFFFFFFF — тогда данные до конца файла
+            avail = size - info["data_offset"]
+            info["data_bytes"] = avail if clen in (0, 0xFFFFFFFF) else min(clen, avail)
+            if info["block_align"] and info["sample_rate"]:
+                info["duration_s"] = round(info["data_bytes"] / info["block_align"] / info["sample_rate"], 3)
+            return info
+        pos += 8 + clen + (clen & 1)
+
+def _sniff_mp3(f, size: int):
+    head = f.read(10)
+    start = 0
+    if head[:3] == b"ID3" and len(head) == 10:
+        start = 10 + ((head[6] & 0x7F) << 21 | (head[7] & 0x7F) << 14 | (head[8] & 0x7F) << 7 | (head[9] & 0x7F))
+        if head[5] & 0x10:
+            start += 10  # footer
+    f.seek(start)
+    buf = f.read(64 * 1024)
+    for i in range(max(0, len(buf) - 4)):
+        if buf[i] != 0xFF or (buf[i + 1] & 0xE0) != 0xE0:
+            continue
+        h = int.from_bytes(buf[i:i + 4], "big")
+        ver, layer, br_i, sr_i = (h >> 19) & 3, (h >> 17) & 3, (h >> 12) & 15, (h >> 10) & 3
+        if ver == 1 or layer != 1 or br_i in (0, 15) or sr_i == 3:
+            continue
+        mpeg1 = ver == 3
+        kbps = _MP3_KBPS[1 if mpeg1 else 2][br_i]
+        rate = _MP3_RATES[ver][sr_i]
+        flen = (144 if mpeg1 else 72) * kbps * 1000 // rate + ((h >> 9) & 1)
+        nxt = i + flen
+        if nxt + 2 <= len(buf) and (buf[nxt] != 0xFF or (buf[nxt + 1] & 0xE0) != 0xE0):
+            continue  # ложная синхронизация
+        channels = 1 if (h >> 6) & 3 == 3 else 2
+        info = {"container": "mp3", "codec": "mp3", "sample_rate": rate, "channels": channels,
+                "bitrate_kbps": kbps, "vbr": False}
+        side = (32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9)
+        frames = None
+        x = i + 4 + side
+        if buf[x:x + 4] in (b"Xing", b"Info") and int.from_bytes(buf[x + 4:x + 8], "big") & 1:
+            frames = int.from_bytes(buf[x + 8:x + 12], "big")
+            info["vbr"] = buf[x:x + 4] == b"Xing"
+        elif buf[i + 36:i + 40] == b"VBRI":
+            frames = int.from_bytes(buf[i + 50:i + 54], "big")
+            info["vbr"] = True
+        if frames:
+            info["duration_s"] = round(frames * (1152 if mpeg1 else 576) / rate, 3)
+        else:  # CBR: по размеру потока (без ID3v1)
+            f.seek(max(0, size - 128))
+            tail = 128 if f.read(3) == b"TAG" else 0
+            info["duration_s"] = round((size - start - i - tail) * 8 / (kbps * 1000), 3)
+        return info
+    return None
+
+def sniff_audio(path: Path) -> dict:
+    """Формат входа по заголовкам: container, codec, sample_rate, channels, duration_s, ... ({} — не распознан)."""
+    try:
+        size = path.stat().st_size
+        with path.open("rb") as f:
+            info = _sniff_wav(f, size)
+            if info is None:
+                f.seek(0)
+                info = _sniff_mp3(f, size)
+        return info or {}
+    except Exception as e:
+        dbg("SNIFF: failed", path, repr(e))
+        return {}
+
+def _pcm_split(src: Path, left_wav: Path, right_wav, info: dict, start_s=None, dur_s=None):
+    """s16 PCM WAV → моно WAV по каналам без перекодирования (right_wav=None — моно-вход)."""
+    import wave, array
+    ch, align, rate = info["channels"], info["block_align"], info["sample_rate"]
+    if align != 2 * ch:
+        raise ValueError(f"block_align {align} for {ch} ch s16")
+    n = info["data_bytes"] // align
+    f0 = min(n, int((start_s or 0) * rate))
+    f1 = n if not dur_s else min(n, f0 + int(dur_s * rate))
+    off = info["data_offset"] + f0 * align
+    outs = [left_wav] + ([right_wav] if ch == 2 else [])
+    writers = []
+    try:
+        for p in outs:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            w = wave.open(str(p), "wb")
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(rate)
+            writers.append(w)
+        if ch == 2 and _np is not None and f1 > f0:
+            mm = _np.memmap(str(src), dtype="<i2", mode="r", offset=off, shape=(f1 - f0, 2))
+            for i in range(0, f1 - f0, PCM_SPLIT_FRAMES):
+                blk = mm[i:i + PCM_SPLIT_FRAMES]
+                writers[0].writeframes(_np.ascontiguousarray(blk[:, 0]).tobytes())
+                writers[1].writeframes(_np.ascontiguousarray(blk[:, 1]).tobytes())
+            del mm
+        else:
+            with src.open("rb") as f:
+                f.seek(off)
+                left = f1 - f0
+                while left > 0:
+                    buf = f.read(min(left, PCM_SPLIT_FRAMES) * align)
+                    if not buf:
+                        break
+                    left -= len(buf) // align
+                    if ch == 1:
+                        writers[0].writeframes(buf)
+                        continue
+                    a = array.array("h", buf[:len(buf) - len(buf) % align])  # сэмплы как есть, порядок байт не важен
+                    writers[0].writeframes(a[0::2].tobytes())
+                    writers[1].writeframes(a[1::2].tobytes())
+    finally:
+        for w in writers:
+            w.close()
+
+def split_channels(src: Path, left_wav: Path, right_wav: Path, info: dict, timeout=TIMEOUT_S, stall_s=None,
+                   start_s=None, dur_s=None):
     """
-    Запускает whisper.cpp и сохраняет результат в <out_prefix>.txt.
-    Без использования несуществующих флагов прогресса. Поддерживает разные варианты вывода
-    у бинарей `main` и `whisper-cli`.
-    Возвращает (rc, stdout, stderr). rc=0 при наличии .txt, иначе rc=2.
+    Каналы для распознавания по формату info (sniff_audio): PCM s16 16 кГц — напрямую, иначе ffmpeg.
+    Моно-вход → только left_wav. info["split"] = direct | ffmpeg. Возвращает (rc, out, err).
     """
-    import os, shutil
-
-    # --- выбираем бинарь ---
+    ch = info.get("channels")
+    if (info.get("codec") == "pcm" and info.get("bits") == 16 and info.get("sample_rate") == 16000
+            and ch in (1, 2)):
+        try:
+            _pcm_split(src, left_wav, right_wav, info, start_s, dur_s)
+            info["split"] = "direct"
+            return 0, "", ""
+        except Exception as e:
+            log("SPLIT: direct PCM failed, using ffmpeg:", repr(e))
+    info["split"] = "ffmpeg"
+    if ch == 1:
+        return ffmpeg_to_mono(src, left_wav, timeout=timeout, stall_s=stall_s, start_s=start_s, dur_s=dur_s)
+    return ffmpeg_split_stereo(src, left_wav, right_wav, timeout=timeout, stall_s=stall_s,
+                               start_s=start_s, dur_s=dur_s)
+
+# --- поиск бинаря whisper.cpp: WHISPER_BIN → сборка в репо → PATH → старый main ---
+def _whisper_exe():
+    import shutil
     candidates = []
     env_bin = os.environ.get("WHISPER_BIN")
     if env_bin and os.path.exists(env_bin) and os.access(env_bin, os.X_OK):
@@ -925,8 +3849,18 @@ def whisper_run(wav_path: Path, out_prefix: str, timeout=3600):
     if pth:
         candidates.append(pth)
     candidates.append(str(home / "worker_agent" / "whisper.cpp" / "build" / "bin" / "main"))
+    return next((c for c in candidates if os.path.exists(c) and os.access(c, os.X_OK)), None)
 
-    exe = next((c for c in candidates if os.path.exists(c) and os.access(c, os.X_OK)), None)
+# --- Whisper.cpp launcher (создаёт <out_prefix>.txt) ---
+
+def whisper_run(wav_path: Path, out_prefix: str, timeout=3600):
+    """
+    Запускает whisper.cpp и сохраняет результат в <out_prefix>.txt.
+    Без использования несуществующих флагов прогресса. Поддерживает разные варианты вывода
+    у бинарей `main` и `whisper-cli`.
+    Возвращает (rc, stdout, stderr). rc=0 при наличии .txt, иначе rc=2.
+    """
+    exe = _whisper_exe()
     if not exe:
         return 127, "", "whisper binary not found (set WHISPER_BIN or build whisper-cli)"
 
@@ -971,24 +3905,15 @@ def whisper_run(wav_path: Path, out_prefix: str, timeout=3600):
 
 
 # --- Whisper JSON helper (создаёт <out_prefix>.json) ---
-def whisper_run_json(wav_path: Path, out_prefix: str, timeout=3600):
+def whisper_run_json(wav_path: Path, out_prefix: str, timeout=3600, stall_s=None, threads=None, model=None, extra=None,
+                     on_line=None, lang=None):
     """
-    Запускает whisper.cpp и сохраняет JSON-сегменты в <out_prefix>.json (ключ 'segments').
-    Возвращает (rc, stdout, stderr). rc=0 при наличии .json, иначе rc=2.
+    Запускает whisper.cpp и сохраняет JSON в <out_prefix>.json (ключ 'transcription').
+    Сначала полный JSON (-ojf: токены с вероятностями), затем обычный -oj для старых сборок.
+    Возвращает (rc, stdout, stderr). rc=0 при наличии .json, иначе rc=2
+    (RC_DEADLINE/RC_STALL — если процесс убит наблюдателем, см. run(stall_s=...)).
     """
-    import os, shutil
-    # выбор бинаря — как в whisper_run
-    candidates = []
-    env_bin = os.environ.get("WHISPER_BIN")
-    if env_bin and os.path.exists(env_bin) and os.access(env_bin, os.X_OK):
-        candidates.append(env_bin)
-    home = Path.home()
-    candidates.append(str(home / "worker_agent" / "whisper.cpp" / "build" / "bin" / "whisper-cli"))
-    pth = shutil.which("whisper-cli")
-    if pth:
-        candidates.append(pth)
-    candidates.append(str(home / "worker_agent" / "whisper.cpp" / "build" / "bin" / "main"))
-    exe = next((c for c in candidates if os.path.exists(c) and os.access(c, os.X_OK)), None)
+    exe = _whisper_exe()
     if not exe:
         return 127, "", "whisper binary not found (set WHISPER_BIN or build whisper-cli)"
 
@@ -997,8 +3922,10 @@ def whisper_run_json(wav_path: Path, out_prefix: str, timeout=3600):
         try: out_json.unlink()
         except Exception: pass
 
-    base = [exe, "-m", str(MODEL_PATH), "-f", str(wav_path), "-l", str(LANG_HINT), "-t", str(THREADS)]
+    base = [exe, "-m", str(model or MODEL_PATH), "-f", str(wav_path), "-l", str(lang or LANG_HINT), "-t", str(threads or THREADS)]
+    base += list(extra or [])  # параметры декодера из профиля
     variants = [
+        ["-of", str(out_prefix), "-ojf"],          # whisper-cli: full JSON
         ["-of", str(out_prefix), "-oj"],           # main
         ["--output-json", str(out_json)],          # whisper-cli
     ]
@@ -1007,57 +3934,18 @@ def whisper_run_json(wav_path: Path, out_prefix: str, timeout=3600):
         if out_json.exists():
             try: out_json.unlink()
             except Exception: pass
-        rc, out, err = run(base + v, timeout=timeout, log_cmd=True)
+        rc, out, err = run(base + v, timeout=timeout, log_cmd=True, stall_s=stall_s, on_line=on_line,
+                           threads=threads or THREADS)
         if out_json.exists():
             return 0, out, err
+        if rc in (RC_DEADLINE, RC_STALL, RC_REPEAT) and (stall_s or on_line):
+            return rc, out, err  # убит наблюдателем — другие варианты флагов не помогут
         last_rc, last_out, last_err = rc, out, err
     if last_rc == 0:
         last_rc = 2
     return last_rc, last_out, (last_err or "") + f" OUTPUT_JSON_MISSING:{out_json}"
 
 
-# --- Whisper SRT helper (создаёт <out_prefix>.srt) ---
-def whisper_run_srt(wav_path: Path, out_prefix: str, timeout=3600):
-    """
-    Run whisper.cpp and save SRT in <out_prefix>.srt.
-    Returns (rc, stdout, stderr). rc=0 if .srt exists, else rc=2.
-    """
-    import os, shutil
-    candidates = []
-    env_bin = os.environ.get("WHISPER_BIN")
-    if env_bin and os.path.exists(env_bin) and os.access(env_bin, os.X_OK):
-        candidates.append(env_bin)
-    home = Path.home()
-    candidates.append(str(home / "worker_agent" / "whisper.cpp" / "build" / "bin" / "whisper-cli"))
-    pth = shutil.which("whisper-cli")
-    if pth:
-        candidates.append(pth)
-    candidates.append(str(home / "worker_agent" / "whisper.cpp" / "build" / "bin" / "main"))
-    exe = next((c for c in candidates if os.path.exists(c) and os.access(c, os.X_OK)), None)
-    if not exe:
-        return 127, "", "whisper binary not found (set WHISPER_BIN or build whisper-cli)"
-    out_srt = Path(f"{out_prefix}.srt")
-    if out_srt.exists():
-        try: out_srt.unlink()
-        except Exception: pass
-    base = [exe, "-m", str(MODEL_PATH), "-f", str(wav_path), "-l", str(LANG_HINT), "-t", str(THREADS)]
-    variants = [
-        ["-of", str(out_prefix), "-osrt"],     # main
-        ["--output-srt", str(out_srt)],        # whisper-cli
-    ]
-    last_rc, last_out, last_err = 1, "", ""
-    for v in variants:
-        if out_srt.exists():
-            try: out_srt.unlink()
-            except Exception: pass
-        rc, out, err = run(base + v, timeout=timeout, log_cmd=True)
-        if out_srt.exists():
-            return 0, out, err
-        last_rc, last_out, last_err = rc, out, err
-    if last_rc == 0:
-        last_rc = 2
-    return last_rc, last_out, (last_err or "") + f" OUTPUT_SRT_MISSING:{out_srt}"
-
 def _parse_srt_to_segments(path: Path, speaker: str):
     """
     Parse .srt file into list of segments: [{'speaker','text','start','end'}, ...]
@@ -1087,67 +3975,818 @@ def _parse_srt_to_segments(path: Path, speaker: str):
         if tx: segs.append({"speaker": speaker, "text": tx, "start": st, "end": en})
     return segs
 
+_WS_RE = re.compile(r"\s+")
+_NOISE_TEXTS = frozenset({"аплодисменты","[аплодисменты]","(аплодисменты)","(шум)","[шум]","(музыка)","[музыка]","applause"})
+
 def _clean_segment_text(t: str) -> str:
     # простая чистка сегментов от мусора
-    import re as _re
     if not t:
         return ""
-    t = _re.sub(r'\s+', ' ', t).strip()
-    low = t.lower()
-    if low in {"аплодисменты","[аплодисменты]","(аплодисменты)","(шум)","[шум]","(музыка)","[музыка]","applause"}:
+    t = _WS_RE.sub(" ", t).strip()
+    if t.lower() in _NOISE_TEXTS:
         return ""
     if len(t) < 3:
         return ""
     return t
 
 
-def _merge_adjacent_segments(segs, max_gap_s=0.6):
+def _whisper_json_segments(path: Path):
     """
-    Сливает соседние сегменты одного и того же speaker'а, если пауза между ними <= max_gap_s.
-    Возвращает новый список сегментов, отсортированный по времени.
+    Сегменты из JSON whisper.cpp: [{'start','end','text','confidence'}, ...], время в секундах
+    из целочисленных offsets (мс). confidence — средняя p по токенам (для -ojf), иначе None.
     """
-    if not isinstance(segs, list):
-        return segs
-    norm = []
-    for s in segs:
-        try:
-            norm.append({
-                "speaker": s.get("speaker"),
-                "text": (s.get("text") or "").strip(),
-                "start": s.get("start"),
-                "end": s.get("end"),
-            })
-        except Exception:
-            pass
-    norm = sorted(norm, key=lambda x: ((x.get("start") or 0), (x.get("end") or 0)))
+    try:
+        data = json.loads(path.read_text(encoding="utf-8", errors="ignore"))
+    except Exception:
+        return []
+    segs = []
+    for it in data.get("transcription") or []:
+        off = it.get("offsets") or {}
+        if "from" not in off or "to" not in off:
+            continue
+        conf = it.get("confidence")
+        toks = it.get("tokens")
+        if conf is None and toks:
+            ps = [t["p"] for t in toks if "p" in t and not str(t.get("text", "")).startswith("[_")]
+            conf = round(sum(ps) / len(ps), 4) if ps else None
+        segs.append({"start": off["from"] / 1000.0, "end": off["to"] / 1000.0,
+                     "text": it.get("text") or "", "confidence": conf})
+    if any(segs[i]["start"] > segs[i + 1]["start"] for i in range(len(segs) - 1)):
+        segs.sort(key=lambda x: (x["start"], x["end"]))
+    return segs
+
+def _write_segments_json(path: Path, segs):
+    """Записать сегменты в формате whisper JSON (offsets в мс), понятном _whisper_json_segments."""
+    data = {"transcription": [
+        {"offsets": {"from": int(round(s["start"] * 1000)), "to": int(round(s["end"] * 1000))},
+         "text": s["text"], "confidence": s.get("confidence")}
+        for s in segs
+    ]}
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+
+def _channel_segments(out_prefix: str):
+    """Сегменты канала по доступному выводу: <prefix>.json → .srt → .txt (без таймкодов)."""
+    pj, ps, pt = Path(f"{out_prefix}.json"), Path(f"{out_prefix}.srt"), Path(f"{out_prefix}.txt")
+    if pj.exists():
+        return _whisper_json_segments(pj)
+    if ps.exists():
+        return _parse_srt_to_segments(ps, None)
+    if pt.exists():
+        t = pt.read_text(encoding="utf-8", errors="ignore").strip()
+        return [{"text": t, "start": None, "end": None}] if t else []
+    return []
+
+def _build_segments(streams, max_gap_s=0.6):
+    """
+    streams: [(speaker, сегменты канала, отсортированные по start), ...]
+    Один проход heap-merge по каналам: чистка текста, роль, слияние соседних реплик
+    одного speaker'а с паузой <= max_gap_s. Возвращает итоговый список сегментов.
+    """
+    import heapq
+
+    def _tagged(speaker, segs):
+        for s in segs:
+            yield ((s.get("start") or 0), (s.get("end") or 0)), speaker, s
+
     out = []
-    for s in norm:
-        if not out:
-            out.append(s); continue
-        prev = out[-1]
-        can_merge = (
-            prev.get("speaker") == s.get("speaker") and
-            prev.get("end") is not None and
-            s.get("start") is not None and
-            (s["start"] - prev["end"] <= max_gap_s)
-        )
-        if can_merge:
-            prev["end"] = s.get("end", prev["end"])
-            prev["text"] = (prev.get("text","") + " " + s.get("text","")).strip()
-        else:
-            out.append(s)
+    for _key, speaker, s in heapq.merge(*(_tagged(sp, sg) for sp, sg in streams), key=lambda x: x[0]):
+        text = _clean_segment_text(s.get("text") or "")
+        if not text:
+            continue
+        st, en, conf = s.get("start"), s.get("end"), s.get("confidence")
+        prev = out[-1] if out else None
+        if (prev is not None and prev["speaker"] == speaker and prev["end"] is not None
+                and st is not None and st - prev["end"] <= max_gap_s):
+            if conf is not None and prev.get("confidence") is not None:
+                w1 = max(prev["end"] - prev["start"], 0.001)
+                w2 = max((en or st) - st, 0.001)
+                prev["confidence"] = round((prev["confidence"] * w1 + conf * w2) / (w1 + w2), 4)
+            prev["end"] = en if en is not None else prev["end"]
+            prev["text"] = prev["text"] + " " + text
+            continue
+        seg = {"speaker": speaker, "text": text, "start": st, "end": en}
+        if conf is not None:
+            seg["confidence"] = conf
+        out.append(seg)
     return out
 
+
+# ================== микро-батчинг коротких звонков ==================
+# Один процесс whisper на несколько коротких задач: каналы всех задач склеиваются
+# в один WAV через паузы тишины, после распознавания сегменты раскладываются
+# обратно по задачам/каналам и пишутся в обычные <job>_left.json / <job>_right.json.
+
+# whisper-прогоны разных задач не должны драться за ядра
+_WHISPER_LOCK = asyncio.Lock()
+
+def _wav_duration_s(path: Path) -> float:
+    import wave
+    try:
+        with wave.open(str(path), "rb") as w:
+            return w.getnframes() / float(w.getframerate() or 1)
+    except Exception:
+        return 0.0
+
+def _concat_wavs(parts, dst: Path, gap_s: float):
+    """
+    Склеить моно WAV (16 kHz s16) в один файл с паузой gap_s между кусками.
+    Возвращает [(start_s, dur_s), ...] — смещения кусков в общем файле.
+    """
+    import wave
+    spans = []
+    pos = 0
+    with wave.open(str(dst), "wb") as out:
+        out.setnchannels(1); out.setsampwidth(2); out.setframerate(16000)
+        for i, p in enumerate(parts):
+            with wave.open(str(p), "rb") as w:
+                if w.getnchannels() != 1 or w.getsampwidth() != 2 or w.getframerate() != 16000:
+                    raise RuntimeError(f"batch: unexpected wav format {p}")
+                n = w.getnframes()
+                out.writeframes(w.readframes(n))
+            spans.append((pos / 16000.0, n / 16000.0))
+            pos += n
+            if i < len(parts) - 1:
+                gap = int(gap_s * 16000)
+                out.writeframes(b"\x00\x00" * gap)
+                pos += gap
+    return spans
+
+def _split_batch_segments(segs, spans):
+    """
+    Разложить сегменты общего прогона по кускам, время — относительно куска.
+    Возвращает (сегменты по кускам, индексы кусков, которые задел сегмент через границу):
+    такой сегмент смешивает речь двух задач — его не делим, куски перераспознаются по отдельности.
+    """
+    out = [[] for _ in spans]
+    crossed = set()
+    for s in segs:
+        hit = [i for i, (st, dur) in enumerate(spans) if s["start"] < st + dur and s["end"] > st]
+        if not hit:
+            continue  # галлюцинация на тишине-разделителе
+        if len(hit) > 1:
+            crossed.update(hit)
+            continue
+        i = hit[0]
+        st, dur = spans[i]
+        out[i].append({
+            "text": s["text"],
+            "start": round(min(max(s["start"] - st, 0.0), dur), 3),
+            "end": round(min(max(s["end"] - st, 0.0), dur), 3),
+            "confidence": s.get("confidence"),
+        })
+    return out, crossed
+
+def _batch_transcribe(items, batch_id: str, lang: str, profile, winfo: dict):
+    """
+    items: [(job_id, left_wav, right_wav, left_pref, right_pref), ...] — все на языке lang и с профилем profile.
+    Один прогон whisper на все каналы всех задач. Возвращает (rc, err) на каждую задачу;
+    winfo дополняется info прогона (threads, attempts, ...).
+    """
+    total = sum(p.stat().st_size for _it in items for p in (_it[1], _it[2]))
+    scratch = _SCRATCH.job(f"batch_{batch_id}")
+    batch_wav = scratch.path("batch", ".wav", total)  # резервирует байты уровня до release
+    batch_pref = str(CACHE_DIR / f"batch_{batch_id}")
+    batch_json = Path(f"{batch_pref}.json")
+    parts = []
+    for _jid, lw, rw, _lp, _rp in items:
+        parts += [lw, rw]
+    try:
+        spans = _concat_wavs(parts, batch_wav, BATCH_GAP_S)
+        rc, out, err, w = whisper_run_guarded(batch_wav, batch_pref, _RTF.deadline_s(_wav_duration_s(batch_wav)),
+                                              profile, lang=lang, extra_args=BATCH_WHISPER_ARGS)
+        winfo.update(w)
+        if rc != 0 or not batch_json.exists():
+            return [(rc or 2, err) for _ in items]
+        per_part, crossed = _split_batch_segments(_whisper_json_segments(batch_json), spans)
+        res = [(0, err) for _ in items]
+        prefs = [p for _jid, _lw, _rw, lp, rp in items for p in (lp, rp)]
+        for i, seg_list in enumerate(per_part):
+            if i not in crossed:
+                _write_segments_json(Path(f"{prefs[i]}.json"), seg_list)
+                continue
+            # сегмент через границу — перераспознать кусок отдельно, чужой текст в результат не попадёт
+            log("BATCH: segment crosses part boundary, re-run", batch_id, "part", i)
+            rc_i, _o, err_i, _w = whisper_run_guarded(parts[i], prefs[i], _RTF.deadline_s(spans[i][1]), profile, lang=lang)
+            winfo["rerun_parts"] = winfo.get("rerun_parts", 0) + 1
+            if rc_i != 0:
+                res[i // 2] = (rc_i, err_i)
+        return res
+    except Exception as e:
+        log("BATCH: failed", batch_id, repr(e))
+        return [(2, repr(e)) for _ in items]
+    finally:
+        scratch.release(batch_wav)
+        cleanup_files(batch_json)
+
+class _ShortJobBatcher:
+    """
+    Копит короткие задачи BATCH_WINDOW_S секунд (или до BATCH_MAX_JOBS) и распознаёт их одним прогоном.
+    Очередь — своя на каждую пару (язык, профиль декодера): в один прогон whisper идут одни флаги.
+    """
+
+    def __init__(self):
+        self._pending = {}  # (lang, profile) -> [(item, fut, t_submit)]
+        self._timers = {}   # (lang, profile) -> TimerHandle
+        self._tasks = set()  # запущенные _run: держим ссылки, иначе GC может снять задачу
+
+    async def submit(self, job_id, left_wav, right_wav, left_pref, right_pref, lang, profile=None):
+        fut = asyncio.get_running_loop().create_future()
+        key = (lang, profile)
+        pending = self._pending.setdefault(key, [])
+        pending.append(((job_id, left_wav, right_wav, left_pref, right_pref), fut, time.time()))
+        if len(pending) >= BATCH_MAX_JOBS or not self._may_grow():
+            self._flush_now(key)  # соседей не будет — окно ожидания только добавило бы задержку
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(BATCH_WINDOW_S, self._flush_now, key)
+        return await fut
+
+    def _may_grow(self) -> bool:
+        """Может ли к батчу ещё кто-то присоединиться: возьмём новую короткую задачу или идёт короткая, ещё не сданная."""
+        if _can_accept_job(BATCH_SHORT_S):
+            return True
+        queued = {it[0] for batch in self._pending.values() for it, _f, _t in batch}
+        return any(jid not in queued and not t.done() and _batch_eligible(JOB_DURATION_HINT.get(jid))
+                   for jid, t in ACTIVE_JOBS.items())
+
+    def _flush_now(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if batch:
+            task = asyncio.create_task(self._run(batch, *key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch, lang, profile):
+        items = [it for it, _f, _t in batch]
+        batch_id = hashlib.sha1("".join(it[0] for it in items).encode("utf-8")).hexdigest()[:12]
+        t_start = time.time()
+        log("BATCH:", batch_id, "lang:", lang, "jobs:", [it[0] for it in items])
+        winfo = {}
+        try:
+            async with _WHISPER_LOCK:
+                t_w0 = time.time()
+                res = await asyncio.get_running_loop().run_in_executor(None, lambda: _batch_transcribe(items, batch_id,
+                                                                                                        lang, profile, winfo))
+            t_w_ms = int((time.time() - t_w0) * 1000)
+        except Exception as e:
+            res = [(2, repr(e)) for _ in items]
+            t_w_ms = 0
+        for (it, fut, t_sub), (rc, err) in zip(batch, res):
+            info = {
+                "batch_id": batch_id,
+                "batch_jobs": len(items),
+                "batch_wait_ms": int((t_start - t_sub) * 1000),
+                "batch_whisper_ms": t_w_ms,
+                "batch_threads": winfo.get("threads"),
+                "batch_rerun_parts": winfo.get("rerun_parts", 0),
+            }
+            if not fut.done():
+                fut.set_result(((rc, err), (rc, err), info))
+
+_BATCHER = _ShortJobBatcher()
+
+# ================== офлайн-батч (backfill) ==================
+# python agent.py batch --input DIR|manifest.jsonl --out results.jsonl [--jobs N] [--whisper-jobs M]
+# Те же этапы, что и handle_job (split → whisper → SRT → чистка → слияние), но без WS/HTTP:
+# ack/error уходят в локальный приёмник, job.result — строкой в results.jsonl.
+BATCH_AUDIO_EXTS = (".mp3", ".wav", ".ogg", ".m4a", ".flac", ".opus")
+
+class _LocalSink:
+    """Заменяет ws для офлайн-прогона: запоминает последнюю ошибку задачи."""
+
+    def __init__(self):
+        self.error = None
+
+    async def send_json(self, obj):
+        if obj.get("type") == "job.error":
+            self.error = obj.get("error")
+
+def _batch_inputs(src: Path):
+    """[(path, extra_input_dict)] из каталога (рекурсивно) или manifest.jsonl."""
+    items = []
+    if src.is_dir():
+        for p in sorted(src.rglob("*")):
+            if p.is_file() and p.suffix.lower() in BATCH_AUDIO_EXTS:
+                items.append((p, {}))
+        return items
+    with src.open(encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                rec = json.loads(line)
+                path = rec.pop("file", None) or rec.pop("path", None)
+                if path:
+                    items.append((Path(path), rec))
+            else:
+                items.append((Path(line), {}))
+    return items
+
+def _batch_done_hashes(out: Path):
+    done = set()
+    if not out.exists():
+        return done
+    with out.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except Exception:
+                continue
+            if rec.get("status") == "ok" and rec.get("audio_sha256"):
+                done.add(rec["audio_sha256"])
+    return done
+
+async def run_batch(src: Path, out: Path, jobs: int = 1, whisper_jobs: int = 1):
+    global _WHISPER_LOCK
+    _WHISPER_LOCK = asyncio.Semaphore(max(1, whisper_jobs))
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _CACHE_INDEX.load)
+    items = _batch_inputs(src)
+    done = _batch_done_hashes(out)
+    sem = asyncio.Semaphore(max(1, jobs))
+    out_lock = asyncio.Lock()
+    stats = {"files": len(items), "ok": 0, "error": 0, "skipped": 0, "audio_s": 0.0}
+    t0 = time.time()
+    log("BATCH-CLI:", len(items), "files;", len(done), "already done; jobs:", jobs, "whisper_jobs:", whisper_jobs)
+
+    async def _write(rec):
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        async with out_lock:
+            with out.open("a", encoding="utf-8") as f:
+                f.write(line)
+
+    async def _one(path: Path, extra: dict):
+        async with sem:
+            try:
+                sha = await loop.run_in_executor(None, sha256_file, path)
+            except Exception as e:
+                stats["error"] += 1
+                await _write({"file": str(path), "status": "error", "error": {"code": "unreadable", "detail": repr(e)}})
+                return
+            if sha in done:
+                stats["skipped"] += 1
+                return
+            done.add(sha)
+            job_id = extra.get("job_id") or f"batch-{sha[:16]}"
+            j_input = {k: v for k, v in extra.items() if k != "job_id"}
+            j_input.update(local_path=str(path), sha256=sha)
+            job = {"type": "job.assign", "job_id": job_id, "input": j_input}
+            sink = _LocalSink()
+            results = []
+
+            async def _deliver(payload):
+                results.append(payload)
+
+            t_job = time.time()
+            try:
+                await handle_job(None, sink, job, deliver=_deliver)
+            except Exception as e:
+                sink.error = {"code": "exception", "detail": repr(e)}
+            if results:
+                p = results[0]
+                stats["ok"] += 1
+                stats["audio_s"] += p["metrics"].get("audio_s") or 0
+                await _write({"file": str(path), "job_id": job_id, "audio_sha256": sha, "status": "ok",
+                              "metrics": p["metrics"], "text": p["text"], "segments": p["meta"]["segments"]})
+            else:
+                stats["error"] += 1
+                await _write({"file": str(path), "job_id": job_id, "audio_sha256": sha, "status": "error",
+                              "error": sink.error, "metrics": {"total_ms": int((time.time() - t_job) * 1000)}})
+
+    await asyncio.gather(*(_one(p, extra) for p, extra in items))
+    wall = time.time() - t0
+    stats["wall_s"] = round(wall, 1)
+    stats["audio_s"] = round(stats["audio_s"], 1)
+    stats["rtf"] = round(wall / stats["audio_s"], 3) if stats["audio_s"] else None
+    slog("BATCH-CLI: summary", stats)
+    return stats
+
+def batch_main(argv):
+    import argparse
+    ap = argparse.ArgumentParser(prog="agent.py batch", description="Offline transcription of archived calls")
+    ap.add_argument("--input", required=True, help="directory with audio files or manifest.jsonl")
+    ap.add_argument("--out", required=True, help="results.jsonl (appended; done files are skipped by sha256)")
+    ap.add_argument("--jobs", type=int, default=2, help="files in flight (download/split/whisper pipeline)")
+    ap.add_argument("--whisper-jobs", type=int, default=1, help="concurrent whisper runs")
+    args = ap.parse_args(argv)
+    stats = asyncio.run(run_batch(Path(args.input), Path(args.out), jobs=args.jobs, whisper_jobs=args.whisper_jobs))
+    return 0 if not stats["error"] else 1
+
+# ================== автотюнер декодера ==================
+# agent.py tune --refs DIR|manifest.jsonl: каждый эталонный звонок (моно-микс) прогоняется по сетке
+# параметров × потоков; считаем WER/CER к эталонной расшифровке и RTF, сохраняем Парето-фронт
+# и профили fast/balanced/accurate в DECODER_PROFILES_FILE под ключом устройство|модель.
+TUNE_GRID = {"beam_size": [1, 2, 5], "best_of": [1, 5], "audio_ctx": [0, 768], "flash_attn": [False, True]}
+
+def _tune_norm(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    return _WS_RE.sub(" ", re.sub(r"[^\w\s]", " ", text)).strip()
+
+def _edit_distance(a, b) -> int:
+    """Левенштейн по последовательностям (слова или символы), O(len(a)·len(b)) по памяти строки."""
+    if len(a) < len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        cur = [i]
+        for j, y in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (x != y)))
+        prev = cur
+    return prev[-1]
+
+def _tune_errors(ref_words, hyp_words):
+    """
+    (ошибки по словам, ошибки по символам без пробелов). Совпадающие куски слов (difflib) служат якорями,
+    Левенштейн считается только в промежутках между ними: на целом звонке квадрат по всей длине
+    непосилен, а по промежуткам — мелочь. Результат — верхняя оценка, на практике совпадает с точным.
+    """
+    import difflib
+    w_err = c_err = 0
+    i = j = 0
+    for bi, bj, n in difflib.SequenceMatcher(None, ref_words, hyp_words, autojunk=False).get_matching_blocks():
+        rw, hw = ref_words[i:bi], hyp_words[j:bj]
+        if rw or hw:
+            w_err += _edit_distance(rw, hw)
+            c_err += _edit_distance("".join(rw), "".join(hw))
+        i, j = bi + n, bj + n
+    return w_err, c_err
+
+def _tune_refs(src: Path):
+    """[(audio, reference_text)]: в каталоге — рядом лежащий <имя>.txt, в manifest — поле ref или ref_path."""
+    refs = []
+    for path, extra in _batch_inputs(src):
+        ref = extra.get("ref")
+        ref_path = extra.get("ref_path") or path.with_suffix(".txt")
+        if ref is None:
+            try:
+                ref = Path(ref_path).read_text(encoding="utf-8")
+            except Exception:
+                log("TUNE: no reference for", path, "— skipped")
+                continue
+        refs.append((path, ref))
+    return refs
+
+def _tune_grid(spec):
+    import itertools
+    grid = dict(TUNE_GRID)
+    if spec:
+        grid = json.loads(Path(spec).read_text(encoding="utf-8") if os.path.exists(spec) else spec)
+    keys = list(grid)
+    points, seen = [], set()
+    for values in itertools.product(*(grid[k] for k in keys)):
+        params = {k: v for k, v in zip(keys, values) if v not in (None, 0, False)}
+        args = tuple(decoder_args(params))  # неподдерживаемые флаги схлопывают точки сетки
+        if args not in seen:
+            seen.add(args)
+            points.append(params)
+    return points
+
+def _pareto(points):
+    """Недоминируемые точки по (wer, rtf), по возрастанию rtf."""
+    front = []
+    for p in sorted(points, key=lambda x: (x["rtf"], x["wer"])):
+        if not front or p["wer"] < front[-1]["wer"]:
+            front.append(p)
+    return front
+
+def _pick_profiles(front):
+    if not front:
+        return {}
+    fast, accurate = front[0], front[-1]
+    w0, w1 = accurate["wer"], fast["wer"]
+    r0, r1 = fast["rtf"], accurate["rtf"]
+    def _knee(p):
+        return ((p["wer"] - w0) / ((w1 - w0) or 1)) + ((p["rtf"] - r0) / ((r1 - r0) or 1))
+    return {"fast": fast, "balanced": min(front, key=_knee), "accurate": accurate}
+
+def run_tune(refs, grid, threads_list, model):
+    work = CACHE_DIR / "tune"
+    work.mkdir(parents=True, exist_ok=True)
+    wavs = []
+    for i, (path, ref) in enumerate(refs):
+        wav = work / f"ref{i}.wav"
+        rc, _out, err = run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", str(path),
+                             "-ar", "16000", "-ac", "1", str(wav)], timeout=TIMEOUT_S, stall_s=STALL_S)
+        if rc != 0:
+            log("TUNE: ffmpeg failed for", path, (err or "")[-200:])
+            continue
+        wavs.append((wav, _wav_duration_s(wav), _tune_norm(ref)))
+    if not wavs:
+        raise RuntimeError("no usable reference calls")
+    audio_total = sum(d for _w, d, _r in wavs)
+    points = []
+    for threads in threads_list:
+        for params in grid:
+            w_err = w_n = c_err = c_n = 0
+            wall = 0.0
+            ok = True
+            for k, (wav, dur, ref) in enumerate(wavs):
+                pref = str(work / f"ref{k}_hyp")
+                t0 = time.time()
+                rc, _out, err = whisper_run_json(wav, pref, timeout=_RTF.deadline_s(dur), stall_s=STALL_S,
+                                                 threads=threads, model=model, extra=decoder_args(params))
+                wall += time.time() - t0
+                if rc != 0:
+                    log("TUNE: whisper failed", params, "threads", threads, (err or "")[-200:])
+                    ok = False
+                    break
+                hyp = _tune_norm(" ".join(sg["text"] for sg in _whisper_json_segments(Path(pref + ".json"))))
+                we, ce = _tune_errors(ref.split(), hyp.split())
+                w_err += we
+                w_n += len(ref.split())
+                c_err += ce
+                c_n += len(ref.replace(" ", ""))
+            if not ok:
+                continue
+            pt = {"params": params, "threads": threads,
+                  "wer": round(w_err / max(1, w_n), 4), "cer": round(c_err / max(1, c_n), 4),
+                  "rtf": round(wall / audio_total, 4)}
+            points.append(pt)
+            log("TUNE:", json.dumps(pt, ensure_ascii=False))
+    cleanup_files(*work.glob("*"))
+    front = _pareto(points)
+    return {"tuned_at": int(time.time()), "refs": len(wavs), "audio_s": round(audio_total, 1),
+            "points": len(points), "pareto": front, "profiles": _pick_profiles(front)}
+
+def tune_main(argv):
+    import argparse
+    ap = argparse.ArgumentParser(prog="agent.py tune", description="Pick decoder profiles on reference calls")
+    ap.add_argument("--refs", required=True, help="directory with audio + <name>.txt references, or manifest.jsonl (path, ref|ref_path)")
+    ap.add_argument("--threads", default=str(THREADS), help="comma-separated thread counts to try")
+    ap.add_argument("--grid", default=None, help="JSON (inline or file) {param: [values]}; params: " + ", ".join(DECODER_PARAM_FLAGS))
+    ap.add_argument("--model", default=MODEL_PATH)
+    args = ap.parse_args(argv)
+    global _STATIC_FACTS
+    if _STATIC_FACTS is None:
+        _STATIC_FACTS = {"whisper": _probe_whisper_caps(), "device_model": _probe_device_model()}
+    refs = _tune_refs(Path(args.refs))
+    grid = _tune_grid(args.grid)
+    threads_list = [int(x) for x in args.threads.split(",") if x.strip()]
+    log("TUNE:", len(refs), "refs ×", len(grid), "param sets ×", len(threads_list), "thread counts")
+    res = run_tune(refs, grid, threads_list, args.model)
+    key = decoder_profile_key(args.model)
+    store = load_decoder_profiles(reload=True)
+    store[key] = res
+    _atomic_write_json(DECODER_PROFILES_FILE, store, indent=1)
+    log("TUNE: saved", key, "→", DECODER_PROFILES_FILE)
+    print(json.dumps(res["profiles"], ensure_ascii=False, indent=1))
+    return 0 if res["profiles"] else 1
+
+# ================== склейка кусков (agent.py merge) ==================
+# agent.py merge chunk1.json chunk2.json … | results.jsonl — эталонная склейка job.result кусков
+# одного звонка (как это сделает диспетчер); итог — JSON в stdout.
+def merge_main(argv):
+    import argparse
+    ap = argparse.ArgumentParser(prog="agent.py merge", description="Stitch chunk job results of one call")
+    ap.add_argument("results", nargs="+", help="job.result JSON files or JSONL with one result per line")
+    ap.add_argument("--gap", type=float, default=float(os.environ.get("SEG_MERGE_GAP_S", "0.6")),
+                    help="merge same-speaker segments across chunk borders up to this pause, s")
+    args = ap.parse_args(argv)
+    results = []
+    for name in args.results:
+        text = Path(name).read_text(encoding="utf-8")
+        try:
+            results.append(json.loads(text))
+        except ValueError:
+            results += [json.loads(line) for line in text.splitlines() if line.strip()]
+    print(json.dumps(merge_chunk_results(results, max_gap_s=args.gap), ensure_ascii=False, indent=1))
+    return 0
+
+# ================== воспроизведение записи WS (agent.py replay) ==================
+# agent.py replay --log rec.jsonl --audio DIR|file [--speed 10]: локальный стенд-диспетчер отдаёт агенту
+# (дочерний процесс) входящие кадры записи в исходном ритме (или ускоренно), audio_url подменяется на
+# локальные файлы, обрывы соединений повторяются. Отчёт: задержки job.assign → job.ack / job.done
+# против записанных и число отказов busy.
+def _replay_load(path: Path):
+    """Записанные сессии по соединениям: {'frames': входящие [(t_ms, кадр)], 'out': исходящие, 'closed': t_ms|None}."""
+    sessions = {}
+    with path.open(encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            if "rec" in rec:
+                continue
+            ses = sessions.setdefault(rec["c"], {"frames": [], "out": [], "closed": None})
+            if rec["d"] == "in":
+                ses["frames"].append((rec["t"], rec["f"]))
+            elif rec["d"] == "out":
+                ses["out"].append((rec["t"], rec["f"]))
+            elif rec["f"].get("type") in ("close", "error") and ses["closed"] is None:
+                ses["closed"] = rec["t"]
+    return [sessions[c] for c in sorted(sessions)]
+
+def _replay_latencies(events):
+    """events: [(t_ms, 'assign'|'ack'|'done'|'error', job_id, code)] → {job_id: {...}}, число busy."""
+    jobs, busy = {}, 0
+    for t, kind, jid, code in sorted(events, key=lambda e: e[0]):
+        if kind == "assign":
+            jobs.setdefault(jid, {"assign": t})
+            continue
+        j = jobs.get(jid)
+        if kind == "error" and code == "busy":
+            busy += 1
+            if j is not None and "ack" not in j:
+                jobs.pop(jid)  # отказанная выдача — в задержки не идёт, диспетчер выдаст заново
+            continue
+        if j is None:
+            continue
+        if kind == "ack":
+            j.setdefault("ack", t)
+        elif "done" not in j:
+            j["done"] = t
+            j["status"] = "ok" if kind == "done" else (code or "error")
+    out = {}
+    for jid, j in jobs.items():
+        out[jid] = {"ack_ms": round(j["ack"] - j["assign"], 1) if "ack" in j else None,
+                    "done_ms": round(j["done"] - j["assign"], 1) if "done" in j else None,
+                    "status": j.get("status")}
+    return out, busy
+
+def _replay_frame_event(t, obj):
+    """Кадр агента → событие для _replay_latencies (или None)."""
+    typ = obj.get("type")
+    if typ == "job.assign":
+        return (t, "assign", obj.get("job_id"), None)
+    if typ == "job.ack":
+        return (t, "ack", obj.get("job_id"), None)
+    if typ == "job.done":
+        return (t, "done", obj.get("job_id"), None)
+    if typ == "job.error":
+        err = obj.get("error")
+        return (t, "error", obj.get("job_id"), err.get("code") if isinstance(err, dict) else err)
+    return None
+
+def _replay_summary(lat: dict, busy: int):
+    def pct(vals, q):
+        vals = sorted(v for v in vals if v is not None)
+        return vals[min(len(vals) - 1, int(q * len(vals)))] if vals else None
+    acks = [j["ack_ms"] for j in lat.values()]
+    dones = [j["done_ms"] for j in lat.values()]
+    return {"jobs": len(lat), "completed": sum(1 for j in lat.values() if j["status"] == "ok"),
+            "busy_rejections": busy,
+            "ack_ms": {"p50": pct(acks, 0.5), "p95": pct(acks, 0.95), "max": pct(acks, 1.0)},
+            "done_ms": {"p50": pct(dones, 0.5), "p95": pct(dones, 0.95), "max": pct(dones, 1.0)}}
+
+async def run_replay(log_path: Path, audio: Path, speed: float = 1.0, port: int = 0,
+                     agent_log: Path = None, tail_s: float = 600.0):
+    from aiohttp import web
+    sessions = _replay_load(log_path)
+    recorded = []
+    for ses in sessions:
+        recorded += [e for e in (_replay_frame_event(t, f) for t, f in ses["frames"] + ses["out"]) if e]
+    files = sorted(p for p in audio.rglob("*") if p.is_file() and p.suffix.lower() in BATCH_AUDIO_EXTS) \
+        if audio.is_dir() else [audio]
+    if not files:
+        raise RuntimeError(f"replay: no audio in {audio}")
+    if port == 0:
+        with socket.socket() as so:
+            so.bind(("127.0.0.1", 0))
+            port = so.getsockname()[1]
+    base = f"http://127.0.0.1:{port}"
+    t0 = time.time()
+    live, audio_idx = [], {}
+    state = {"conn": 0, "finished": asyncio.Event()}
+
+    def now_ms():
+        return (time.time() - t0) * 1000
+
+    def rewrite(frame: dict) -> dict:
+        if frame.get("type") != "job.assign":
+            return frame
+        frame = json.loads(json.dumps(frame))
+        idx = audio_idx.setdefault(frame.get("job_id"), len(audio_idx))
+        frame["audio_url"] = f"{base}/audio/{idx}"
+        if isinstance(frame.get("input"), dict):
+            frame["input"].pop("local_path", None)
+        return frame
+
+    async def h_audio(req):
+        return web.FileResponse(files[int(req.match_info["n"]) % len(files)])
+
+    async def h_result(req):
+        await req.read()
+        return web.json_response({"ok": True})
+
+    async def pump(ws, frames, t_ref, close_at):
+        """Входящие кадры записи после registration.ok — в исходном ритме / speed; затем обрыв, если он был."""
+        t_start = time.time()
+        for t, frame in frames + ([(close_at, None)] if close_at is not None else []):
+            delay = (t - t_ref) / 1000.0 / speed - (time.time() - t_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if frame is None:
+                await ws.close()
+                return
+            frame = rewrite(frame)
+            await ws.send_json(frame)
+            ev = _replay_frame_event(now_ms(), frame)
+            if ev:
+                live.append(ev)
+
+    async def h_ws(req):
+        ws = web.WebSocketResponse()
+        await ws.prepare(req)
+        k = state["conn"]
+        state["conn"] += 1
+        reg = json.loads((await ws.receive()).data)
+        last = k + 1 >= len(sessions)
+        ses = sessions[k] if k < len(sessions) else {"frames": [], "closed": None}
+        t_ok, ok = next(((t, f) for t, f in ses["frames"] if f.get("type") == "registration.ok"),
+                        (0, {"type": "registration.ok", "result_transport": "http", "result_format": "json"}))
+        await ws.send_json(dict(ok, worker_id=reg.get("worker_id")))
+        frames = [(t, f) for t, f in ses["frames"] if f.get("type") not in ("registration.ok", "job.result.ack")]
+        task = asyncio.create_task(pump(ws, frames, t_ok, None if last else ses["closed"]))
+        try:
+            async for m in ws:
+                if m.type == aiohttp.WSMsgType.TEXT:
+                    ev = _replay_frame_event(now_ms(), json.loads(m.data))
+                    if ev:
+                        live.append(ev)
+                elif m.type == aiohttp.WSMsgType.BINARY and m.data[:4] == b"RSC1":
+                    import struct
+                    hl = struct.unpack(">I", m.data[4:8])[0]
+                    h = json.loads(m.data[8:8 + hl])
+                    await ws.send_json({"type": "job.result.ack", "result_id": h["result_id"], "seq": h["seq"]})
+                if task.done() and last:
+                    lat, _busy = _replay_latencies(live)
+                    if all(j["status"] for j in lat.values()):
+                        state["finished"].set()
+        finally:
+            task.cancel()
+        await ws.close()
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/audio/{n}", h_audio)
+    app.router.add_post("/api", h_result)
+    app.router.add_get("/ws/worker/{w}", h_ws)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    env = dict(os.environ, SERVER_WS=f"ws://127.0.0.1:{port}/ws/worker/{WORKER_ID}", SERVER_API=f"{base}/api",
+               WS_RECORD_FILE="", METRICS_PORT="0")
+    out = open(agent_log, "ab") if agent_log else asyncio.subprocess.DEVNULL
+    proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__),
+                                                env=env, stdout=out, stderr=asyncio.subprocess.STDOUT)
+    rec_span = max([t for t, *_ in recorded] or [0]) / 1000.0
+    try:
+        await asyncio.wait_for(state["finished"].wait(), timeout=rec_span / speed + tail_s)
+    except asyncio.TimeoutError:
+        log("REPLAY: timeout, unfinished jobs reported as null")
+    finally:
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), 10)
+        except asyncio.TimeoutError:
+            proc.kill()
+        await runner.cleanup()
+        if agent_log:
+            out.close()
+
+    lat_rec, busy_rec = _replay_latencies(recorded)
+    lat_live, busy_live = _replay_latencies(live)
+    return {"speed": speed, "sessions": len(sessions), "connections": state["conn"],
+            "recorded": _replay_summary(lat_rec, busy_rec), "replay": _replay_summary(lat_live, busy_live),
+            "jobs": {jid: {"replay": j, "recorded": lat_rec.get(jid)} for jid, j in lat_live.items()}}
+
+def replay_main(argv):
+    import argparse
+    ap = argparse.ArgumentParser(prog="agent.py replay", description="Replay recorded dispatcher WS traffic")
+    ap.add_argument("--log", required=True, help="recording made with WS_RECORD_FILE")
+    ap.add_argument("--audio", required=True, help="audio file or directory substituted for audio_url")
+    ap.add_argument("--speed", type=float, default=1.0, help="time compression factor (10 = ten times faster)")
+    ap.add_argument("--port", type=int, default=0)
+    ap.add_argument("--agent-log", default=None, help="write the agent's output here")
+    ap.add_argument("--tail", type=float, default=600.0, help="seconds to wait for jobs after the last frame")
+    args = ap.parse_args(argv)
+    rep = asyncio.run(run_replay(Path(args.log), Path(args.audio), speed=args.speed, port=args.port,
+                                 agent_log=Path(args.agent_log) if args.agent_log else None, tail_s=args.tail))
+    print(json.dumps(rep, ensure_ascii=False, indent=1))
+    return 0 if rep["replay"]["jobs"] == rep["replay"]["completed"] else 1
+
 # ================== entrypoint ==================
 if __name__ == "__main__":
     # гарантируем немедленный вывод
     os.environ.setdefault("PYTHONUNBUFFERED", "1")
 
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        sys.exit(batch_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "tune":
+        sys.exit(tune_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        sys.exit(replay_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        sys.exit(merge_main(sys.argv[2:]))
+
     # маленький баннер старта (чтобы не было «тихого» выхода)
     try:
-        log("START agent", WORKER_ID)
-        sw = get_software_versions()
-        log("FFmpeg:", sw.get("ffmpeg","?"), "Python:", sw.get("python","?"))
+        log("START agent", WORKER_ID, "Python:", sys.version.split()[0])
     except Exception:
         print("START agent", WORKER_ID, flush=True)
 
@@ -1190,6 +4829,7 @@ if __name__ == "__main__":
                 await task
             except asyncio.CancelledError:
                 pass
+        _WS_REC.close()
 
     try:
         asyncio.run(_runner())
@@ -0,0 +1,40 @@
+"""Склейка job.result кусков одного звонка (merge_chunk_results)."""
+import agent
+
+
+def _chunks():
+    # окна: [0, 32] и [28, 62]; стык — 30 с, перекрытие по 2 с с каждой стороны
+    left = {"meta": {"range": {"start_s": 0, "end_s": 30, "overlap_s": 2}, "segments": [
+        {"speaker": "operator", "text": "добрый день", "start": 1.0, "end": 2.0},
+        # та же реплика, что в правом куске, но в 0.5 с от края своего окна
+        {"speaker": "client", "text": "я звоню по поводу заказа", "start": 29.5, "end": 31.5, "overlap": True},
+        # непарный обрезок у самого края окна
+        {"speaker": "operator", "text": "обрезан", "start": 31.8, "end": 31.95, "overlap": True},
+    ]}}
+    right = {"meta": {"range": {"start_s": 30, "end_s": 60, "overlap_s": 2}, "segments": [
+        {"speaker": "client", "text": "я звоню по поводу заказа", "start": 29.5, "end": 31.6},
+        {"speaker": "operator", "text": "слушаю вас", "start": 40.0, "end": 41.0},
+    ]}}
+    return left, right
+
+
+def test_duplicate_keeps_version_with_more_context():
+    res = agent.merge_chunk_results(list(_chunks()))
+    assert res["chunks"] == 2
+    assert res["duplicates"] == 1
+    dup = [s for s in res["segments"] if s["speaker"] == "client"]
+    assert len(dup) == 1
+    assert dup[0]["end"] == 31.6  # версия правого куска: до края её окна 1.5 с против 0.5 с
+
+
+def test_edge_cut_dropped():
+    res = agent.merge_chunk_results(list(_chunks()))
+    assert res["edge_cut"] == 1
+    assert "обрезан" not in res["text"]
+    assert res["text"] == "добрый день я звоню по поводу заказа слушаю вас"
+    assert all("overlap" not in s for s in res["segments"])
+
+
+def test_order_of_inputs_does_not_matter():
+    left, right = _chunks()
+    assert agent.merge_chunk_results([left, right]) == agent.merge_chunk_results([right, left])
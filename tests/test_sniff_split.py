@@ -0,0 +1,127 @@
+"""Разбор заголовков входа (_sniff_wav, _sniff_mp3) и раскладка PCM по каналам (_pcm_split)."""
+import array
+import struct
+import wave
+
+import pytest
+
+import agent
+
+
+# ---------- WAV ----------
+
+def _wav_bytes(frames: bytes, channels=2, rate=16000, extensible=False, data_len=None):
+    align = 2 * channels
+    fmt = struct.pack("<HHIIHH", 0xFFFE if extensible else 1, channels, rate, rate * align, align, 16)
+    if extensible:
+        # cbSize, valid bits, channel mask, SubFormat GUID (первые 2 байта — кодек: 1 = PCM)
+        fmt += struct.pack("<HHI", 22, 16, 3) + struct.pack("<H", 1) + bytes(14)
+    body = b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt
+    body += b"data" + struct.pack("<I", len(frames) if data_len is None else data_len) + frames
+    return b"RIFF" + struct.pack("<I", 0 if data_len is not None else len(body)) + body
+
+
+@pytest.mark.parametrize("data_len", [0, 0xFFFFFFFF])
+def test_wav_extensible_streaming_length(tmp_path, data_len):
+    frames = bytes(16000 * 4)  # 1 с стерео s16
+    p = tmp_path / "a.wav"
+    p.write_bytes(_wav_bytes(frames, extensible=True, data_len=data_len))
+    info = agent.sniff_audio(p)
+    assert info["container"] == "wav"
+    assert info["codec"] == "pcm"  # из SubFormat, а не 0xfffe
+    assert (info["channels"], info["sample_rate"], info["bits"]) == (2, 16000, 16)
+    assert info["data_bytes"] == len(frames)  # 0 / 0xFFFFFFFF — данные до конца файла
+    assert info["duration_s"] == 1.0
+
+
+# ---------- MP3 ----------
+
+_FRAME_LEN = 417  # MPEG-1 Layer III, 128 кбит/с, 44.1 кГц, без padding
+_HDR = bytes([0xFF, 0xFB, 0x90, 0x00])  # стерео: side info 32 байта
+
+
+def _mp3(first_frame_payload=b"", frames=20):
+    first = (_HDR + first_frame_payload).ljust(_FRAME_LEN, b"\x00")
+    return first + (_HDR.ljust(_FRAME_LEN, b"\x00")) * (frames - 1)
+
+
+def test_mp3_cbr(tmp_path):
+    p = tmp_path / "cbr.mp3"
+    data = _mp3(frames=40)
+    p.write_bytes(data)
+    info = agent.sniff_audio(p)
+    assert (info["codec"], info["sample_rate"], info["channels"], info["bitrate_kbps"]) == ("mp3", 44100, 2, 128)
+    assert info["vbr"] is False
+    assert info["duration_s"] == round(len(data) * 8 / 128000, 3)
+
+
+def test_mp3_xing(tmp_path):
+    p = tmp_path / "xing.mp3"
+    xing = bytes(32) + b"Xing" + struct.pack(">II", 1, 1000)  # флаги: есть число кадров
+    p.write_bytes(_mp3(xing))
+    info = agent.sniff_audio(p)
+    assert info["vbr"] is True
+    assert info["duration_s"] == round(1000 * 1152 / 44100, 3)
+
+
+def test_mp3_vbri(tmp_path):
+    p = tmp_path / "vbri.mp3"
+    vbri = bytes(32) + b"VBRI" + bytes(10) + struct.pack(">I", 500)  # кадров — по смещению 50 от заголовка
+    p.write_bytes(_mp3(vbri))
+    info = agent.sniff_audio(p)
+    assert info["vbr"] is True
+    assert info["duration_s"] == round(500 * 1152 / 44100, 3)
+
+
+def test_mp3_after_id3(tmp_path):
+    p = tmp_path / "id3.mp3"
+    tag = b"ID3" + bytes([4, 0, 0]) + bytes([0, 0, 0, 20]) + bytes(20)
+    p.write_bytes(tag + _mp3(frames=10))
+    assert agent.sniff_audio(p)["bitrate_kbps"] == 128
+
+
+# ---------- раскладка по каналам ----------
+
+def _stereo_wav(path, n=5000):
+    left = array.array("h", [(i * 7) % 30000 - 15000 for i in range(n)])
+    right = array.array("h", [-(i * 13) % 30000 - 15000 for i in range(n)])
+    inter = array.array("h", [0]) * (2 * n)
+    inter[0::2], inter[1::2] = left, right
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(inter.tobytes())
+    return left.tobytes(), right.tobytes()
+
+
+def _read(path):
+    with wave.open(str(path), "rb") as w:
+        assert (w.getnchannels(), w.getsampwidth(), w.getframerate()) == (1, 2, 16000)
+        return w.readframes(w.getnframes())
+
+
+def _check_split(tmp_path):
+    src = tmp_path / "st.wav"
+    left, right = _stereo_wav(src)
+    info = agent.sniff_audio(src)
+    agent._pcm_split(src, tmp_path / "l.wav", tmp_path / "r.wav", info)
+    assert _read(tmp_path / "l.wav") == left
+    assert _read(tmp_path / "r.wav") == right
+    # окно: 0.1 с со 2-й десятой
+    agent._pcm_split(src, tmp_path / "l2.wav", tmp_path / "r2.wav", info, start_s=0.1, dur_s=0.1)
+    assert _read(tmp_path / "l2.wav") == left[1600 * 2:3200 * 2]
+    assert _read(tmp_path / "r2.wav") == right[1600 * 2:3200 * 2]
+
+
+def test_pcm_split_without_numpy(tmp_path, monkeypatch):
+    monkeypatch.setattr(agent, "_np", None)
+    monkeypatch.setattr(agent, "PCM_SPLIT_FRAMES", 1000)  # несколько блоков чтения
+    _check_split(tmp_path)
+
+
+def test_pcm_split_with_numpy(tmp_path, monkeypatch):
+    np = pytest.importorskip("numpy")
+    monkeypatch.setattr(agent, "_np", np)
+    monkeypatch.setattr(agent, "PCM_SPLIT_FRAMES", 1000)
+    _check_split(tmp_path)
@@ -1,6 +1,11 @@
 import os, asyncio, aiohttp
 from pathlib import Path
 
+CLOUD_API = os.environ.get("YADISK_CLOUD_API", "https://cloud-api.yandex.net/v1/disk")
+
+def yadisk_token():
+    return os.environ.get("YADISK_OAUTH_TOKEN") or os.environ.get("YANDEX_DISK_OAUTH")
+
 def _normalize_disk_path(remote_path: str) -> str:
     p = (remote_path or "").strip()
     if not p:
@@ -12,7 +17,6 @@ def _normalize_disk_path(remote_path: str) -> str:
     return "disk:" + p
 
 async def _yadisk_get_href(session: aiohttp.ClientSession, disk_path: str, token: str, timeout=30, retries=5):
-    CLOUD_API = "https://cloud-api.yandex.net/v1/disk"
     url = f"{CLOUD_API}/resources/download"
     params = {"path": disk_path}
     headers = {"Authorization": f"OAuth {token}"}
@@ -42,7 +46,7 @@ async def _yadisk_get_href(session: aiohttp.ClientSession, disk_path: str, token
             await r.release()
 
 async def yadisk_download_cloud(session: aiohttp.ClientSession, remote_path: str, dst: Path, timeout=300):
-    token = os.environ.get("YADISK_OAUTH_TOKEN") or os.environ.get("YANDEX_DISK_OAUTH")
+    token = yadisk_token()
     if not token:
         raise RuntimeError("YADISK_OAUTH_TOKEN is not set")
     disk_path = _normalize_disk_path(remote_path)
@@ -53,3 +57,24 @@ async def yadisk_download_cloud(session: aiohttp.ClientSession, remote_path: str
             async for chunk in r.content.iter_chunked(1 << 20):
                 f.write(chunk)
     return dst
+
+async def yadisk_list_recent(session: aiohttp.ClientSession, base_dir: str, token: str, limit=100, etag=None, timeout=30):
+    """
+    Last uploaded audio files under base_dir (newest first): (items, etag).
+    items: [{"path", "size", "modified", "md5"}]; None if the server answered 304 to If-None-Match.
+    """
+    url = f"{CLOUD_API}/resources/last-uploaded"
+    params = {"limit": str(limit), "media_type": "audio",
+              "fields": "items.path,items.size,items.modified,items.md5,items.type"}
+    headers = {"Authorization": f"OAuth {token}"}
+    if etag:
+        headers["If-None-Match"] = etag
+    async with session.get(url, headers=headers, params=params, timeout=timeout) as r:
+        if r.status == 304:
+            return None, etag
+        r.raise_for_status()
+        data = await r.json()
+        prefix = _normalize_disk_path(base_dir).rstrip("/") + "/"
+        items = [it for it in (data.get("items") or [])
+                 if it.get("type", "file") == "file" and (it.get("path") or "").startswith(prefix)]
+        return items, r.headers.get("ETag") or etag